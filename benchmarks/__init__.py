@@ -0,0 +1,2 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
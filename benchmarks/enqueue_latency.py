@@ -0,0 +1,100 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Measures borrow enqueue latency as a day queue grows.
+
+Run from the repository root against a scratch redis database, it will be
+flushed!
+
+    python -m benchmarks.enqueue_latency [redis_url]
+
+Pass memory instead of a url to run against the in-process backend, which
+leaves out the network round trips.
+
+"""
+
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import redis
+
+from inpassing.worker import LiveOrg, MemoryRedis, date_to_str
+from inpassing.worker.queue import _day_score, _queue_index, _token_field
+
+BenchOrg = namedtuple('BenchOrg', 'id timezone')
+
+QUEUE_SIZES = [10, 100, 1000, 10000, 100000]
+
+# How many enqueues are timed at each queue size.
+SAMPLES = 200
+
+# How many users are added to the queue with every pipeline round trip.
+FILL_BATCH = 1000
+
+
+def fill_queue(r, live_org, date, start_id, end_id):
+    """Adds users [start_id, end_id) to the borrow queue of a date.
+
+    This writes the queue and its index directly with pipelines, going through
+    enqueue_user_borrow would take forever at the larger sizes.
+    """
+    queue = live_org._borrow_queue(date)
+    for batch_start in range(start_id, end_id, FILL_BATCH):
+        batch_end = min(batch_start + FILL_BATCH, end_id)
+        pipe = r.pipeline(transaction=False)
+        pipe.incrby(live_org._queue_ticket_counter(), batch_end - batch_start)
+        for user_id in range(batch_start, batch_end):
+            pipe.hsetnx(live_org._user_token_hash(user_id),
+                        _token_field(user_id), 1)
+            pipe.zadd(queue, user_id, str(user_id))
+            pipe.hset(_queue_index(queue), str(user_id), 1)
+            pipe.sadd(live_org._user_queues_set(user_id),
+                      _day_score(date_to_str(date)))
+        pipe.execute()
+
+
+def time_enqueues(live_org, date, first_id, samples):
+    """Returns the median enqueue latency in microseconds."""
+    latencies = []
+    for user_id in range(first_id, first_id + samples):
+        start = time.perf_counter()
+        live_org.enqueue_user_borrow(date, user_id)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1e6
+
+
+def run(r, sizes=QUEUE_SIZES, samples=SAMPLES):
+    r.flushdb()
+    live_org = LiveOrg(r, BenchOrg(1, 'UTC'))
+    date = datetime(2017, 5, 1)
+    live_org._activate_day_queue(date)
+
+    print('{:>10} {:>16}'.format('queue len', 'enqueue (us)'))
+
+    queue_len = 0
+    next_id = 1
+    for size in sizes:
+        # Grow the queue up to the next size, not counting what the previous
+        # round of timed enqueues already added.
+        if size > queue_len:
+            fill_queue(r, live_org, date, next_id, next_id + size - queue_len)
+            next_id += size - queue_len
+            queue_len = size
+
+        latency = time_enqueues(live_org, date, next_id, samples)
+        next_id += samples
+        queue_len += samples
+
+        print('{:>10} {:>16.1f}'.format(size, latency))
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 else 'redis://localhost:6379/15'
+    if url == 'memory':
+        run(MemoryRedis())
+    else:
+        run(redis.StrictRedis.from_url(url))
@@ -0,0 +1,109 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Checks how long the entry points take to import against a budget.
+
+Every entry point is imported in a fresh interpreter a few times and the
+fastest run counts. On Python 3.7 and later this is the cumulative time
+`python -X importtime` reports for the entry point, along with the slowest
+modules it pulled in. Older interpreters don't have -X importtime, there the
+time is how much longer the interpreter takes to start with the import than
+without it.
+
+Modules that are only imported on first use are also checked, importing an
+entry point must not import them. Exits with 1 if anything is over budget or
+a deferred module was imported. Run from the repository root:
+
+    python -m benchmarks.import_time [runs]
+
+"""
+
+import re
+import subprocess
+import sys
+import time
+
+# Budgets in milliseconds. Both entry points take about 1200 ms on a slow
+# development machine (wall clock), the rest is headroom for noise.
+BUDGETS = {
+    'inpassing': 1500,
+    'run_worker': 1600,
+}
+
+# Imported on first use, never by an entry point.
+DEFERRED = ['numpy', 'bcrypt', 'pyparsing']
+
+# import time:       123 |       4567 | package.module
+IMPORTTIME_LINE = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)$')
+
+HAS_IMPORTTIME = sys.version_info >= (3, 7)
+
+
+def run_python(*args):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    return time.perf_counter() - start, proc
+
+
+def importtime(module):
+    """Returns (ms, [(cumulative ms, module)]) from -X importtime."""
+    _, proc = run_python('-X', 'importtime', '-c', 'import ' + module)
+    total = 0
+    top = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1e3
+        if match.group(3) == ' ':
+            top.append((cumulative, match.group(4)))
+        if match.group(4) == module:
+            total = cumulative
+    return total, sorted(top, reverse=True)
+
+
+def wall_clock(module):
+    """Returns the ms the import adds to starting the interpreter."""
+    with_import, _ = run_python('-c', 'import ' + module)
+    without, _ = run_python('-c', 'pass')
+    return (with_import - without) * 1e3, []
+
+
+def deferred_imports(module):
+    _, proc = run_python('-c', 'import sys, {}; print(" ".join(sorted(set({!r})'
+                               ' & set(sys.modules))))'.format(module,
+                                                               DEFERRED))
+    return proc.stdout.split()
+
+
+def run(runs):
+    measure = importtime if HAS_IMPORTTIME else wall_clock
+    print('measured with', '-X importtime' if HAS_IMPORTTIME else
+          'wall clock (no -X importtime before Python 3.7)')
+
+    failed = False
+    for module, budget in sorted(BUDGETS.items()):
+        ms, top = min((measure(module) for _ in range(runs)),
+                      key=lambda result: result[0])
+        over = ms > budget
+        failed = failed or over
+        print('{:>12} {:>8.1f} ms  budget {:>6} ms  {}'.format(
+            module, ms, budget, 'OVER' if over else 'ok'
+        ))
+        for cumulative, name in top[:5]:
+            print('{:>12} {:>8.1f} ms  {}'.format('', cumulative, name))
+
+        imported = deferred_imports(module)
+        if len(imported) > 0:
+            failed = True
+            print('{:>12} imports deferred modules: {}'.format(
+                '', ', '.join(imported)
+            ))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run(int(sys.argv[1]) if len(sys.argv) > 1 else 5))
@@ -0,0 +1,70 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Measures what the LiveOrg registry saves every request.
+
+Every org endpoint used to build a new LiveOrg, fetching the org and looking
+up its timezone each time. This compares that with asking the registry, and
+times building the key names a borrow touches. Nothing is sent to redis, the
+org lives in an in-memory sqlite database.
+
+    python -m benchmarks.live_org_registry [iterations]
+
+"""
+
+import sys
+import time
+from datetime import datetime
+
+from inpassing import create_app
+from inpassing.models import db, Org
+from inpassing.util import get_live_org_store
+from inpassing.view_util import get_live_org, get_org_by_id
+from inpassing.worker import LiveOrg
+
+
+class bench_config:
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+
+
+def time_per_call(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def run(iterations):
+    app = create_app(bench_config, suppress_env_config=True)
+    with app.test_request_context():
+        db.create_all()
+        db.session.add(Org(id=1, name='Bench Org',
+                           timezone='America/New_York'))
+        db.session.commit()
+
+        def fresh_live_org():
+            return LiveOrg(get_live_org_store(), get_org_by_id(1),
+                           use_scripts=app.config['LIVE_ORG_USE_SCRIPTS'])
+
+        def borrow_keys():
+            live_org = get_live_org(1)
+            live_org._active_queue_set()
+            live_org._active_queue_schedule()
+            live_org._user_token_hash(1)
+            live_org._queue_ticket_counter()
+            live_org._user_queues_set(1)
+            live_org._borrow_queue(datetime(2017, 5, 1))
+
+        fresh = time_per_call(fresh_live_org, iterations)
+        registry = time_per_call(lambda: get_live_org(1), iterations)
+        keys = time_per_call(borrow_keys, iterations) - registry
+
+    print('{:>22} {:>12}'.format('', 'us / call'))
+    print('{:>22} {:>12.2f}'.format('new LiveOrg', fresh * 1e6))
+    print('{:>22} {:>12.2f}'.format('registry', registry * 1e6))
+    print('{:>22} {:>12.2f}'.format('borrow key names', keys * 1e6))
+    print('saved per request: {:.2f} us'.format((fresh - registry) * 1e6))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
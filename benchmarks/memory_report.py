@@ -0,0 +1,120 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Compares the redis memory taken by the old and compact queue layouts.
+
+The same generated org is written twice, once with one token hash per org
+and day strings in the reverse indices (the old layout) and once with token
+buckets and day scores. MEMORY USAGE of every key is added up by kind. Needs
+redis 4 or later. Run from the repository root against a scratch redis
+database, it will be flushed!
+
+    python -m benchmarks.memory_report [redis_url] [users]
+
+"""
+
+import random
+import sys
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+
+import redis
+
+from inpassing.worker import LiveOrg, date_to_str
+from inpassing.worker.queue import _day_score, _queue_index, _token_field
+
+BenchOrg = namedtuple('BenchOrg', 'id timezone')
+
+DAYS = 20
+
+# How many of the days every user borrows on.
+DAYS_PER_USER = 5
+
+OLD_ORG_ID = 1
+NEW_ORG_ID = 2
+
+
+def generate(num_users, seed=0):
+    """Returns (user id, token, dates) for every generated user."""
+    rand = random.Random(seed)
+    dates = [datetime(2017, 5, 1) + timedelta(days=i) for i in range(DAYS)]
+    return [(user_id, rand.randint(1, 20),
+             rand.sample(dates, DAYS_PER_USER))
+            for user_id in range(1, num_users + 1)]
+
+
+def write_org(r, live_org, users, compact):
+    pipe = r.pipeline(transaction=False)
+    ticket = 0
+    for user_id, token, dates in users:
+        if compact:
+            pipe.hset(live_org._user_token_hash(user_id),
+                      _token_field(user_id), token)
+        else:
+            pipe.hset(str(live_org.org_id) + ':user-tokens', str(user_id),
+                      token)
+
+        for date in dates:
+            ticket += 1
+            queue = live_org._borrow_queue(date)
+            pipe.zadd(queue, ticket, str(user_id))
+            pipe.hset(_queue_index(queue), str(user_id), token)
+
+            day_str = date_to_str(date)
+            pipe.sadd(live_org._user_queues_set(user_id),
+                      _day_score(day_str) if compact else day_str)
+
+        if user_id % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def key_kind(key):
+    key = key.decode('utf-8')
+    if ':user-tokens' in key:
+        return 'tokens'
+    elif ':user-queues:' in key:
+        return 'reverse indices'
+    elif key.endswith('-index'):
+        return 'queue indices'
+    else:
+        return 'queues'
+
+
+def memory_by_kind(r, org_id):
+    usage = OrderedDict((kind, 0) for kind in (
+        'tokens', 'reverse indices', 'queues', 'queue indices'
+    ))
+    for key in r.scan_iter(str(org_id) + ':*'):
+        usage[key_kind(key)] += r.execute_command('MEMORY', 'USAGE', key)
+    return usage
+
+
+def run(r, num_users):
+    r.flushdb()
+    users = generate(num_users)
+
+    write_org(r, LiveOrg(r, BenchOrg(OLD_ORG_ID, 'UTC')), users, False)
+    write_org(r, LiveOrg(r, BenchOrg(NEW_ORG_ID, 'UTC')), users, True)
+
+    old = memory_by_kind(r, OLD_ORG_ID)
+    new = memory_by_kind(r, NEW_ORG_ID)
+
+    print('{} users, {} days each'.format(num_users, DAYS_PER_USER))
+    print('{:>16} {:>12} {:>12} {:>8}'.format('', 'old (KiB)', 'new (KiB)',
+                                              'ratio'))
+    for kind in list(old) + ['total']:
+        if kind == 'total':
+            old_bytes, new_bytes = sum(old.values()), sum(new.values())
+        else:
+            old_bytes, new_bytes = old[kind], new[kind]
+        print('{:>16} {:>12.1f} {:>12.1f} {:>8.2f}'.format(
+            kind, old_bytes / 1024, new_bytes / 1024,
+            new_bytes / old_bytes if old_bytes else 0
+        ))
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 else 'redis://localhost:6379/15'
+    num_users = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    run(redis.StrictRedis.from_url(url), num_users)
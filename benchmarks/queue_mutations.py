@@ -0,0 +1,71 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Compares the Lua script and WATCH / MULTI versions of LiveOrg mutations.
+
+A number of threads play out a morning rush on the same few days, every user
+borrows, refreshes and unborrows. Run from the repository root against a
+scratch redis database, it will be flushed!
+
+    python -m benchmarks.queue_mutations [redis_url] [threads]
+
+"""
+
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import redis
+
+from inpassing.worker import LiveOrg
+from inpassing.worker.scripts import load_scripts
+
+BenchOrg = namedtuple('BenchOrg', 'id timezone')
+
+USERS_PER_THREAD = 500
+DAYS = 3
+
+
+def rush(live_org, first_user_id, dates):
+    for user_id in range(first_user_id, first_user_id + USERS_PER_THREAD):
+        for date in dates:
+            live_org.enqueue_user_borrow(date, user_id)
+            live_org.refresh_user(date, user_id)
+            live_org.dequeue_user_borrow(date, user_id)
+
+
+def run(r, num_threads):
+    dates = [datetime(2017, 5, 1) + timedelta(days=i) for i in range(DAYS)]
+    load_scripts(r)
+
+    print('{:>12} {:>10} {:>14}'.format('mode', 'seconds', 'ops / second'))
+    for use_scripts in (False, True):
+        r.flushdb()
+        live_org = LiveOrg(r, BenchOrg(1, 'UTC'), use_scripts=use_scripts)
+
+        threads = [
+            threading.Thread(target=rush,
+                             args=(live_org, i * USERS_PER_THREAD, dates))
+            for i in range(num_threads)
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        num_ops = num_threads * USERS_PER_THREAD * DAYS * 3
+        print('{:>12} {:>10.2f} {:>14.0f}'.format(
+            'scripts' if use_scripts else 'transaction', elapsed,
+            num_ops / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 else 'redis://localhost:6379/15'
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    run(redis.StrictRedis.from_url(url), num_threads)
@@ -0,0 +1,61 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Compares parsing rule strings with the pyparsing grammar and by hand.
+
+An org only ever has a few distinct rule strings, so the hand written parser
+is timed with its cache (the same strings over and over) and without it
+(every string is new). Rule sets are stored already parsed now, reading them
+only unpacks the rules, which is timed too.
+
+    python -m benchmarks.rule_parser [iterations]
+
+"""
+
+import sys
+import time
+
+from inpassing.worker import rule_grammar, rules
+
+RULES = ['cur', 'none', '3', '1:1-20(40)', '2:1-20(40),21-40(60),61=7']
+
+
+def parses_per_second(parse, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for rule in RULES:
+            parse(rule)
+    return iterations * len(RULES) / (time.perf_counter() - start)
+
+
+def uncached(rule):
+    rules._parse_rule_string.cache_clear()
+    return rules.parse_rule(rule)
+
+
+PACKED = {rule: rules.pack_rule(rule) for rule in RULES}
+
+
+def unpack(rule):
+    return rules.unpack_rule(PACKED[rule])
+
+
+def run(iterations):
+    print('{:>22} {:>12}'.format('', 'parses / s'))
+    print('{:>22} {:>12.0f}'.format(
+        'pyparsing', parses_per_second(rule_grammar.parse_rule, iterations)
+    ))
+    print('{:>22} {:>12.0f}'.format(
+        'hand written', parses_per_second(uncached, iterations)
+    ))
+    print('{:>22} {:>12.0f}'.format(
+        'hand written, cached',
+        parses_per_second(rules.parse_rule, iterations)
+    ))
+    print('{:>22} {:>12.0f}'.format(
+        'unpacked', parses_per_second(unpack, iterations)
+    ))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
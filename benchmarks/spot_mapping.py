@@ -0,0 +1,78 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+"""Compares compiled spot mappings with asking a CompositeMapping.
+
+A big lot is split into a few hundred spot ranges spread over the daystates,
+then every pass of the org is looked up for one day. CompositeMapping asks
+every mapping and spot map in turn, CompiledMapping does a binary search per
+pass, or one vectorized lookup for all of them. Nothing touches redis.
+
+    python -m benchmarks.spot_mapping [ranges] [passes]
+
+"""
+
+import random
+import sys
+import time
+
+from inpassing.worker import rules
+from inpassing.worker.mapping import compile_mappings
+
+NUM_STATES = 6
+
+
+def make_rules(num_ranges, rand):
+    rule_strs = ['cur']
+    for state_id in range(1, NUM_STATES + 1):
+        spot_maps = []
+        for i in range(num_ranges // NUM_STATES):
+            start = i * 10 + 1
+            spot_maps.append('{}-{}({})'.format(start, start + 9,
+                                                rand.randint(0, 500)))
+        rule_strs.append('{}:{}'.format(state_id, ','.join(spot_maps)))
+    return rule_strs
+
+
+def run(num_ranges, num_passes):
+    rand = random.Random(1)
+    maps = [rules.parse_rule(rule) for rule in make_rules(num_ranges, rand)]
+    maps[0].current_state_id = 1
+    composite = rules.CompositeMapping(maps)
+
+    max_spot = num_ranges // NUM_STATES * 10
+    state_ids = [rand.randint(1, NUM_STATES) for _ in range(num_passes)]
+    spot_nums = [rand.randint(1, max_spot) for _ in range(num_passes)]
+    passes = list(zip(state_ids, spot_nums))
+
+    start = time.perf_counter()
+    expected = [composite.adjust_pass(*p) for p in passes]
+    walk = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = compile_mappings(composite)
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scalar = [compiled.adjust_pass(*p) for p in passes]
+    search = time.perf_counter() - start
+
+    start = time.perf_counter()
+    adjusted, can_park = compiled.adjust_passes(state_ids, spot_nums)
+    vectorized = time.perf_counter() - start
+
+    assert scalar == expected
+    assert [a if ok else None for a, ok in zip(adjusted.tolist(), can_park)] \
+        == expected
+
+    print('{} spot ranges, {} passes'.format(num_ranges, num_passes))
+    print('{:>22} {:>12}'.format('', 'ms'))
+    print('{:>22} {:>12.3f}'.format('CompositeMapping', walk * 1e3))
+    print('{:>22} {:>12.3f}'.format('compile', compile_time * 1e3))
+    print('{:>22} {:>12.3f}'.format('adjust_pass', search * 1e3))
+    print('{:>22} {:>12.3f}'.format('adjust_passes', vectorized * 1e3))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 600,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
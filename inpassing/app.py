@@ -5,6 +5,7 @@ from flask import Flask, jsonify
 from flask_jwt_extended import JWTManager
 
 from . import default_config, models, views, exceptions as ex
+from .worker import EligibilityCache, LiveOrgRegistry, MemoryRedis
 
 
 def create_app(config_obj=None, suppress_env_config=False, **kwargs):
@@ -43,6 +44,24 @@ def create_app(config_obj=None, suppress_env_config=False, **kwargs):
     # Init Redis
     views.redis_store.init_app(app)
 
+    # Pick where LiveOrgs keep their data.
+    backend = app.config['LIVE_ORG_BACKEND']
+    if backend == 'redis':
+        app.extensions['live_org_store'] = views.redis_store
+    elif backend == 'memory':
+        app.extensions['live_org_store'] = MemoryRedis()
+    else:
+        raise ValueError('unknown LIVE_ORG_BACKEND {!r}'.format(backend))
+
+    # LiveOrgs are reused between requests, they all share the store above
+    # (and its connection pool).
+    app.extensions['live_orgs'] = LiveOrgRegistry(
+        app.config['LIVE_ORG_REGISTRY_SIZE']
+    )
+    app.extensions['eligibility'] = EligibilityCache(
+        app.config['ELIGIBILITY_CACHE_SIZE']
+    )
+
     # Init JWT Helper
     jwt = JWTManager(app)
 
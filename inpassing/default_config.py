@@ -9,3 +9,39 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:///db.sqlite3'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 REDIS_URL = 'redis://localhost:6379/0'
+
+# Run LiveOrg queue mutations as Lua scripts (one round trip each), set to
+# False to fall back to WATCH / MULTI transactions.
+LIVE_ORG_USE_SCRIPTS = True
+
+# The most days a single borrow / lend request (or its undoing) may cover.
+MAX_QUEUE_DATE_RANGE = 31
+
+# Where LiveOrgs keep their queues, tokens and rules. 'redis' uses the server
+# at REDIS_URL, 'memory' keeps everything inside this process which is only
+# good for single process installs (and tests). The memory backend can't run
+# scripts so LIVE_ORG_USE_SCRIPTS doesn't apply to it.
+LIVE_ORG_BACKEND = 'redis'
+
+# How many LiveOrgs each process keeps around between requests.
+LIVE_ORG_REGISTRY_SIZE = 256
+
+# Computed daystates are kept for days at most this many days from today, so
+# that asking for a nearby day doesn't start over from the fixed daystate.
+DAYSTATE_CHECKPOINT_WINDOW = 366
+
+# The most days a single daystate calendar request may cover.
+MAX_CALENDAR_DATE_RANGE = 366
+
+# The most days a single daystate summary request may cover.
+MAX_SUMMARY_DATE_RANGE = 3660
+
+# The most days a single rule simulation may look ahead.
+MAX_SIMULATION_DAYS = 366
+
+# The most single-use rule sets a single page of rule sets may have, also how
+# many a page has when the client doesn't say.
+MAX_RULE_SETS_PER_PAGE = 100
+
+# How many org days of who may park where each process keeps around.
+ELIGIBILITY_CACHE_SIZE = 256
@@ -101,6 +101,69 @@ class RuleSetExists(InPassingException):
         )
 
 
+class InvalidRulePattern(InPassingException):
+    code = 422
+    err = 'invalid_rule_pattern'
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def get_msg(self):
+        return '{} is not a valid rule set pattern'.format(self.pattern)
+
+
+class InvalidRule(InPassingException):
+    code = 422
+    err = 'invalid_rule'
+
+    def __init__(self, rule):
+        self.rule = rule
+
+    def get_msg(self):
+        return '{} is not a valid rule'.format(self.rule)
+
+
+class InvalidDateRange(InPassingException):
+    code = 422
+    err = 'invalid_date_range'
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class InvalidDate(InPassingException):
+    code = 422
+    err = 'invalid_date'
+
+    def __init__(self, date):
+        self.date = date
+
+    def get_msg(self):
+        return '{} is not a valid date'.format(self.date)
+
+
+class InvalidFixDate(InPassingException):
+    code = 422
+    err = 'invalid_fix_date'
+
+    def __init__(self, date, last_date):
+        self.date = date
+        self.last_date = last_date
+
+    def get_msg(self):
+        return '{} comes before the daystate fixed on {}'.format(
+            self.date, self.last_date
+        )
+
+
+class InvalidPage(InPassingException):
+    code = 422
+    err = 'invalid_page'
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
 class NotImplemented(InPassingException):
     code = 422
     err = 'not_implemented'
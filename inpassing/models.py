@@ -105,6 +105,11 @@ class User(db.Model, UserMixin):
 
 class Pass(db.Model):
     __tablename__ = 'passes'
+    __table_args__ = (
+        # Finding the passes of some daystates of an org, see eligibility.
+        db.Index('ix_passes_org_id_assigned_state_id', 'org_id',
+                 'assigned_state_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
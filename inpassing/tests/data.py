@@ -9,6 +9,7 @@ from fixture import DataSet
 class Org(DataSet):
     class locust_valley:
         name = 'Locust Valley High School'
+        timezone = 'America/New_York'
 
 
 class Daystate(DataSet):
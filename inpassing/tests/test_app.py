@@ -3,12 +3,18 @@
 
 import json
 import re
+from datetime import datetime, timedelta
 
 from fixture import SQLAlchemyFixture
 from flask_testing import TestCase
 
 from . import data as test_data
-from .. import models, exceptions as ex
+from .. import models, view_util, exceptions as ex
+from ..util import get_live_org_store
+from ..worker import date_to_str
+from ..worker.queue import (FixedDaystate, org_version_key,
+                             passes_version_key)
+from ..worker.rules import RuleSet
 from ..app import create_app
 
 
@@ -19,6 +25,7 @@ class testing_config:
     PRESERVE_CONTEXT_ON_EXCEPTION = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    LIVE_ORG_BACKEND = 'memory'
 
 
 API_PREFIX = '/api/v1'
@@ -136,6 +143,507 @@ class TestApp(TestCase):
         self.assertStatus(res2, 422)
         self.assertEqual(res2.json['err'], ex.UserExistsError.err)
 
+    def test_daystate_calendar(self):
+        org_id = self.data.Org.locust_valley.id
+        a_day = self.data.Daystate.a_day.id
+        b_day = self.data.Daystate.b_day.id
+
+        live_org = view_util.get_live_org(org_id)
+        live_org.set_state_sequence([a_day, b_day])
+        live_org.push_fixed_daystate(FixedDaystate(
+            live_org.date_util.date_from_string('2017-05-01'), a_day
+        ))
+        live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        live_org.push_rule_set(RuleSet('sunday', False, 'none'))
+
+        token = self.auth(test_data.User.user)
+        url = API_PREFIX + '/orgs/{}/daystates/calendar'.format(org_id)
+
+        res = self.client.get(url + '?start=2017-05-06&end=2017-05-08',
+                              headers=auth_headers(token))
+        self.assert200(res)
+        calendar = json.loads(res.get_data().decode())
+        self.assertEqual(calendar, {
+            '2017-05-06': {'daystate_id': b_day, 'pattern': '*',
+                           'incrday': True},
+            '2017-05-07': {'daystate_id': b_day, 'pattern': 'sunday',
+                           'incrday': False},
+            '2017-05-08': {'daystate_id': a_day, 'pattern': '*',
+                           'incrday': True}
+        })
+
+        self.assertStatus(self.client.get(url + '?start=2017-05-06',
+                                          headers=auth_headers(token)), 422)
+        self.assertStatus(
+            self.client.get(url + '?start=2017-05-06&end=2017-05-01',
+                            headers=auth_headers(token)), 422
+        )
+
+    def test_daystate_summary(self):
+        org_id = self.data.Org.locust_valley.id
+        a_day = self.data.Daystate.a_day.id
+        b_day = self.data.Daystate.b_day.id
+
+        live_org = view_util.get_live_org(org_id)
+        live_org.set_state_sequence([a_day, b_day])
+        live_org.push_fixed_daystate(FixedDaystate(
+            live_org.date_util.date_from_string('2017-05-01'), a_day
+        ))
+        live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        live_org.push_rule_set(RuleSet('sunday', False, 'none'))
+        live_org.push_rule_set(RuleSet('saturday', False, 'none'))
+
+        models.db.session.add(models.Pass(
+            org_id=org_id, owner_id=self.data.User.user.id,
+            assigned_state_id=a_day, assigned_spot_num=1
+        ))
+        models.db.session.commit()
+
+        token = self.auth(test_data.User.user)
+        res = self.client.get(
+            API_PREFIX + '/orgs/{}/daystates/summary'.format(org_id) +
+            '?start=2017-05-03&end=2017-05-14', headers=auth_headers(token)
+        )
+        self.assert200(res)
+        summary = json.loads(res.get_data().decode())
+
+        # Wednesday to the sunday after next, one pass has an A day spot.
+        self.assertEqual(summary['school_days'], 8)
+        self.assertEqual(summary['daystates'],
+                         {str(a_day): 4, str(b_day): 4})
+        self.assertEqual(summary['weeks'], [{
+            'start': '2017-05-01',
+            'daystates': {str(a_day): 2, str(b_day): 1},
+            'usable_passes': 2
+        }, {
+            'start': '2017-05-08',
+            'daystates': {str(a_day): 2, str(b_day): 3},
+            'usable_passes': 2
+        }])
+
+    def test_eligibility(self):
+        org_id = self.data.Org.locust_valley.id
+        a_day = self.data.Daystate.a_day.id
+        b_day = self.data.Daystate.b_day.id
+
+        live_org = view_util.get_live_org(org_id)
+        live_org.set_state_sequence([a_day, b_day])
+        live_org.push_fixed_daystate(FixedDaystate(
+            live_org.date_util.date_from_string('2017-05-01'), a_day
+        ))
+        # On A days B day spots 1-10 park 100 spots up.
+        live_org.push_rule_set(RuleSet('*', True,
+                                       ['cur', '{}:1-10(100)'.format(b_day)]))
+        live_org.push_rule_set(RuleSet('sunday', False, 'none'))
+
+        def add_pass(state_id, spot_num, verified=True):
+            models.db.session.add(models.Pass(
+                org_id=org_id, owner_id=self.data.User.user.id,
+                assigned_state_id=state_id, assigned_spot_num=spot_num,
+                assigned_time=datetime(2017, 4, 1) if verified else None
+            ))
+            models.db.session.commit()
+
+        add_pass(a_day, 1)
+        add_pass(b_day, 5)
+        add_pass(b_day, 20)
+        add_pass(a_day, 2, verified=False)
+
+        def get(date=None):
+            url = API_PREFIX + '/orgs/{}/eligibility'.format(org_id)
+            if date is not None:
+                url += '?date=' + date
+            res = self.client.get(
+                url, headers=auth_headers(self.auth(test_data.User.mod))
+            )
+            self.assert200(res)
+            return json.loads(res.get_data().decode())
+
+        res = get('2017-05-01')
+        self.assertEqual(res['date'], '2017-05-01')
+        self.assertEqual(res['daystate_id'], a_day)
+        self.assertEqual([(p['state_id'], p['spot_num'], p['parks_in'])
+                          for p in res['passes']],
+                         [(a_day, 1, 1), (b_day, 5, 105)])
+
+        res = get('2017-05-02')
+        self.assertEqual(res['daystate_id'], b_day)
+        self.assertEqual([(p['state_id'], p['spot_num'], p['parks_in'])
+                          for p in res['passes']],
+                         [(b_day, 5, 5), (b_day, 20, 20)])
+
+        self.assertEqual(get('2017-05-07')['passes'], [])
+
+        # Without a date it is today in the org, the same as asking for it.
+        today = date_to_str(live_org.date_util.today())
+        self.assertEqual(get()['date'], today)
+        self.assertEqual(get(), get(today))
+
+        # New passes show up right away.
+        add_pass(a_day, 3)
+        self.assertEqual(len(get('2017-05-01')['passes']), 3)
+
+        # Other processes announce changes to passes through the store (bulk
+        # updates don't go through the session events).
+        models.Pass.query.filter_by(assigned_spot_num=3).update(
+            {'assigned_time': None}
+        )
+        models.db.session.commit()
+        self.assertEqual(len(get('2017-05-01')['passes']), 3)
+        get_live_org_store().incr(passes_version_key(org_id))
+        self.assertEqual(len(get('2017-05-01')['passes']), 2)
+
+        # Only moderators can see this.
+        self.assertStatus(self.client.get(
+            API_PREFIX + '/orgs/{}/eligibility?date=2017-05-01'.format(org_id),
+            headers=auth_headers(self.auth(test_data.User.user))
+        ), 403)
+        self.assertStatus(self.client.get(
+            API_PREFIX + '/orgs/{}/eligibility?date=tuesday'.format(org_id),
+            headers=auth_headers(self.auth(test_data.User.mod))
+        ), 422)
+
+    def test_rules(self):
+        org_id = self.data.Org.locust_valley.id
+
+        def rules_request(method, js):
+            return self.client.open(
+                API_PREFIX + '/orgs/{}/rules'.format(org_id), method=method,
+                content_type='application/json', data=json.dumps(js),
+                headers=auth_headers(self.auth(test_data.User.mod))
+            )
+
+        rule_set = {'pattern': 'monday', 'incrday': True,
+                    'rules': ['cur', '1:1-20(40)']}
+        self.assertStatus(rules_request('PUT', {'rule_set': rule_set}), 204)
+
+        res = rules_request('GET', {'criteria': {'reoccurring': True},
+                                    'filter': {}})
+        self.assert200(res)
+        self.assertEqual(json.loads(res.get_data().decode())['rule_sets'],
+                         [rule_set])
+
+        self.assertStatus(rules_request('PUT', {'rule_set': {
+            'pattern': 'monday', 'incrday': True, 'rules': ['nope']
+        }}), 422)
+        self.assertStatus(rules_request('PUT', {'rule_set': {
+            'pattern': 'monday', 'rules': ['cur']
+        }}), 422)
+        self.assertStatus(rules_request('PUT', {'rule_set': {
+            'pattern': 'sunday', 'incrday': False, 'rules': 'none'
+        }}), 204)
+
+        # Changes can take effect from a day on, days before keep the rule set
+        # they had.
+        self.assertStatus(rules_request('PUT', {
+            'rule_set': dict(rule_set, incrday=False),
+            'effective_date': '2017-05-01'
+        }), 204)
+        live_org = view_util.get_live_org(org_id)
+        self.assertTrue(live_org.get_rule_set(
+            live_org.date_util.date_from_string('2017-04-24')).incrday)
+        self.assertFalse(live_org.get_rule_set(
+            live_org.date_util.date_from_string('2017-05-01')).incrday)
+        self.assertStatus(rules_request('PUT', {
+            'rule_set': rule_set, 'effective_date': 'soon'
+        }), 422)
+
+        # Single-use rule sets can only be posted once for a day.
+        snow_day = {'pattern': '2017-05-04', 'incrday': False,
+                    'rules': ['none']}
+        self.assertStatus(rules_request('POST', {'rule_set': snow_day}), 204)
+        self.assertStatus(rules_request('POST', {'rule_set': dict(
+            snow_day, pattern='2017-05-05'
+        )}), 204)
+        res = rules_request('POST', {'rule_set': snow_day})
+        self.assertStatus(res, 422)
+        self.assertEqual(res.json['err'], ex.RuleSetExists.err)
+
+        # The same day written without leading zeros is still a duplicate.
+        res = rules_request('POST', {'rule_set': dict(
+            snow_day, pattern='2017-5-4'
+        )})
+        self.assertStatus(res, 422)
+        self.assertEqual(res.json['err'], ex.RuleSetExists.err)
+        self.assertStatus(rules_request('PUT', {'rule_set': dict(
+            snow_day, pattern='2017-5-5', incrday=True
+        )}), 204)
+        live_org = view_util.get_live_org(org_id)
+        day = live_org.date_util.date_from_string('2017-05-05')
+        self.assertEqual(
+            [(rs.pattern, rs.incrday)
+             for rs in live_org.get_single_use_rule_set_page(day, day)[0]],
+            [('2017-05-05', True)]
+        )
+
+    def test_rules_pages(self):
+        org_id = self.data.Org.locust_valley.id
+        live_org = view_util.get_live_org(org_id)
+        live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        for day in range(1, 8):
+            live_org.push_rule_set(
+                RuleSet('2017-05-{:02d}'.format(day), False, 'none')
+            )
+        # Two rule sets on one day, the page boundary falls between them.
+        live_org.push_rule_set(RuleSet('2017-05-03', True, 'cur'))
+
+        def get(**args):
+            res = self.client.get(
+                API_PREFIX + '/orgs/{}/rules'.format(org_id),
+                query_string=args,
+                headers=auth_headers(self.auth(test_data.User.user))
+            )
+            self.assert200(res)
+            return json.loads(res.get_data().decode())
+
+        patterns = []
+        page = get(start='2017-05-02', end='2017-05-06', limit=2)
+        while page['next_cursor'] is not None:
+            self.assertEqual(len(page['rule_sets']), 2)
+            patterns.extend(rs['pattern'] for rs in page['rule_sets'])
+            page = get(start='2017-05-02', end='2017-05-06', limit=2,
+                       cursor=page['next_cursor'])
+        patterns.extend(rs['pattern'] for rs in page['rule_sets'])
+        self.assertEqual(patterns, ['2017-05-02', '2017-05-03', '2017-05-03',
+                                    '2017-05-04', '2017-05-05', '2017-05-06',
+                                    '*'])
+
+        self.assertEqual([rs['pattern'] for rs in
+                          get(pattern='2017-05-07')['rule_sets']],
+                         ['2017-05-07'])
+        self.assertEqual([rs['pattern'] for rs in
+                          get(pattern='*', limit=1)['rule_sets']], ['*'])
+        self.assertEqual(get(pattern='2017-05-07', end='2017-05-06'),
+                         {'rule_sets': [], 'next_cursor': None})
+
+        for args in [{'limit': 0}, {'limit': 'lots'}, {'cursor': 'nope'},
+                     {'start': 'may'}, {'pattern': 'someday'},
+                     {'start': '2017-05-02', 'end': '2017-05-01'}]:
+            self.assertStatus(self.client.get(
+                API_PREFIX + '/orgs/{}/rules'.format(org_id),
+                query_string=args,
+                headers=auth_headers(self.auth(test_data.User.user))
+            ), 422)
+
+    def test_rules_simulate(self):
+        org_id = self.data.Org.locust_valley.id
+        a_day = self.data.Daystate.a_day.id
+        b_day = self.data.Daystate.b_day.id
+
+        live_org = view_util.get_live_org(org_id)
+        live_org.set_state_sequence([a_day, b_day])
+        live_org.push_fixed_daystate(FixedDaystate(
+            live_org.date_util.date_from_string('2017-05-01'), a_day
+        ))
+        live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        live_org.push_rule_set(RuleSet('sunday', False, 'none'))
+        live_org.push_rule_set(RuleSet('saturday', False, 'none'))
+
+        models.db.session.add(models.Pass(
+            org_id=org_id, owner_id=self.data.User.user.id,
+            assigned_state_id=a_day, assigned_spot_num=1,
+            assigned_time=datetime(2017, 4, 1)
+        ))
+        models.db.session.commit()
+
+        def simulate(js):
+            return self.client.post(
+                API_PREFIX + '/orgs/{}/rules/simulate'.format(org_id),
+                content_type='application/json', data=json.dumps(js),
+                headers=auth_headers(self.auth(test_data.User.mod))
+            )
+
+        # A snow day on Thursday keeps the A day from Wednesday, which pushes
+        # Friday (and the weekend) to a B day.
+        res = simulate({
+            'rule_sets': [{'pattern': '2017-05-04', 'incrday': False,
+                           'rules': ['none']}],
+            'start_date': '2017-05-01',
+            'days': 6
+        })
+        self.assert200(res)
+        days = json.loads(res.get_data().decode())['days']
+        self.assertEqual([day['date'] for day in days],
+                         ['2017-05-04', '2017-05-05', '2017-05-06'])
+        self.assertEqual(days[0]['before']['pattern'], '*')
+        self.assertEqual(days[0]['after']['pattern'], '2017-05-04')
+        self.assertEqual(days[0]['after']['daystate_id'], a_day)
+        self.assertEqual(days[1]['before']['daystate_id'], a_day)
+        self.assertEqual(days[1]['after']['daystate_id'], b_day)
+        self.assertEqual(days[0]['affected_passes'], [])
+        self.assertEqual([(p['before'], p['after'])
+                          for p in days[1]['affected_passes']], [(1, None)])
+        self.assertEqual(days[2]['affected_passes'], [])
+
+        # Nothing was changed for real.
+        self.assertEqual(live_org.get_rule_set(
+            live_org.date_util.date_from_string('2017-05-04')).pattern, '*')
+
+        self.assertStatus(simulate({
+            'fixes': [{'date': '2017-05-03', 'daystate_id': 12345}]
+        }), 422)
+        self.assertStatus(simulate({'fixes': [a_day]}), 422)
+        self.assertStatus(simulate({'days': 100000}), 422)
+
+        # Malformed rule sets and fixes are client errors.
+        res = simulate({'rule_sets': [{'pattern': 'monday'}]})
+        self.assertStatus(res, 422)
+        self.assertEqual(res.json['err'], ex.MissingFieldError.err)
+        self.assertStatus(simulate({'rule_sets': ['monday']}), 422)
+        self.assertStatus(simulate({'rule_sets': [
+            {'pattern': ['monday'], 'incrday': False, 'rules': []}
+        ]}), 422)
+        for daystate_id in ([a_day], {'id': a_day}, True):
+            res = simulate({
+                'fixes': [{'date': '2017-05-03', 'daystate_id': daystate_id}]
+            })
+            self.assertStatus(res, 422)
+            self.assertEqual(res.json['err'], ex.InvalidDaystate.err)
+
+        # Fixes can't come before the newest one, pushed or proposed.
+        res = simulate({
+            'fixes': [{'date': '2017-04-28', 'daystate_id': b_day}]
+        })
+        self.assertStatus(res, 422)
+        self.assertEqual(res.json['err'], ex.InvalidFixDate.err)
+        self.assertStatus(simulate({
+            'fixes': [{'date': '2017-05-08', 'daystate_id': b_day},
+                      {'date': '2017-05-03', 'daystate_id': a_day}]
+        }), 422)
+        self.assert200(simulate({
+            'fixes': [{'date': '2017-05-01', 'daystate_id': b_day}],
+            'start_date': '2017-05-01'
+        }))
+
+    def test_live_org_changes(self):
+        org = models.Org.query.get(self.data.Org.locust_valley.id)
+        live_org = view_util.get_live_org(org.id)
+
+        # The change isn't announced until it is committed.
+        org.timezone = 'Europe/London'
+        models.db.session.flush()
+        self.assertIs(view_util.get_live_org(org.id), live_org)
+
+        models.db.session.commit()
+        live_org = view_util.get_live_org(org.id)
+        self.assertEqual(live_org.timezone.zone, 'Europe/London')
+        self.assertIs(view_util.get_live_org(org.id), live_org)
+
+        # Other processes announce changes through the store.
+        get_live_org_store().incr(org_version_key(org.id))
+        self.assertIsNot(view_util.get_live_org(org.id), live_org)
+
+    def test_borrow_and_lend_ranges(self):
+        org_id = self.data.Org.locust_valley.id
+        pass_ = models.Pass(org_id=org_id, owner_id=self.data.User.user.id)
+        models.db.session.add(pass_)
+        models.db.session.commit()
+        pass_id = pass_.id
+        token = self.auth(test_data.User.user)
+
+        def post(url, js):
+            res = self.client.post(
+                API_PREFIX + url, content_type='application/json',
+                data=json.dumps(js), headers=auth_headers(token)
+            )
+            return res.status_code, res.json
+
+        days = {'start_date': '2030-05-01', 'end_date': '2030-05-03'}
+        self.assertEqual(post('/passes/borrow', dict(days, org_id=org_id)), (
+            200, {'2030-05-01': {'enqueued': True},
+                  '2030-05-02': {'enqueued': True},
+                  '2030-05-03': {'enqueued': True}}
+        ))
+        self.assertEqual(post('/passes/borrow', {
+            'org_id': org_id, 'date': '2030-05-02'
+        }), (200, {'2030-05-02': {'enqueued': False}}))
+        self.assertEqual(post('/passes/unborrow', {
+            'org_id': org_id, 'start_date': '2030-05-02',
+            'end_date': '2030-05-04'
+        }), (200, {'2030-05-02': {'dequeued': True},
+                   '2030-05-03': {'dequeued': True},
+                   '2030-05-04': {'dequeued': False}}))
+
+        lend = '/passes/{}/lend'.format(pass_id)
+        self.assertEqual(post(lend, days)[1]['2030-05-03'],
+                         {'enqueued': True})
+        self.assertEqual(post('/passes/{}/unlend'.format(pass_id),
+                              days)[1]['2030-05-01'], {'dequeued': True})
+
+        # Ranges are capped, and have to go forward.
+        max_days = self.app.config['MAX_QUEUE_DATE_RANGE']
+        too_long = {'start_date': '2030-05-01', 'end_date': date_to_str(
+            datetime(2030, 5, 1) + timedelta(days=max_days)
+        )}
+        backwards = {'start_date': '2030-05-02', 'end_date': '2030-05-01'}
+        for js in [too_long, backwards, {'start_date': '2030-05-01'},
+                   {'date': 'tomorrow'}, {'date': 20300501}]:
+            self.assertEqual(post('/passes/borrow',
+                                  dict(js, org_id=org_id))[0], 422)
+            self.assertEqual(post(lend, js)[0], 422)
+
+    def test_borrow_position(self):
+        org_id = self.data.Org.locust_valley.id
+        live_org = view_util.get_live_org(org_id)
+        day = datetime(2030, 5, 1)
+        live_org.enqueue_user_borrow(day, self.data.User.mod.id)
+        live_org.enqueue_user_borrow(day, self.data.User.user.id)
+
+        res = self.client.get(
+            API_PREFIX + '/passes/borrow/position?org_id={}&start_date='
+            '2030-05-01&end_date=2030-05-02'.format(org_id),
+            headers=auth_headers(self.auth(test_data.User.user))
+        )
+        self.assert200(res)
+        self.assertEqual(res.json, {
+            '2030-05-01': {'position': 2, 'depth': 2},
+            '2030-05-02': {'position': None, 'depth': 0}
+        })
+
+        for args in ['', '&date=someday', '&start_date=2030-05-01'
+                     '&end_date=2030-13-01']:
+            self.assertStatus(self.client.get(
+                API_PREFIX + '/passes/borrow/position?org_id={}{}'.format(
+                    org_id, args
+                ), headers=auth_headers(self.auth(test_data.User.user))
+            ), 422)
+
+    def test_leaving_drops_queues(self):
+        org_id = self.data.Org.locust_valley.id
+        user_id = self.data.User.user.id
+        pass_ = models.Pass(org_id=org_id, owner_id=user_id)
+        models.db.session.add(pass_)
+        models.db.session.commit()
+        pass_id = pass_.id
+
+        live_org = view_util.get_live_org(org_id)
+        day = datetime.combine(live_org.date_util.today().date(),
+                               datetime.min.time()) + timedelta(days=1)
+        live_org.enqueue_user_borrow(day, user_id)
+        live_org.enqueue_pass_lend(day, pass_id)
+        token = self.auth(test_data.User.user)
+
+        # Giving up a pass stops it from being lent.
+        self.assertStatus(self.client.delete(
+            API_PREFIX + '/passes/{}'.format(pass_id),
+            headers=auth_headers(token)
+        ), 204)
+        self.assertEqual(live_org.drop_pass_lends(pass_id), [])
+
+        # So does leaving the org for borrowing.
+        self.assertStatus(self.client.delete(
+            API_PREFIX + '/orgs/{}/participants/{}'.format(org_id, user_id),
+            headers=auth_headers(token)
+        ), 204)
+        self.assertEqual(live_org.user_borrow_positions([day], user_id),
+                         {day: (None, 0)})
+
+        # The fixture removes them from the org on its own.
+        models.Org.query.get(org_id).participants.append(
+            models.User.query.get(user_id)
+        )
+        models.db.session.commit()
+
     def test_org_public_interface(self):
         # TODO: Test access to orgs without authentication tokens
         pass
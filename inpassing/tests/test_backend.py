@@ -0,0 +1,118 @@
+import unittest
+
+from redis.exceptions import ResponseError, WatchError
+
+from ..worker import MemoryRedis
+
+
+class TestMemoryRedis(unittest.TestCase):
+    def setUp(self):
+        self.r = MemoryRedis()
+
+    def test_replies_are_bytes(self):
+        self.r.set('a', 5)
+        self.assertEqual(self.r.get('a'), b'5')
+        self.assertEqual(self.r.incr('a'), 6)
+
+        self.r.hset('h', 1, 'one')
+        self.assertEqual(self.r.hgetall('h'), {b'1': b'one'})
+        self.assertEqual(self.r.hvals('h'), [b'one'])
+        self.assertIsNone(self.r.hget('h', 2))
+
+        self.r.sadd('s', 20170501)
+        self.assertEqual(self.r.smembers('s'), {b'20170501'})
+
+    def test_wrong_type(self):
+        self.r.sadd('s', 1)
+        self.assertRaises(ResponseError, self.r.hget, 's', 1)
+
+    def test_empty_keys_are_removed(self):
+        self.r.zadd('z', 1, 'a')
+        self.r.zrem('z', 'a')
+        self.r.sadd('s', 1)
+        self.r.srem('s', 1)
+        self.assertEqual(self.r.keys(), [])
+        self.assertEqual(self.r.type('z'), b'none')
+
+    def test_sorted_set(self):
+        self.r.zadd('z', 3, 'c', 1, 'a', 2, 'b', 2, 'bb')
+        self.assertEqual(self.r.zrange('z', 0, -1), [b'a', b'b', b'bb', b'c'])
+        self.assertEqual(self.r.zrank('z', 'bb'), 2)
+        self.assertEqual(self.r.zrevrank('z', 'bb'), 1)
+        self.assertEqual(self.r.zscore('z', 'c'), 3.0)
+
+        # Moving a member keeps the order.
+        self.r.zadd('z', 0, 'c')
+        self.assertEqual(self.r.zrange('z', 0, 0, withscores=True),
+                         [(b'c', 0.0)])
+
+        self.assertEqual(self.r.zrangebyscore('z', '(1', '+inf'),
+                         [b'b', b'bb'])
+        self.assertEqual(self.r.zrangebyscore('z', '-inf', 2, 1, 2),
+                         [b'a', b'b'])
+        self.assertEqual(self.r.zrevrangebyscore('z', '(2', '-inf', 0, 1),
+                         [b'a'])
+        self.assertEqual(self.r.zremrangebyscore('z', '-inf', '(2'), 2)
+        self.assertEqual(self.r.zrange('z', 0, -1), [b'b', b'bb'])
+
+    def test_lists(self):
+        self.r.lpush('l', 'a', 'b', 'a')
+        self.assertEqual(self.r.lrange('l', 0, -1), [b'a', b'b', b'a'])
+        self.assertEqual(self.r.lindex('l', -1), b'a')
+        self.assertEqual(self.r.lrem('l', -1, 'a'), 1)
+        self.assertEqual(self.r.lrange('l', 0, -1), [b'a', b'b'])
+
+    def test_pipeline(self):
+        pipe = self.r.pipeline()
+        pipe.sadd('s', 1, 2)
+        pipe.smembers('s')
+        self.assertEqual(pipe.execute(), [2, {b'1', b'2'}])
+
+    def test_watched_key_changed(self):
+        pipe = self.r.pipeline()
+        pipe.watch('a')
+
+        # Commands run right away until multi.
+        self.assertIsNone(pipe.get('a'))
+        self.r.set('a', 1)
+
+        pipe.multi()
+        pipe.set('a', 2)
+        self.assertRaises(WatchError, pipe.execute)
+        self.assertEqual(self.r.get('a'), b'1')
+
+    def test_deleted_keys_are_forgotten(self):
+        self.r.set('a', 1)
+        self.r.sadd('s', 1)
+        self.r.srem('s', 1)
+        self.r.delete('a')
+        self.assertEqual(self.r.versions, {})
+
+        # Watchers still see the key go away, or come and go.
+        for make in [lambda: self.r.set('a', 1), lambda: None]:
+            make()
+            pipe = self.r.pipeline()
+            pipe.watch('a')
+            self.r.set('a', 2)
+            self.r.delete('a')
+            pipe.multi()
+            pipe.set('a', 3)
+            self.assertRaises(WatchError, pipe.execute)
+
+    def test_transaction_retries(self):
+        calls = []
+
+        def increment(pipe):
+            value = int(pipe.get('a') or 0)
+            if not calls:
+                # Someone else gets in first.
+                self.r.set('a', 10)
+            calls.append(value)
+            pipe.multi()
+            pipe.set('a', value + 1)
+            return value + 1
+
+        self.assertEqual(self.r.transaction(increment, 'a',
+                                            value_from_callable=True), 11)
+        self.assertEqual(calls, [0, 10])
+        self.assertEqual(self.r.get('a'), b'11')
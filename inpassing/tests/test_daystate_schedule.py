@@ -2,8 +2,9 @@
 # All rights reserved.
 
 import unittest
-from datetime import timedelta, datetime
-from ..worker.daystate import current_state, num_periods
+from datetime import timedelta, datetime, date
+from ..worker.daystate import current_state, num_periods, weekday_counts, \
+    count_increments, increment_mask, project_states
 
 
 class TestDaystateSchedule(unittest.TestCase):
@@ -56,3 +57,72 @@ class TestDaystateSchedule(unittest.TestCase):
         self.assertAlmostEqual(num_periods(
             timedelta(seconds=3600), now, now + timedelta(days=1)
         ), 24.0)
+
+    def test_weekday_counts(self):
+        self.assertEqual(weekday_counts(0, 0), [0] * 7)
+        self.assertEqual(weekday_counts(0, 7), [1] * 7)
+        self.assertEqual(weekday_counts(5, 3), [1, 0, 0, 0, 0, 1, 1])
+        self.assertEqual(weekday_counts(6, 16), [3, 2, 2, 2, 2, 2, 3])
+
+    def test_count_increments(self):
+        weekdays_only = [True] * 5 + [False] * 2
+
+        # 2017-03-06 is a monday.
+        monday = date(2017, 3, 6)
+        self.assertEqual(count_increments(
+            monday, monday, weekdays_only
+        ), 0)
+        self.assertEqual(count_increments(
+            monday, monday + timedelta(days=7), weekdays_only
+        ), 5)
+        self.assertEqual(count_increments(
+            monday + timedelta(days=7), monday, weekdays_only
+        ), -5)
+
+        # Take the wednesday off and add the saturday.
+        overrides = {date(2017, 3, 8): False, date(2017, 3, 11): True,
+                     date(2017, 3, 20): False}
+        self.assertEqual(count_increments(
+            monday, monday + timedelta(days=7), weekdays_only, overrides
+        ), 5)
+        self.assertEqual(count_increments(
+            monday, monday + timedelta(days=4), weekdays_only, overrides
+        ), 3)
+
+    def test_increment_mask(self):
+        weekdays_only = [True] * 5 + [False] * 2
+
+        # 2017-03-04 is a saturday.
+        saturday = date(2017, 3, 4)
+        self.assertEqual(list(increment_mask(saturday, 0, weekdays_only)), [])
+        self.assertEqual(
+            list(increment_mask(saturday, 9, weekdays_only)),
+            [False, False, True, True, True, True, True, False, False]
+        )
+        self.assertEqual(list(increment_mask(saturday, 4, weekdays_only, {
+            saturday: True,
+            saturday + timedelta(days=2): False,
+            saturday + timedelta(days=30): True
+        })), [True, False, False, True])
+
+    def test_project_states(self):
+        mask = [True, True, False, True, True, True]
+        self.assertEqual(list(project_states(['A', 'B'], 0, [])), [])
+        self.assertEqual(list(project_states(['A', 'B'], 0, mask)),
+                         ['A', 'B', 'B', 'A', 'B', 'A'])
+        self.assertEqual(list(project_states(['A', 'B', 'C'], 2, mask)),
+                         ['C', 'A', 'A', 'B', 'C', 'A'])
+
+        # The same as current_state day by day.
+        for fixed_index in range(3):
+            states = project_states(['A', 'B', 'C'], fixed_index, mask)
+            for i, state in enumerate(states):
+                self.assertEqual(state, current_state(
+                    ['A', 'B', 'C'], fixed_index, sum(mask[1:i + 1])
+                ))
+
+        # Fixes start the sequence over.
+        self.assertEqual(
+            list(project_states(['A', 'B', 'C'], 0, mask, {2: 0, 4: 2})),
+            ['A', 'B', 'A', 'B', 'C', 'A']
+        )
@@ -0,0 +1,849 @@
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import msgpack
+
+from ..worker import LiveOrg, MemoryRedis, date_to_str
+from ..worker import rules
+from ..worker.queue import FixedDaystate, InvalidFixDate, InvalidRuleCursor, \
+    _queue_index
+from ..worker.rules import RuleSet
+
+# The Lua scripts need a real redis server, redislite runs one for us.
+try:
+    import redislite
+except ImportError:
+    redislite = None
+
+Org = namedtuple('Org', 'id timezone')
+
+_redis_server = None
+
+
+def real_redis():
+    """Returns an empty database on a redis server shared by every test."""
+    global _redis_server
+    if _redis_server is None:
+        _redis_server = redislite.StrictRedis()
+    _redis_server.flushdb()
+    return _redis_server
+
+
+class TestLiveOrgQueues(unittest.TestCase):
+    # The memory backend can't run scripts, it uses transactions instead.
+    use_scripts = True
+    runs_scripts = False
+
+    def make_redis(self):
+        return MemoryRedis()
+
+    def setUp(self):
+        self.r = self.make_redis()
+        self.live_org = LiveOrg(self.r, Org(1, 'America/New_York'),
+                                use_scripts=self.use_scripts)
+        self.days = [datetime(2030, 5, 1) + timedelta(days=i)
+                     for i in range(3)]
+
+    def test_uses_scripts(self):
+        self.assertEqual(self.live_org.use_scripts, self.runs_scripts)
+
+    def test_enqueue_days(self):
+        res = self.live_org.enqueue_user_borrow_days(self.days, 5)
+        self.assertEqual(res, {day: True for day in self.days})
+
+        # Enqueueing again leaves the user where they were.
+        self.live_org.enqueue_user_borrow(self.days[0], 6)
+        self.assertFalse(self.live_org.enqueue_user_borrow(self.days[0], 5))
+
+        positions = self.live_org.user_borrow_positions(self.days[:2], 6)
+        self.assertEqual(positions[self.days[0]], (2, 2))
+        self.assertEqual(positions[self.days[1]], (None, 1))
+
+    def test_queue_index(self):
+        index = _queue_index(self.live_org._borrow_queue(self.days[0]))
+        self.live_org.enqueue_user_borrow(self.days[0], 5)
+        self.live_org.enqueue_user_borrow(self.days[0], 6)
+        self.assertEqual(self.r.hgetall(index), {b'5': b'1', b'6': b'1'})
+
+        # The index has the token each object was queued with, and is what
+        # tells us an object is already queued.
+        self.live_org.refresh_user(self.days[0], 5)
+        self.assertEqual(self.r.hget(index, '5'), b'2')
+        self.assertFalse(self.live_org.enqueue_user_borrow(self.days[0], 5))
+        self.assertEqual(self.r.zcard(self.live_org._borrow_queue(
+            self.days[0])), 2)
+
+        self.live_org.dequeue_user_borrow(self.days[0], 6)
+        self.assertEqual(self.r.hgetall(index), {b'5': b'2'})
+
+    def test_refresh_moves_to_the_back(self):
+        self.live_org.enqueue_user_borrow(self.days[0], 5)
+        self.live_org.enqueue_user_borrow(self.days[0], 6)
+        self.live_org.refresh_user(self.days[0], 5)
+
+        positions = self.live_org.user_borrow_positions(self.days[:1], 5)
+        self.assertEqual(positions[self.days[0]], (2, 2))
+        self.assertEqual(self.live_org.live_user(5).token, 2)
+
+        # Objects without a token start at 1, like the script does.
+        self.live_org.refresh_user(self.days[0], 7)
+        self.assertEqual(self.live_org.live_user(7).token, 2)
+
+    def test_reconcile_only_changed_days(self):
+        dirty = self.live_org._active_queue_dirty_set()
+        self.live_org.enqueue_user_borrow_days(self.days, 5)
+        self.assertEqual(self.r.smembers(dirty),
+                         {b'2030-05-01', b'2030-05-02', b'2030-05-03'})
+
+        # Days are claimed, another worker doesn't look at them again.
+        other = LiveOrg(self.r, Org(1, 'America/New_York'),
+                        use_scripts=self.use_scripts)
+        self.assertEqual(self.live_org.reconcile_active_queue(), 0)
+        self.assertEqual(self.r.smembers(dirty), set())
+        self.assertEqual(other.reconcile_active_queue(), 0)
+
+        # Days that aren't marked changed are left alone.
+        schedule = self.live_org._active_queue_schedule()
+        self.r.zrem(schedule, '2030-05-02')
+        self.assertEqual(self.live_org.reconcile_active_queue(), 0)
+        self.r.sadd(dirty, '2030-05-02')
+        self.r.incr(self.live_org._active_queue_change_counter())
+        self.assertEqual(self.live_org.reconcile_active_queue(), 1)
+        self.assertEqual(self.r.zrange(schedule, 0, -1),
+                         [b'2030-05-01', b'2030-05-02', b'2030-05-03'])
+
+    def test_enqueue_retries_after_refresh(self):
+        if self.live_org.use_scripts:
+            self.skipTest('scripts run atomically')
+        self.live_org.enqueue_user_borrow(self.days[0], 6)
+
+        # The user refreshes while they are being enqueued, after the enqueue
+        # read their token.
+        pipeline = self.r.pipeline
+
+        def pipeline_then_refresh(transaction=True, shard_hint=None):
+            pipe = pipeline(transaction, shard_hint)
+            if transaction:
+                return pipe
+            execute = pipe.execute
+
+            def execute_then_refresh():
+                res = execute()
+                self.r.pipeline = pipeline
+                self.live_org.refresh_user(self.days[0], 5)
+                return res
+            pipe.execute = execute_then_refresh
+            return pipe
+
+        self.r.pipeline = pipeline_then_refresh
+        self.live_org.enqueue_user_borrow_days(self.days[:2], 5)
+        self.r.pipeline = pipeline
+
+        # The enqueue went again with the new token, and only took the
+        # tickets it used.
+        for day in self.days[:2]:
+            self.assertEqual(self.r.hget(
+                _queue_index(self.live_org._borrow_queue(day)), '5'
+            ), b'2')
+        self.assertEqual(
+            self.r.get(self.live_org._queue_ticket_counter()), b'3'
+        )
+        positions = self.live_org.user_borrow_positions(self.days[:2], 5)
+        self.assertEqual(positions[self.days[0]], (2, 2))
+
+    def test_queue_order(self):
+        for user_id in [5, 6, 7]:
+            self.live_org.enqueue_user_borrow(self.days[0], user_id)
+
+        def front_to_back():
+            return [int(user_id) for user_id in self.r.zrange(
+                self.live_org._borrow_queue(self.days[0]), 0, -1
+            )]
+
+        self.assertEqual(front_to_back(), [5, 6, 7])
+        self.assertEqual(
+            self.live_org.user_borrow_positions(self.days[:1], 7),
+            {self.days[0]: (3, 3)}
+        )
+
+        # Leaving the queue moves everyone behind up, refreshing goes to the
+        # back.
+        self.live_org.dequeue_user_borrow(self.days[0], 5)
+        self.live_org.refresh_user(self.days[0], 6)
+        self.assertEqual(front_to_back(), [7, 6])
+        self.assertEqual(
+            self.live_org.user_borrow_positions(self.days[:1], 7),
+            {self.days[0]: (1, 2)}
+        )
+
+    def test_dequeue_and_drop(self):
+        self.live_org.enqueue_user_borrow_days(self.days, 5)
+
+        self.assertTrue(self.live_org.dequeue_user_borrow(self.days[1], 5))
+        self.assertFalse(self.live_org.dequeue_user_borrow(self.days[1], 5))
+
+        dropped = self.live_org.drop_user_borrows(5, since=self.days[0])
+        self.assertEqual([day.day for day in dropped], [1, 3])
+
+        positions = self.live_org.user_borrow_positions(self.days, 5)
+        self.assertEqual(set(positions.values()), {(None, 0)})
+
+    def test_dequeue_by_id(self):
+        self.live_org.enqueue_pass_lend_days(self.days, 2)
+        queues = self.live_org._pass_queues_set(2)
+        self.assertEqual(self.r.smembers(queues),
+                         {b'20300501', b'20300502', b'20300503'})
+
+        # The pass is found whatever token it was queued with.
+        self.live_org.refresh_pass(self.days[0], 2)
+        self.assertEqual(self.live_org.dequeue_pass_lend_days(self.days[:2],
+                                                              2),
+                         {self.days[0]: True, self.days[1]: True})
+        self.assertEqual(self.r.smembers(queues), {b'20300503'})
+        self.assertEqual(self.r.zcard(self.live_org._lend_queue(
+            self.days[0])), 0)
+
+        # Only days from since on are dropped.
+        self.live_org.enqueue_pass_lend(self.days[0], 2)
+        dropped = self.live_org.drop_pass_lends(2, since=self.days[1])
+        self.assertEqual([day.day for day in dropped], [3])
+        self.assertEqual(self.r.smembers(queues), {b'20300501'})
+
+    def test_cycle_active_queue(self):
+        self.live_org.enqueue_user_borrow(self.days[2], 5)
+        self.live_org.enqueue_pass_lend(self.days[1], 2)
+        self.live_org.dequeue_pass_lend(self.days[1], 2)
+
+        # Empty days are deactivated on the way to the nearest queued day.
+        self.assertEqual(self.live_org.cycle_active_queue(self.days[0]),
+                         '2030-05-03')
+        self.assertEqual(self.r.smembers(self.live_org._active_queue_set()),
+                         {b'2030-05-03'})
+
+        # Days before today are retired.
+        self.assertIsNone(
+            self.live_org.cycle_active_queue(self.days[2] + timedelta(days=1))
+        )
+
+    def test_cycle_picks_the_nearest_day(self):
+        for day in reversed(self.days):
+            self.live_org.enqueue_pass_lend(day, 2)
+        self.assertEqual(
+            self.r.zrange(self.live_org._active_queue_schedule(), 0, -1,
+                          withscores=True),
+            [(b'2030-05-01', 20300501), (b'2030-05-02', 20300502),
+             (b'2030-05-03', 20300503)]
+        )
+
+        # The nearest day keeps coming back until its queues are empty, no
+        # matter how often it was handed out.
+        for _ in range(2):
+            self.assertEqual(self.live_org.cycle_active_queue(self.days[0]),
+                             '2030-05-01')
+        self.live_org.dequeue_pass_lend(self.days[0], 2)
+        self.assertEqual(self.live_org.cycle_active_queue(self.days[0]),
+                         '2030-05-02')
+
+        # Today is where the schedule starts.
+        self.assertEqual(self.live_org.cycle_active_queue(self.days[2]),
+                         '2030-05-03')
+        self.assertEqual(self.r.zcard(self.live_org._active_queue_schedule()),
+                         1)
+
+    def test_reconcile_active_queue(self):
+        self.live_org.enqueue_user_borrow_days(self.days, 5)
+        self.assertEqual(self.live_org.reconcile_active_queue(), 0)
+
+        # Lose a day from the schedule behind LiveOrg's back.
+        self.r.zrem(self.live_org._active_queue_schedule(), '2030-05-02')
+        self.assertEqual(self.live_org.reconcile_active_queue(full=True), 1)
+        self.assertEqual(self.live_org.cycle_active_queue(self.days[1]),
+                         '2030-05-02')
+
+
+@unittest.skipIf(redislite is None, 'redislite is not installed')
+class TestLiveOrgQueueScripts(TestLiveOrgQueues):
+    runs_scripts = True
+
+    def make_redis(self):
+        return real_redis()
+
+
+@unittest.skipIf(redislite is None, 'redislite is not installed')
+class TestLiveOrgQueueTransactions(TestLiveOrgQueueScripts):
+    use_scripts = False
+    runs_scripts = False
+
+
+@unittest.skipIf(redislite is None, 'redislite is not installed')
+class TestLiveOrgQueueModes(unittest.TestCase):
+    """The scripts and the transactions have to leave the same data behind."""
+
+    def use_queues(self, live_org):
+        days = [datetime(2030, 5, 1) + timedelta(days=i) for i in range(4)]
+        live_org.enqueue_user_borrow_days(days[:3], 5)
+        live_org.enqueue_user_borrow_days(days[1:], 6)
+        live_org.enqueue_user_borrow(days[1], 5)
+        live_org.enqueue_pass_lend_days(days[:2], 2)
+        live_org.refresh_user(days[1], 5)
+        live_org.refresh_pass(days[3], 2)
+        live_org.dequeue_user_borrow_days(days[:2], 6)
+        live_org.drop_pass_lends(2, since=days[1])
+        live_org.cycle_active_queue(days[0])
+        live_org.cycle_active_queue(days[2])
+        live_org.reconcile_active_queue()
+        live_org.reconcile_active_queue(full=True)
+        live_org.push_fixed_daystate(FixedDaystate(days[1], 4))
+        with self.assertRaises(InvalidFixDate):
+            live_org.push_fixed_daystate(FixedDaystate(days[0], 4))
+
+    def dump(self, r, org_id):
+        """Returns every key of an org (without the org id) and its value."""
+        read = {
+            b'string': r.get, b'hash': r.hgetall, b'set': r.smembers,
+            b'list': lambda key: r.lrange(key, 0, -1),
+            b'zset': lambda key: r.zrange(key, 0, -1, withscores=True)
+        }
+        prefix = '{}:'.format(org_id).encode()
+        return {key[len(prefix):]: read[r.type(key)](key)
+                for key in r.keys(prefix + b'*')}
+
+    maxDiff = None
+
+    def test_same_state(self):
+        r = real_redis()
+        states = []
+        for org_id, store, use_scripts in [(1, r, True), (2, r, False),
+                                           (3, MemoryRedis(), False)]:
+            live_org = LiveOrg(store, Org(org_id, 'America/New_York'),
+                               use_scripts=use_scripts)
+            self.assertEqual(live_org.use_scripts, use_scripts)
+            self.use_queues(live_org)
+            states.append(self.dump(store, org_id))
+
+        self.assertIn(b'2030-05-02:borrow', states[0])
+        self.assertEqual(states[1], states[0])
+        self.assertEqual(states[2], states[0])
+
+
+class TestLiveOrgRules(unittest.TestCase):
+    def setUp(self):
+        self.live_org = LiveOrg(MemoryRedis(), Org(1, 'America/New_York'))
+
+    def patterns(self):
+        return [(rs.pattern, rs.incrday)
+                for rs in self.live_org.get_reoccurring_rule_sets()]
+
+    def test_reoccurring_rule_sets(self):
+        self.live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        self.live_org.push_rule_set(RuleSet('sunday', False, 'none'))
+        self.assertEqual(self.patterns(), [('sunday', False), ('*', True)])
+
+        # Setting a pattern again replaces it and makes it match first.
+        self.live_org.put_rule_set(RuleSet('*', False, 'none'))
+        self.assertEqual(self.patterns(), [('*', False), ('sunday', False)])
+
+        sunday = self.live_org.date_util.date_from_string('2017-01-08')
+        self.assertEqual(self.live_org._read_rule_set(sunday).pattern, '*')
+        self.assertEqual(self.live_org.get_rule_set(sunday).pattern, '*')
+
+        self.assertEqual(self.live_org.remove_reoccuring_rule_set('*'), 1)
+        self.assertEqual(self.live_org.remove_reoccuring_rule_set('*'), 0)
+        self.assertEqual(self.patterns(), [('sunday', False)])
+        self.assertEqual(self.live_org.get_rule_set(sunday).pattern, 'sunday')
+
+    def test_put_single_use_rule_set(self):
+        self.live_org.push_rule_set(RuleSet('2017-01-08', False, 'none'))
+        self.live_org.put_rule_set(RuleSet('2017-01-08', True, 'cur'))
+
+        rule_sets = self.live_org.get_single_use_rule_sets()
+        self.assertEqual([(rs.pattern, rs.incrday) for rs in rule_sets],
+                         [('2017-01-08', True)])
+
+    def test_single_use_rule_set_pages(self):
+        for rule in ['none', 'cur', '1', '2', '3']:
+            self.live_org.push_rule_set(RuleSet('2017-01-09', False, rule))
+        self.live_org.push_rule_set(RuleSet('2017-01-10', False, 'none'))
+
+        rules_seen = []
+        cursor = None
+        while True:
+            rule_sets, cursor = self.live_org.get_single_use_rule_set_page(
+                cursor=cursor, limit=2, convert=False
+            )
+            rules_seen.extend(rs.rules[0] for rs in rule_sets)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(rules_seen[:5]), ['1:', '2:', '3:', 'cur',
+                                                  'none'])
+        self.assertEqual(rules_seen[5:], ['none'])
+
+        rule_sets, cursor = self.live_org.get_single_use_rule_set_page(
+            start_date=self.live_org.date_util.date_from_string('2017-01-10')
+        )
+        self.assertEqual([rs.pattern for rs in rule_sets], ['2017-01-10'])
+        self.assertIsNone(cursor)
+
+        for cursor in ['1:-1', 'nope', '1:2:3']:
+            with self.assertRaises(InvalidRuleCursor):
+                self.live_org.get_single_use_rule_set_page(cursor=cursor)
+
+    def test_rule_format(self):
+        self.live_org.push_rule_set(RuleSet('*', True, ['cur', '1:1-20(40)']))
+        self.live_org.push_rule_set(RuleSet('2017-01-09', False,
+                                            rules.parse_rule('none')))
+
+        # Rule sets packed before the format was versioned still read.
+        self.live_org.r.hset(
+            self.live_org._reoccurring_rule_hash(), 'sunday',
+            msgpack.packb([['sunday', False, ['2:3=4']], 0, 0])
+        )
+        self.live_org.r.zadd(
+            self.live_org._single_use_rule_bucket(), 1483851600,
+            msgpack.packb([['2017-01-08', True, ['cur']], 1483851600])
+        )
+
+        rule_sets = self.live_org.get_reoccurring_rule_sets()
+        self.assertIsInstance(rule_sets[0].rules[0], rules.CurStateMapping)
+        self.assertEqual(
+            self.live_org.get_reoccurring_rule_sets(convert=False),
+            [RuleSet('*', True, ['cur', '1:1-20(40)']),
+             RuleSet('sunday', False, ['2:3=4'])]
+        )
+        self.assertEqual(
+            self.live_org.get_single_use_rule_sets(convert=False),
+            [RuleSet('2017-01-08', True, ['cur']),
+             RuleSet('2017-01-09', False, ['none'])]
+        )
+
+        with self.assertRaises(rules.RuleSyntaxError):
+            self.live_org.push_rule_set(RuleSet('monday', True, 'nope'))
+
+
+class TestLiveOrgDaystates(unittest.TestCase):
+    def setUp(self):
+        self.live_org = LiveOrg(MemoryRedis(), Org(1, 'America/New_York'))
+        self.live_org.set_state_sequence([4, 5, 6])
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.live_org.date_util.date_from_string('2017-01-04'), 5
+        ))
+
+        # Alternate on weekdays, skip weekends.
+        self.live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        self.live_org.push_rule_set(RuleSet('sunday', False, 'none'))
+        self.live_org.push_rule_set(RuleSet('saturday', False, 'none'))
+
+    def day(self, day_str):
+        return self.live_org.date_util.date_from_string(day_str)
+
+    def assert_same_as_walker(self, first_day, num_days, step=1):
+        for i in range(0, num_days, step):
+            day = self.day(first_day) + timedelta(days=i)
+            self.assertEqual(self.live_org.get_daystate_id(day),
+                             self.live_org._walk_daystate_id(day),
+                             date_to_str(day))
+
+    def test_weekdays(self):
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-04')),
+                         5)
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-05')),
+                         6)
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-06')),
+                         4)
+        # The weekend doesn't count.
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-09')),
+                         5)
+
+        self.assert_same_as_walker('2017-01-04', 80)
+        self.assert_same_as_walker('2017-01-04', 400, 13)
+
+    def test_overrides(self):
+        # Snow day, and a saturday that counts.
+        self.live_org.push_rule_set(RuleSet('2017-02-09', False, 'none'))
+        self.live_org.push_rule_set(RuleSet('2017-03-11', True, 'cur'))
+        # The first single-use rule of a day wins.
+        self.live_org.push_rule_set(RuleSet('2017-03-11', False, 'none'))
+
+        self.assert_same_as_walker('2017-01-04', 80)
+
+        # Only the overrides of the days asked for are handed out.
+        schedule = self.live_org.get_schedule()
+        self.assertEqual(schedule.incrday_overrides(
+            self.day('2017-03-01').date(), self.day('2017-03-31').date()
+        ), {self.day('2017-03-11').date(): False})
+
+    def test_rule_order(self):
+        # Newer reoccurring rule sets come first, so this takes over mondays
+        # but leaves the weekend alone.
+        self.live_org.push_rule_set(RuleSet('monday', False, 'none'))
+        self.live_org.push_rule_set(RuleSet('*', True, 'cur'))
+        self.live_org.push_rule_set(RuleSet('tuesday', False, 'none'))
+
+        self.assert_same_as_walker('2017-01-04', 60)
+
+    def test_dated_patterns(self):
+        # Older than the break, so the break wins where they overlap.
+        self.live_org.push_rule_set(RuleSet('2017-12-28 to 2018-01-10',
+                                            True, 'cur'))
+        # Winter break, the last friday of every month and the fourth of
+        # July are off, but the first saturday of every month counts.
+        self.live_org.push_rule_set(RuleSet('2017-12-20 to 2018-01-02',
+                                            False, 'none'))
+        self.live_org.push_rule_set(RuleSet('last friday', False, 'none'))
+        self.live_org.push_rule_set(RuleSet('07-04', False, 'none'))
+        self.live_org.push_rule_set(RuleSet('first saturday', True, 'cur'))
+        self.live_org.push_rule_set(RuleSet('2017-12-29', True, 'cur'))
+
+        self.assertFalse(self.live_org.get_rule_set(
+            self.day('2017-07-04')).incrday)
+        self.assertFalse(self.live_org.get_rule_set(
+            self.day('2017-12-28')).incrday)
+        self.assertTrue(self.live_org.get_rule_set(
+            self.day('2017-12-29')).incrday)
+        self.assertTrue(self.live_org.get_rule_set(
+            self.day('2018-01-04')).incrday)
+        self.assertTrue(self.live_org.get_rule_set(
+            self.day('2017-02-04')).incrday)
+        self.assertFalse(self.live_org.get_rule_set(
+            self.day('2017-03-31')).incrday)
+
+        self.assert_same_as_walker('2017-01-04', 40)
+        self.assert_same_as_walker('2017-06-28', 10)
+
+        # Keep the walk to the winter short.
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-12-01'), 4
+        ))
+        self.assert_same_as_walker('2017-12-15', 30)
+        self.assert_same_as_walker('2018-01-04', 400, 37)
+
+    def assert_simulates(self, rule_sets, fixes, first_day, num_days):
+        first_date = self.day(first_day)
+        last_date = first_date + timedelta(days=num_days - 1)
+        before = self.live_org.get_daystate_calendar(first_date, last_date)
+        simulation = self.live_org.simulate_changes(rule_sets, fixes,
+                                                    first_date, last_date)
+
+        # Make the changes for real and see what changed.
+        for rs in rule_sets:
+            self.live_org.put_rule_set(rs)
+        for fix in fixes:
+            self.live_org.push_fixed_daystate(fix)
+        after = self.live_org.get_daystate_calendar(first_date, last_date)
+
+        # Days can also change by their rules alone, which the calendar
+        # doesn't show.
+        offsets = [(b.date - first_date.date()).days
+                   for b, a in simulation.days]
+        self.assertEqual(simulation.days,
+                         [(before[i], after[i]) for i in offsets])
+        self.assertLessEqual(
+            {b.date for b, a in zip(before, after) if b != a},
+            {b.date for b, a in simulation.days}
+        )
+        return simulation
+
+    def test_simulate(self):
+        # A snow day halfway through, everything after it moves.
+        simulation = self.assert_simulates(
+            [RuleSet('2017-06-14', False, ['none'])], [], '2017-01-04', 365
+        )
+        self.assertEqual(simulation.recomputed_from,
+                         self.day('2017-06-14').date())
+        self.assertEqual(simulation.days[0][0].date,
+                         self.day('2017-06-14').date())
+
+        # Counting saturdays changes every week.
+        self.assert_simulates([RuleSet('saturday', True, ['cur'])], [],
+                              '2017-01-10', 60)
+
+        # Same daystates, but a different mapping on mondays.
+        simulation = self.assert_simulates(
+            [RuleSet('monday', True, ['cur', '4:1-5'])], [], '2017-01-10', 30
+        )
+        self.assertEqual(len(simulation.days), 4)
+
+        # Fixes, one before and one inside the range.
+        self.assert_simulates([], [
+            FixedDaystate(self.day('2017-01-06'), 6),
+            FixedDaystate(self.day('2017-02-01'), 5),
+        ], '2017-01-10', 60)
+
+        # Nothing that happens after the range matters.
+        simulation = self.live_org.simulate_changes(
+            [RuleSet('2018-06-14', False, ['none'])], [],
+            self.day('2018-01-01'), self.day('2018-01-31')
+        )
+        self.assertIsNone(simulation.recomputed_from)
+
+        # Before the first fix days are counted backwards from it.
+        self.assert_simulates([RuleSet('2016-12-20', False, ['none'])], [],
+                              '2016-12-01', 30)
+
+    def test_spot_mapping(self):
+        # State 4 passes park 40 spots up on 5 days.
+        self.live_org.push_rule_set(RuleSet('monday', True,
+                                            ['cur', '4:1-20(40)']))
+
+        mapping = self.live_org.get_spot_mapping(self.day('2017-01-09'))
+        self.assertEqual(mapping.adjust_pass(5, 3), 3)
+        self.assertEqual(mapping.adjust_pass(4, 3), 43)
+        self.assertIsNone(mapping.adjust_pass(6, 3))
+        self.assertIs(self.live_org.get_spot_mapping(self.day('2017-01-09')),
+                      mapping)
+
+        mapping = self.live_org.get_spot_mapping(self.day('2017-01-05'))
+        self.assertEqual(mapping.adjust_pass(6, 3), 3)
+        self.assertIsNone(mapping.adjust_pass(4, 3))
+
+        # Nobody parks on the weekend.
+        mapping = self.live_org.get_spot_mapping(self.day('2017-01-08'))
+        self.assertFalse(mapping.adjust_passes([4, 5, 6], [1, 1, 1])[1].any())
+
+        live_org = LiveOrg(MemoryRedis(), Org(2, 'UTC'))
+        self.assertIsNone(live_org.get_spot_mapping(self.day('2017-01-09')))
+
+    def test_before_and_between_fixes(self):
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-02-01'), 4
+        ))
+
+        # The fix from January still holds in January.
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-05')),
+                         6)
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-02-02')),
+                         5)
+
+        # Before the first fix we count backwards.
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-03')),
+                         4)
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2016-12-30')),
+                         5)
+
+    def test_rule_buckets(self):
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-02-01'), 4
+        ))
+        # Wednesdays stop counting in March.
+        self.live_org.push_rule_set(RuleSet('wednesday', False, 'none'),
+                                    self.day('2017-03-01'))
+        self.assertEqual(self.live_org.get_rule_bucket_days(),
+                         [None, '2017-01-04', '2017-02-01', '2017-03-01'])
+
+        def pattern(day_str):
+            return self.live_org.get_rule_set(self.day(day_str)).pattern
+
+        self.assertEqual(pattern('2017-02-22'), '*')
+        self.assertEqual(pattern('2017-03-01'), 'wednesday')
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-03-01')),
+                         self.live_org.get_daystate_id(self.day('2017-02-28')))
+        self.assert_same_as_walker('2017-02-01', 90)
+        # Counted back from the first fix, by the bucket it opened.
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2016-12-20')),
+                         6)
+
+        state_ids, mask = self.live_org.project_daystates(
+            self.day('2016-12-20'), self.day('2017-04-30')
+        )
+        for i in range(0, len(state_ids), 3):
+            day = self.day('2016-12-20') + timedelta(days=i)
+            self.assertEqual(state_ids[i], self.live_org.get_daystate_id(day))
+
+        # Rule sets put without a day change every bucket.
+        self.live_org.push_rule_set(RuleSet('friday', False, 'none'))
+        self.assertEqual(pattern('2016-12-30'), 'friday')
+        self.assertEqual(pattern('2017-03-03'), 'friday')
+
+        # Archived buckets are left out of the schedule, but their rule sets
+        # can still be looked up.
+        self.assertEqual(
+            self.live_org.archive_rule_buckets(self.day('2017-03-15')), 3
+        )
+        self.assertEqual(self.live_org.get_rule_bucket_days(), ['2017-03-01'])
+        self.assertEqual(pattern('2017-03-08'), 'wednesday')
+        self.assertNotIn('wednesday', [
+            rs.pattern for rs in self.live_org.get_reoccurring_rule_sets(
+                date=self.day('2017-02-22')
+            )
+        ])
+
+        self.assertEqual(self.live_org.remove_rule_set(
+            'wednesday', self.day('2017-04-05')
+        ), 1)
+        self.assertEqual(pattern('2017-03-08'), 'wednesday')
+        self.assertEqual(pattern('2017-04-05'), '*')
+        self.assertIn('wednesday', [
+            rs.pattern for rs in self.live_org.get_reoccurring_rule_sets(
+                date=self.day('2017-04-04')
+            )
+        ])
+        self.assertNotIn('wednesday', [
+            rs.pattern for rs in self.live_org.get_reoccurring_rule_sets()
+        ])
+
+    def test_projection(self):
+        self.live_org.push_rule_set(RuleSet('2017-02-09', False, 'none'))
+        self.live_org.push_rule_set(RuleSet('2017-03-11', True, 'cur'))
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-06-01'), 4
+        ))
+
+        state_ids, mask = self.live_org.project_daystates(
+            self.day('2016-12-01'), self.day('2019-12-31')
+        )
+        self.assertEqual(len(state_ids), 1126)
+        for i in range(0, len(state_ids), 7):
+            day = self.day('2016-12-01') + timedelta(days=i)
+            self.assertEqual(state_ids[i], self.live_org.get_daystate_id(day),
+                             date_to_str(day))
+            self.assertEqual(mask[i], self.live_org.get_rule_set(day).incrday)
+
+        # Without a fix there are no daystates to project.
+        live_org = LiveOrg(MemoryRedis(), Org(2, 'UTC'))
+        state_ids, mask = live_org.project_daystates(self.day('2017-01-01'),
+                                                     self.day('2017-01-31'))
+        self.assertIsNone(state_ids)
+        self.assertFalse(mask.any())
+
+
+class TestLiveOrgDaystateCheckpoints(TestLiveOrgDaystates):
+    def setUp(self):
+        super().setUp()
+        # Keep every day we compute, however long ago.
+        self.live_org.checkpoint_window = 100000
+
+    def checkpoints(self):
+        cache = self.live_org._get_schedule_cache()
+        return ['{}:{}'.format(date_to_str(day), cache.checkpoints[day])
+                for day in cache.checkpoint_days]
+
+    def test_schedule_version(self):
+        schedule = self.live_org.get_schedule()
+        self.assertIs(self.live_org.get_schedule(), schedule)
+        self.assertEqual(schedule.sequence, (4, 5, 6))
+        self.assertEqual(schedule.rule_set(self.day('2017-01-08').date())
+                         .pattern, 'sunday')
+
+        # Every change builds a new schedule.
+        self.live_org.push_rule_set(RuleSet('2017-02-01', False, 'none'))
+        self.assertIsNot(self.live_org.get_schedule(), schedule)
+        schedule = self.live_org.get_schedule()
+
+        self.live_org.remove_single_use_rule_set('2017-02-01')
+        self.assertIsNot(self.live_org.get_schedule(), schedule)
+        schedule = self.live_org.get_schedule()
+
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-02-01'), 4
+        ))
+        self.assertIsNot(self.live_org.get_schedule(), schedule)
+        schedule = self.live_org.get_schedule()
+
+        self.live_org.set_state_sequence([5, 4, 6])
+        self.assertIsNot(self.live_org.get_schedule(), schedule)
+
+    def test_resumes_from_checkpoint(self):
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-09')),
+                         5)
+        self.assertEqual(self.checkpoints(), ['2017-01-09:1'])
+        self.assertEqual(self.live_org.daystate_cache_stats(),
+                         {'hits': 0, 'misses': 1})
+
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-10')),
+                         6)
+        self.assertEqual(self.live_org.get_daystate_id(self.day('2017-01-09')),
+                         5)
+        self.assertEqual(self.live_org.daystate_cache_stats(),
+                         {'hits': 2, 'misses': 1})
+
+        # Before the fix there is nothing to resume from.
+        self.live_org.get_daystate_id(self.day('2017-01-02'))
+        self.assertEqual(self.live_org.daystate_cache_stats(),
+                         {'hits': 2, 'misses': 2})
+        self.assertEqual(len(self.checkpoints()), 2)
+
+    def test_rules_invalidate_checkpoints(self):
+        self.assert_same_as_walker('2017-01-04', 60, 3)
+
+        self.live_org.push_rule_set(RuleSet('2017-02-01', False, 'none'))
+        self.assertEqual(self.checkpoints(), [])
+        self.assert_same_as_walker('2017-01-04', 60, 2)
+
+        self.live_org.remove_single_use_rule_set('2017-02-01')
+        self.assert_same_as_walker('2017-01-04', 60)
+
+        self.live_org.push_rule_set(RuleSet('monday', False, 'none'))
+        self.assertEqual(self.checkpoints(), [])
+        self.assert_same_as_walker('2017-01-04', 60)
+
+    def test_sequence_and_fix_invalidate_checkpoints(self):
+        self.assert_same_as_walker('2017-01-04', 60)
+
+        january = [self.live_org.get_daystate_id(self.day('2017-01-20'))]
+
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-02-01'), 4
+        ))
+        self.assertEqual(self.checkpoints(), [])
+        # The walker only knows about the latest fix.
+        self.assert_same_as_walker('2017-02-01', 60)
+        self.assertEqual(
+            [self.live_org.get_daystate_id(self.day('2017-01-20'))], january
+        )
+
+        self.live_org.set_state_sequence([5, 4, 6])
+        self.assertEqual(self.checkpoints(), [])
+        self.assert_same_as_walker('2017-02-01', 60)
+
+    def test_window(self):
+        self.live_org.checkpoint_window = 10
+        today = self.live_org.date_util.today()
+
+        self.live_org.get_daystate_id(today + timedelta(days=20))
+        self.assertEqual(self.checkpoints(), [])
+
+        self.live_org.get_daystate_id(today + timedelta(days=5))
+        self.assertEqual(self.checkpoints(),
+                         [date_to_str(today + timedelta(days=5)) + ':' +
+                          self.checkpoints()[0].split(':')[1]])
+
+        # Checkpoints outside the window are dropped the next time one is
+        # saved.
+        self.live_org.checkpoint_window = 100000
+        self.live_org.get_daystate_id(self.day('2017-01-05'))
+        self.assertEqual(len(self.checkpoints()), 2)
+
+        self.live_org.checkpoint_window = 10
+        self.live_org.get_daystate_id(today)
+        self.assertEqual(len(self.checkpoints()), 2)
+        self.assertNotIn('2017-01-05', self.checkpoints()[0])
+
+    def test_calendar(self):
+        self.live_org.push_rule_set(RuleSet('2017-02-09', False, 'none'))
+        self.live_org.push_fixed_daystate(FixedDaystate(
+            self.day('2017-02-20'), 4
+        ))
+
+        calendar = self.live_org.get_daystate_calendar(self.day('2016-12-20'),
+                                                       self.day('2017-03-20'))
+        self.assertEqual(len(calendar), 91)
+        for day in calendar:
+            self.assertEqual(day.daystate_id, self.live_org.get_daystate_id(
+                self.live_org.date_util.date_from_string(date_to_str(day.date))
+            ), date_to_str(day.date))
+
+        self.assertEqual(calendar[51].pattern, '2017-02-09')
+        self.assertFalse(calendar[51].incrday)
+        self.assertEqual(calendar[53].pattern, 'saturday')
+        self.assertEqual(calendar[55].pattern, '*')
+        self.assertTrue(calendar[55].incrday)
+
+        # The cached calendar is the same, until the rules change.
+        self.assertEqual(calendar, self.live_org.get_daystate_calendar(
+            self.day('2016-12-20'), self.day('2017-03-20')
+        ))
+        self.live_org.remove_single_use_rule_set('2017-02-09')
+        self.assertEqual(self.live_org.get_daystate_calendar(
+            self.day('2017-02-09'), self.day('2017-02-09')
+        )[0].pattern, '*')
@@ -0,0 +1,90 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+import random
+import unittest
+
+from ..worker import rules
+from ..worker.mapping import compile_mappings
+
+
+def composite(rule_strs, current_state_id=None):
+    maps = [rules.parse_rule(rule) for rule in rule_strs]
+    for mapping in maps:
+        if isinstance(mapping, rules.CurStateMapping):
+            mapping.current_state_id = current_state_id
+    return rules.CompositeMapping(maps)
+
+
+class TestMapping(unittest.TestCase):
+    def assert_same_as_composite(self, rule_strs, current_state_id=None,
+                                 state_ids=range(1, 5), spot_nums=range(80)):
+        mapping = composite(rule_strs, current_state_id)
+        compiled = compile_mappings(mapping)
+
+        passes = [(state_id, spot_num) for state_id in state_ids
+                  for spot_num in spot_nums]
+        adjusted, can_park = compiled.adjust_passes(
+            [state_id for state_id, spot_num in passes],
+            [spot_num for state_id, spot_num in passes]
+        )
+        for i, (state_id, spot_num) in enumerate(passes):
+            expected = mapping.adjust_pass(state_id, spot_num)
+            msg = '{} {}:{}'.format(rule_strs, state_id, spot_num)
+            self.assertEqual(compiled.adjust_pass(state_id, spot_num),
+                             expected, msg)
+            self.assertEqual(compiled.includes_pass(state_id, spot_num),
+                             mapping.includes_pass(state_id, spot_num), msg)
+            self.assertEqual(bool(can_park[i]), expected is not None, msg)
+            if expected is not None:
+                self.assertEqual(adjusted[i], expected, msg)
+
+    def test_composite_adjust_pass(self):
+        mapping = composite(['1:1-20(40)', 'cur'], 2)
+        self.assertEqual(mapping.adjust_pass(1, 5), 45)
+        self.assertEqual(mapping.adjust_pass(2, 5), 5)
+        self.assertIsNone(mapping.adjust_pass(1, 25))
+        self.assertIsNone(mapping.adjust_pass(3, 5))
+
+    def test_rules(self):
+        self.assert_same_as_composite(['cur'], 2)
+        self.assert_same_as_composite(['cur'])
+        self.assert_same_as_composite(['none'])
+        self.assert_same_as_composite(['3'])
+        self.assert_same_as_composite(['cur', '1:1-20(40)', '2:1-20(40)'], 3)
+        # Earlier spot maps win where they overlap.
+        self.assert_same_as_composite(['1:10-30(5),1=70,20-40(1),5'])
+        self.assert_same_as_composite(['1:10-30', '1:20-40(2)', 'cur'], 1)
+        # Nothing after 'none' matters.
+        self.assert_same_as_composite(['2:1-5', 'none', '1', 'cur'], 1)
+
+    def test_random_rules(self):
+        rand = random.Random(4)
+        for _ in range(50):
+            rule_strs = []
+            for _ in range(rand.randint(1, 4)):
+                kind = rand.random()
+                if kind < 0.1:
+                    rule_strs.append('cur')
+                elif kind < 0.15:
+                    rule_strs.append('none')
+                elif kind < 0.25:
+                    rule_strs.append(str(rand.randint(1, 4)))
+                else:
+                    spot_maps = []
+                    for _ in range(rand.randint(1, 5)):
+                        start = rand.randint(0, 70)
+                        if rand.random() < 0.3:
+                            spot_maps.append('{}={}'.format(
+                                start, rand.randint(0, 100)))
+                        else:
+                            spot_maps.append('{}-{}({})'.format(
+                                start, start + rand.randint(0, 20),
+                                rand.randint(0, 40)))
+                    rule_strs.append('{}:{}'.format(rand.randint(1, 4),
+                                                    ','.join(spot_maps)))
+            self.assert_same_as_composite(rule_strs, rand.randint(1, 4))
+
+    def test_no_segments(self):
+        adjusted, can_park = compile_mappings([]).adjust_passes([1, 2], [3, 4])
+        self.assertFalse(can_park.any())
@@ -3,7 +3,7 @@
 
 import unittest
 from datetime import datetime, date
-from ..worker.queue import FixedDaystate
+from ..worker.queue import FixedDaystate, _day_score, _score_day
 
 
 class TestQueue(unittest.TestCase):
@@ -40,3 +40,11 @@ class TestQueue(unittest.TestCase):
         # Change something to make sure inequality works.
         fix.date = date(year=1960, month=1, day=1)
         self.assertNotEqual(fix, parsed_fix)
+
+    def test_day_score(self):
+        self.assertEqual(_day_score('2017-05-01'), 20170501)
+        self.assertEqual(_score_day(20170501), '2017-05-01')
+        self.assertEqual(_score_day(_day_score('0999-12-31')), '0999-12-31')
+
+        # Scores sort the same way as dates.
+        self.assertLess(_day_score('2016-12-31'), _day_score('2017-01-01'))
@@ -0,0 +1,92 @@
+import unittest
+
+from ..worker import EligibilityCache, LiveOrgRegistry
+
+
+class TestLiveOrgRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = LiveOrgRegistry(2)
+        self.made = []
+
+    def make(self, org_id):
+        def make_live_org():
+            self.made.append(org_id)
+            return object()
+        return make_live_org
+
+    def test_reuse(self):
+        first = self.registry.get(1, self.make(1))
+        self.assertIs(self.registry.get(1, self.make(1)), first)
+        self.assertEqual(self.made, [1])
+        self.assertEqual((self.registry.hits, self.registry.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        self.registry.get(1, self.make(1))
+        self.registry.get(2, self.make(2))
+
+        # Org 1 is now used more recently than org 2.
+        self.registry.get(1, self.make(1))
+        self.registry.get(3, self.make(3))
+        self.assertEqual(len(self.registry), 2)
+
+        self.registry.get(1, self.make(1))
+        self.registry.get(2, self.make(2))
+        self.assertEqual(self.made, [1, 2, 3, 2])
+
+    def test_invalidate(self):
+        first = self.registry.get(1, self.make(1))
+        self.registry.invalidate(1)
+        self.assertIsNot(self.registry.get(1, self.make(1)), first)
+        self.assertEqual(self.made, [1, 1])
+
+    def test_version(self):
+        first = self.registry.get(1, self.make(1), b'1')
+        self.assertIs(self.registry.get(1, self.make(1), b'1'), first)
+        self.assertIsNot(self.registry.get(1, self.make(1), b'2'), first)
+        self.assertEqual(self.made, [1, 1])
+
+    def test_invalidate_while_building(self):
+        def make_live_org():
+            # The org changes while we look it up.
+            self.registry.invalidate(1)
+            return object()
+
+        stale = self.registry.get(1, make_live_org)
+        self.assertIsNot(self.registry.get(1, self.make(1)), stale)
+
+
+class TestEligibilityCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = EligibilityCache(2)
+        self.computed = []
+
+    def compute(self, org_id, day):
+        def compute():
+            self.computed.append((org_id, day))
+            return object()
+        return compute
+
+    def test_version(self):
+        first = self.cache.get(1, 'monday', b'1', self.compute(1, 'monday'))
+        self.assertIs(self.cache.get(1, 'monday', b'1',
+                                     self.compute(1, 'monday')), first)
+
+        # The schedule changed.
+        self.assertIsNot(self.cache.get(1, 'monday', b'2',
+                                        self.compute(1, 'monday')), first)
+        self.assertEqual(self.computed, [(1, 'monday'), (1, 'monday')])
+
+    def test_invalidate(self):
+        self.cache.get(1, 'monday', b'1', self.compute(1, 'monday'))
+        self.cache.get(2, 'monday', b'1', self.compute(2, 'monday'))
+        self.cache.invalidate(1)
+        self.assertEqual(len(self.cache), 1)
+
+        def compute():
+            # A pass changes while we look them up.
+            self.cache.invalidate(1)
+            return object()
+
+        stale = self.cache.get(1, 'tuesday', b'1', compute)
+        self.assertIsNot(self.cache.get(1, 'tuesday', b'1',
+                                        self.compute(1, 'tuesday')), stale)
@@ -1,10 +1,22 @@
 # Copyright (c) 2017 Luke San Antonio Bialecki
 # All rights reserved.
 
-from ..worker import rules
+from ..worker import patterns, rule_grammar, rules
+import random
 import unittest
 from datetime import date
 
+import pyparsing as pp
+
+
+def describe_mapping(mapping):
+    if isinstance(mapping, rules.CustomMapping):
+        return mapping.state_id, [
+            (spot_map.start, spot_map.end, spot_map.value,
+             spot_map.adjust_type) for spot_map in mapping.spot_mappings
+        ]
+    return type(mapping)
+
 
 class TestRules(unittest.TestCase):
     def testPatternMatching(self):
@@ -52,3 +64,136 @@ class TestRules(unittest.TestCase):
         self.assertFalse(rules.pattern_reoccurs('2017-1-10'))
         self.assertFalse(rules.pattern_reoccurs('2011-12-1'))
         self.assertFalse(rules.pattern_reoccurs('hello, sailor'))
+
+    def testDatedPatterns(self):
+        # The same day every year
+        self.assertTrue(rules.pattern_matches_date('07-04', date(2017, 7, 4)))
+        self.assertTrue(rules.pattern_matches_date('7-4', date(2020, 7, 4)))
+        self.assertFalse(rules.pattern_matches_date('07-04', date(2017, 7, 5)))
+        self.assertTrue(rules.pattern_matches_date('02-29', date(2020, 2, 29)))
+
+        # One weekday of every month
+        self.assertTrue(rules.pattern_matches_date(
+            'first monday', date(2017, 5, 1))
+        )
+        self.assertTrue(rules.pattern_matches_date(
+            'fourth thursday', date(2017, 11, 23))
+        )
+        self.assertFalse(rules.pattern_matches_date(
+            'first monday', date(2017, 5, 8))
+        )
+        self.assertTrue(rules.pattern_matches_date(
+            'last monday', date(2017, 5, 29))
+        )
+        self.assertFalse(rules.pattern_matches_date(
+            'last monday', date(2017, 5, 22))
+        )
+        self.assertFalse(rules.pattern_matches_date(
+            'fifth monday', date(2017, 6, 26))
+        )
+
+        # Ranges include both ends
+        self.assertTrue(rules.pattern_matches_date(
+            '2017-12-20 to 2018-01-02', date(2017, 12, 20))
+        )
+        self.assertTrue(rules.pattern_matches_date(
+            '2017-12-20 to 2018-01-02', date(2018, 1, 2))
+        )
+        self.assertFalse(rules.pattern_matches_date(
+            '2017-12-20 to 2018-01-02', date(2018, 1, 3))
+        )
+
+        self.assertTrue(rules.pattern_reoccurs('07-04'))
+        self.assertTrue(rules.pattern_reoccurs('last friday'))
+        self.assertTrue(rules.pattern_reoccurs('2017-12-20 to 2018-01-02'))
+
+    def testInvalidPatterns(self):
+        self.assertIsNone(patterns.compile_pattern('hello, sailor'))
+        self.assertIsNone(patterns.compile_pattern('02-30'))
+        self.assertIsNone(patterns.compile_pattern('2017-02-29'))
+        self.assertIsNone(patterns.compile_pattern('sixth monday'))
+        self.assertIsNone(patterns.compile_pattern('2018-01-02 to 2017-12-20'))
+        self.assertIsNone(patterns.compile_pattern(None))
+        self.assertFalse(rules.pattern_matches_date('hello, sailor',
+                                                    date(2017, 1, 1)))
+
+    def testNthWeekdayInMonth(self):
+        self.assertEqual(patterns.NthWeekdayPattern(1, 0).in_month(2017, 5),
+                         date(2017, 5, 1))
+        self.assertEqual(
+            patterns.NthWeekdayPattern(patterns.LAST, 0).in_month(2017, 5),
+            date(2017, 5, 29)
+        )
+        self.assertIsNone(patterns.NthWeekdayPattern(5, 0).in_month(2017, 6))
+
+    def assertParsesLikeGrammar(self, instring):
+        try:
+            expected = describe_mapping(rule_grammar.parse_rule(instring))
+        except pp.ParseException:
+            with self.assertRaises(rules.RuleSyntaxError, msg=instring):
+                rules.parse_rule(instring)
+        else:
+            self.assertEqual(describe_mapping(rules.parse_rule(instring)),
+                             expected, instring)
+
+    def testParseRule(self):
+        mapping = rules.parse_rule('2:1-20(40),3=7,5(2)')
+        self.assertEqual(mapping.state_id, 2)
+        self.assertEqual(str(mapping), '2:1-20(40),3=7,5(2)')
+        self.assertIsInstance(rules.parse_rule('cur'), rules.CurStateMapping)
+        self.assertIsInstance(rules.parse_rule('none'), rules.NoneMapping)
+        with self.assertRaises(rules.RuleSyntaxError):
+            rules.parse_rule('nope')
+
+        # Parses are cached, mappings aren't.
+        self.assertIsNot(rules.parse_rule('cur'), rules.parse_rule('cur'))
+
+        for instring in ['1', ' 1 : 2 - 3 ( 4 ) , 5 = 6', '1:', '1:2,',
+                         '1:2-3=4', '1:2(3', '1-2', 'curry', 'none:1', '',
+                         '  ', '1:2-(3)', '007:08', '1:2=', '1::2']:
+            self.assertParsesLikeGrammar(instring)
+
+    def testParseRuleLikeGrammar(self):
+        tokens = ['cur', 'none', '1', '23', '0', ':', ':', ',', ',', '-',
+                  '(', ')', '=', ' ', '\t', 'x', 'no', 'c']
+        rand = random.Random(7)
+        for _ in range(2000):
+            instring = ''.join(rand.choice(tokens)
+                               for _ in range(rand.randint(0, 10)))
+            self.assertParsesLikeGrammar(instring)
+
+    def testSpotMapFromString(self):
+        for instring in ['1', '1-20(40)', '3=7', '5(2)', '4-', '6 - 8']:
+            spot_map = rules.SpotMap.fromstring(instring)
+            expected = rules.SpotMap.fromdict(
+                rule_grammar.spot_map.parseString(instring).asDict()
+            )
+            self.assertEqual(str(spot_map), str(expected))
+
+    def testPackRule(self):
+        for instring in ['cur', 'none', '3', '0:4', '2:1-20(40),3=7,5(2)']:
+            packed = rules.pack_rule(instring)
+            self.assertTrue(all(isinstance(i, int) for i in packed))
+            self.assertEqual(str(rules.unpack_rule(packed)),
+                             str(rules.parse_rule(instring)))
+            self.assertEqual(rules.pack_rule(rules.parse_rule(instring)),
+                             packed)
+
+        with self.assertRaises(rules.RuleSyntaxError):
+            rules.pack_rule('nope')
+        with self.assertRaises(ValueError):
+            rules.unpack_rule([-3])
+        with self.assertRaises(ValueError):
+            rules.unpack_rule([1, 2, 3])
+
+    def testRuleSetFromDict(self):
+        rs = rules.ruleset_from_dict({'pattern': 'monday', 'incrday': True,
+                                      'rules': ['cur', '1:1-20(40)']})
+        self.assertEqual(rules.dict_from_ruleset(rs)['rules'],
+                         ['cur', '1:1-20(40)'])
+
+        # A single rule doesn't have to be in a list.
+        rs = rules.ruleset_from_dict({'pattern': 'monday', 'incrday': True,
+                                      'rules': '2:3=7'})
+        self.assertEqual(rules.dict_from_ruleset(rs)['rules'],
+                         [str(rules.parse_rule('2:3=7'))])
@@ -31,3 +31,10 @@ class TestRangeInclusiveDates(unittest.TestCase):
         it = util.range_inclusive_dates(day, day)
         self.assertEqual(next(it), day)
         self.assertRaises(StopIteration, next, it)
+
+
+class TestPasswords(unittest.TestCase):
+    def test_check_password(self):
+        hashed = util.hash_password('hunter2', rounds=4)
+        self.assertTrue(util.check_password('hunter2', hashed))
+        self.assertFalse(util.check_password('hunter3', hashed))
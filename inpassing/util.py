@@ -116,3 +116,21 @@ def get_redis():
         return current_app.extensions['redis']
     else:
         return None
+
+
+def get_live_org_store():
+    """Returns the redis (or redis-like) store picked by LIVE_ORG_BACKEND."""
+    return current_app.extensions['live_org_store']
+
+
+# bcrypt is imported by these two on first use, only logging in and signing up
+# need it.
+
+def hash_password(password, rounds=12):
+    import bcrypt
+    return bcrypt.hashpw(password.encode('ascii'), bcrypt.gensalt(rounds))
+
+
+def check_password(password, hashed):
+    import bcrypt
+    return bcrypt.checkpw(password.encode('ascii'), hashed)
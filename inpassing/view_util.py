@@ -1,9 +1,19 @@
 # Copyright (c) 2016 Luke San Antonio Bialecki
 # All rights reserved.
 
+from datetime import timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
 from . import exceptions as ex
 from . import models
-from .models import db, User, Org, Daystate
+from .models import db, User, Org, Daystate, Pass
+from .util import get_live_org_store
+from .worker import (LiveOrg, date_to_str, org_version_key,
+                     passes_version_key)
+from .worker.mapping import compile_mappings
 
 
 def user_is_participant(user_id, org_id):
@@ -36,6 +46,248 @@ def get_org_by_id(org_id):
     return org
 
 
+def get_live_org(org_id):
+    # Ids also come in as strings from query arguments and json, the registry
+    # is keyed by the same integer ids it is invalidated with.
+    try:
+        org_id = int(org_id)
+    except (TypeError, ValueError):
+        raise ex.OrgNotFound(org_id)
+
+    def make_live_org():
+        return LiveOrg(get_live_org_store(), get_org_by_id(org_id),
+                       use_scripts=current_app.config['LIVE_ORG_USE_SCRIPTS'],
+                       checkpoint_window=current_app.config[
+                           'DAYSTATE_CHECKPOINT_WINDOW'
+                       ])
+
+    # The org may have been changed by another process since its LiveOrg was
+    # built.
+    version = get_live_org_store().get(org_version_key(org_id))
+    return current_app.extensions['live_orgs'].get(org_id, make_live_org,
+                                                   version)
+
+
+# Changes to orgs and passes are only announced once they are committed, a
+# LiveOrg (or eligibility) computed from the old rows in between would be kept
+# otherwise. The ids of the orgs are kept in the session until then.
+
+def _changed_orgs(obj, name):
+    return inspect(obj).session.info.setdefault(name, set())
+
+
+@event.listens_for(Org, 'after_update')
+def _org_updated(mapper, connection, org):
+    # The LiveOrg of an org caches its timezone.
+    if inspect(org).attrs.timezone.history.has_changes():
+        _changed_orgs(org, 'changed_orgs').add(org.id)
+
+
+@event.listens_for(Org, 'after_delete')
+def _org_deleted(mapper, connection, org):
+    _changed_orgs(org, 'changed_orgs').add(org.id)
+
+
+@event.listens_for(Pass, 'after_insert')
+@event.listens_for(Pass, 'after_update')
+@event.listens_for(Pass, 'after_delete')
+def _pass_changed(mapper, connection, pass_):
+    # Passes that move between orgs change who may park in both.
+    _changed_orgs(pass_, 'changed_passes').update(
+        inspect(pass_).attrs.org_id.history.sum()
+    )
+
+
+@event.listens_for(Session, 'after_commit')
+def _announce_changes(session):
+    org_ids = session.info.pop('changed_orgs', ())
+    pass_org_ids = session.info.pop('changed_passes', ())
+    if not (org_ids or pass_org_ids) or not has_app_context():
+        return
+
+    pipe = get_live_org_store().pipeline(transaction=False)
+    for org_id in org_ids:
+        pipe.incr(org_version_key(org_id))
+        current_app.extensions['live_orgs'].invalidate(org_id)
+    for org_id in pass_org_ids:
+        pipe.incr(passes_version_key(org_id))
+        current_app.extensions['eligibility'].invalidate(org_id)
+    pipe.execute()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('changed_orgs', None)
+    session.info.pop('changed_passes', None)
+
+
+def daystate_summary(org_id, start_date, end_date):
+    """Counts the days of each daystate from start_date to end_date, in total
+    and for every week (starting on Monday), along with how many passes can be
+    used each week.
+
+    Only days that move the daystate sequence forward (school days) count.
+    """
+    import numpy as np
+
+    schedule = get_live_org(org_id).get_schedule()
+    first_day, last_day = start_date.date(), end_date.date()
+    state_ids, school_days = schedule.project(first_day, last_day)
+
+    offsets = np.arange(len(school_days))
+    weeks = (offsets + first_day.weekday()) // 7
+    num_weeks = int(weeks[-1]) + 1 if len(weeks) > 0 else 0
+    first_monday = first_day - timedelta(days=first_day.weekday())
+
+    # How many passes are assigned to each daystate.
+    assigned = dict(db.session.query(
+        Pass.assigned_state_id, func.count(Pass.id)
+    ).filter_by(org_id=org_id).group_by(Pass.assigned_state_id).all())
+
+    totals = {}
+    week_days = {}
+    usable = np.zeros(num_weeks, dtype=np.int64)
+    if state_ids is not None:
+        for state_id in sorted(set(schedule.sequence)):
+            days = school_days & (state_ids == state_id)
+            per_week = np.bincount(weeks[days], minlength=num_weeks)
+
+            totals[state_id] = int(days.sum())
+            week_days[state_id] = per_week
+            usable += per_week * assigned.get(state_id, 0)
+
+    return {
+        'start': date_to_str(first_day),
+        'end': date_to_str(last_day),
+        'school_days': int(school_days.sum()),
+        'daystates': totals,
+        'weeks': [{
+            'start': date_to_str(first_monday + timedelta(weeks=week)),
+            'daystates': {state_id: int(counts[week])
+                          for state_id, counts in week_days.items()},
+            'usable_passes': int(usable[week])
+        } for week in range(num_weeks)]
+    }
+
+
+def eligibility(org_id, date):
+    """Returns (daystate id, passes) for a day, passes is a list of (pass id,
+    owner id, state id, spot num, adjusted spot num) tuples of every verified
+    pass that can park, and where.
+
+    The daystate and rule set are only looked up once, and only passes of the
+    daystates the rules let park are loaded. Results are cached until the
+    schedule of the org or one of its passes changes.
+    """
+    live_org = get_live_org(org_id)
+    org_id = live_org.org_id
+
+    def compute():
+        mapping = live_org.get_spot_mapping(date)
+        if mapping is None or len(mapping.state_ids) == 0:
+            return live_org.get_daystate_id(date), []
+
+        rows = db.session.query(
+            Pass.id, Pass.owner_id, Pass.assigned_state_id,
+            Pass.assigned_spot_num
+        ).filter(
+            Pass.org_id == org_id,
+            Pass.assigned_state_id.in_(mapping.state_ids),
+            Pass.assigned_spot_num.isnot(None),
+            Pass.assigned_time.isnot(None)
+        ).order_by(Pass.id).all()
+
+        adjusted, can_park = mapping.adjust_passes(
+            [row[2] for row in rows], [row[3] for row in rows]
+        )
+        return live_org.get_daystate_id(date), [
+            tuple(row) + (spot_num,)
+            for row, spot_num, ok in zip(rows, adjusted.tolist(), can_park)
+            if ok
+        ]
+
+    # Passes may have been changed by another process, the version is read
+    # before they are.
+    version = (live_org.get_schedule().version,
+               get_live_org_store().get(passes_version_key(org_id)))
+    return current_app.extensions['eligibility'].get(
+        org_id, date.date(), version, compute
+    )
+
+
+def simulate_rules(org_id, rule_sets, fixes, start_date, end_date):
+    """Returns the days from start_date to end_date whose daystate or rule set
+    would change with the given rule sets and fixes, along with the passes
+    that would park somewhere else (or not at all) on each of them.
+    """
+    import numpy as np
+
+    live_org = get_live_org(org_id)
+    simulation = live_org.simulate_changes(rule_sets, fixes, start_date,
+                                           end_date)
+
+    passes = []
+    if len(simulation.days) > 0:
+        passes = db.session.query(
+            Pass.id, Pass.owner_id, Pass.assigned_state_id,
+            Pass.assigned_spot_num
+        ).filter(
+            Pass.org_id == live_org.org_id,
+            Pass.assigned_state_id.isnot(None),
+            Pass.assigned_spot_num.isnot(None),
+            Pass.assigned_time.isnot(None)
+        ).order_by(Pass.id).all()
+    state_ids = np.array([p[2] for p in passes], dtype=np.int64)
+    spot_nums = np.array([p[3] for p in passes], dtype=np.int64)
+
+    # Most days share a few rule sets and daystates.
+    mappings = {}
+
+    def spots(schedule, day):
+        """Returns where every pass parks on a day, -1 if it can't."""
+        rule_set = schedule.rule_set(day.date)
+        if rule_set is None:
+            return np.full(len(passes), -1, dtype=np.int64)
+
+        key = (id(rule_set), day.daystate_id)
+        if key not in mappings:
+            mapping = compile_mappings(rule_set.rules, day.daystate_id)
+            adjusted, can_park = mapping.adjust_passes(state_ids, spot_nums)
+            mappings[key] = np.where(can_park, adjusted, -1)
+        return mappings[key]
+
+    def day_dict(day):
+        return {
+            'daystate_id': day.daystate_id,
+            'pattern': day.pattern,
+            'incrday': day.incrday
+        }
+
+    days = []
+    for before, after in simulation.days:
+        before_spots = spots(simulation.before, before)
+        after_spots = spots(simulation.after, after)
+        affected = np.nonzero(before_spots != after_spots)[0]
+        days.append({
+            'date': date_to_str(before.date),
+            'before': day_dict(before),
+            'after': day_dict(after),
+            'affected_passes': [{
+                'pass_id': passes[i][0],
+                'owner_id': passes[i][1],
+                'before': None if before_spots[i] < 0
+                else int(before_spots[i]),
+                'after': None if after_spots[i] < 0 else int(after_spots[i])
+            } for i in affected.tolist()]
+        })
+
+    return {
+        'start': date_to_str(start_date),
+        'end': date_to_str(end_date),
+        'days': days
+    }
+
+
 def get_user_by_id(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
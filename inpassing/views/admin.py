@@ -1,7 +1,6 @@
 # Copyright (c) 2016 Luke San Antonio Bialecki
 # All rights reserved.
 
-import bcrypt
 from flask import Blueprint, render_template, request, redirect, url_for
 from flask_login import LoginManager, login_user, login_required, \
     logout_user, current_user
@@ -9,7 +8,7 @@ from flask_login import LoginManager, login_user, login_required, \
 from inpassing.view_util import get_org_by_id
 from ..models import db, User
 from ..forms import LoginForm, SignupForm
-from ..util import get_redirect_target
+from ..util import get_redirect_target, hash_password, check_password
 
 admin_www = Blueprint('admin', __name__, template_folder='templates_admin')
 
@@ -57,8 +56,7 @@ def user_login():
     if form.validate_on_submit():
         # Form is validated, try to log in
         user = User.query.filter_by(email=form.email.data).first()
-        in_pass = form.password.data.encode('ascii')
-        if user and bcrypt.checkpw(in_pass, user.password):
+        if user and check_password(form.password.data, user.password):
             # Authenticated!
             login_user(user)
 
@@ -85,8 +83,7 @@ def user_signup():
         new_user = User(first_name=form.first_name.data,
                         last_name=form.last_name.data,
                         email=email)
-        new_user.password = bcrypt.hashpw(form.password.data.encode('ascii'),
-                                          bcrypt.gensalt(12))
+        new_user.password = hash_password(form.password.data)
 
         db.session.add(new_user)
         db.session.commit()
@@ -1,20 +1,28 @@
 # Copyright (c) 2017 Luke San Antonio Bialecki
 # All rights reserved.
 
-from flask import Blueprint, jsonify, request, current_app, url_for
+import json
+from datetime import date, timedelta
+
+from flask import Blueprint, Response, jsonify, request, current_app, url_for
 from flask_jwt_extended import get_jwt_identity, jwt_required
 
 from pytz import all_timezones
 
+from inpassing.worker.patterns import compile_pattern
 from inpassing.worker.rules import dict_from_ruleset, ruleset_from_dict, \
-    pattern_reoccurs
+    pattern_reoccurs, RuleSyntaxError
 from .. import util, exceptions as ex
 from ..models import db, Org, User, Daystate
-from ..util import jwt_optional, get_redis
+from ..util import jwt_optional
 from ..view_util import user_is_mod, user_is_participant, get_field, \
     get_org_by_id, get_user_by_id, daystate_exists, verify_user_is_mod, \
-    verify_user_is_participant_or_mod
-from ..worker import LiveOrg
+    verify_user_is_participant_or_mod, get_live_org, daystate_summary, \
+    eligibility, simulate_rules
+from ..worker import date_to_str, str_to_date
+from ..worker.queue import FixedDaystate, InvalidRuleCursor
+from .passes import get_date_pair, EndDateTooEarlyError, \
+    DateRangeTooLongError
 
 org_api = Blueprint('org', __name__)
 
@@ -131,7 +139,7 @@ def org_participants(org_id):
             raise ex.Forbidden('Regular users cannot make this request')
 
 
-@org_api.route('/<org_id>/participants/<user_id>')
+@org_api.route('/<org_id>/participants/<user_id>', methods=['GET', 'DELETE'])
 @jwt_required
 def org_participants_query(org_id, user_id):
     org = get_org_by_id(org_id)
@@ -144,6 +152,31 @@ def org_participants_query(org_id, user_id):
     else:
         participating = False
 
+    if request.method == 'DELETE':
+        # Users can leave an org on their own, mods can remove anyone.
+        client_user_id = get_jwt_identity()
+        if client_user_id != user.id and not user_is_mod(client_user_id,
+                                                         org_id):
+            raise ex.Forbidden(
+                'user {} cannot remove user {} from org {}'.format(
+                    client_user_id, user.id, org_id
+                )
+            )
+
+        if not participating:
+            return jsonify({
+                'msg': 'user {} does not participate in org {}'.format(
+                    user_id, org_id
+                )
+            }), 404
+
+        org.participants.remove(user)
+        db.session.commit()
+
+        # They can't borrow a pass from an org they aren't a part of.
+        get_live_org(org_id).drop_user_borrows(user.id)
+        return '', 204
+
     user_ret = jsonify(util.user_dict(user)), 200
     no_part_ret = jsonify({
         'msg': 'user {} does not participate in org {}'.format(user_id, org_id)
@@ -292,7 +325,7 @@ def org_daystate_sequence(org_id):
     verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
 
     # Construct a live org
-    live_org = LiveOrg(get_redis(), get_org_by_id(org_id))
+    live_org = get_live_org(org_id)
     if request.method == 'POST':
         # This should be an array of ints / ids
         daystate_seq = get_field(request, 'daystate_sequence')
@@ -355,7 +388,7 @@ def org_daystates_query(org_id, daystate_id):
 def org_daystates_current(org_id):
     verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
 
-    live_org = LiveOrg(get_redis(), get_org_by_id(org_id))
+    live_org = get_live_org(org_id)
 
     # Get the datetime of the start of today ie 00:00:00.
     today = live_org.date_util.today()
@@ -367,53 +400,182 @@ def org_daystates_current(org_id):
     ).first()
     return jsonify(util.daystate_dict(daystate)), 200
 
+
+def get_start_end_dates(max_days):
+    """Returns the dates of the start and end query arguments."""
+    start, end = request.args.get('start'), request.args.get('end')
+    if start is None or end is None:
+        raise ex.InvalidDateRange('must provide start and end')
+
+    try:
+        return get_date_pair(None, start, end, max_days)
+    except (EndDateTooEarlyError, DateRangeTooLongError) as e:
+        raise ex.InvalidDateRange(str(e))
+
+
+@org_api.route('/<org_id>/daystates/calendar')
+@jwt_required
+def org_daystates_calendar(org_id):
+    verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
+
+    start_date, end_date = get_start_end_dates(
+        current_app.config['MAX_CALENDAR_DATE_RANGE']
+    )
+    calendar = get_live_org(org_id).get_daystate_calendar(start_date, end_date)
+    return jsonify({
+        date_to_str(day.date): {
+            'daystate_id': day.daystate_id,
+            'pattern': day.pattern,
+            'incrday': day.incrday
+        } for day in calendar
+    }), 200
+
+
+@org_api.route('/<org_id>/daystates/summary')
+@jwt_required
+def org_daystates_summary(org_id):
+    verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
+
+    start_date, end_date = get_start_end_dates(
+        current_app.config['MAX_SUMMARY_DATE_RANGE']
+    )
+    return jsonify(daystate_summary(org_id, start_date, end_date)), 200
+
+
+@org_api.route('/<org_id>/eligibility')
+@jwt_required
+def org_eligibility(org_id):
+    verify_user_is_mod(get_jwt_identity(), org_id)
+    live_org = get_live_org(org_id)
+
+    date_str = request.args.get('date')
+    if date_str is None:
+        day = live_org.date_util.today()
+    else:
+        try:
+            day = live_org.date_util.date_from_string(date_str)
+        except ValueError:
+            raise ex.InvalidDate(date_str)
+
+    daystate_id, passes = eligibility(org_id, day)
+
+    # There can be a lot of passes, send them as they are serialized.
+    def generate():
+        yield '{{"date": {}, "daystate_id": {}, "passes": ['.format(
+            json.dumps(date_to_str(day)), json.dumps(daystate_id)
+        )
+        for i, (pass_id, owner_id, state_id, spot_num, parks_in) in \
+                enumerate(passes):
+            yield (',' if i > 0 else '') + json.dumps({
+                'pass_id': pass_id,
+                'owner_id': owner_id,
+                'state_id': state_id,
+                'spot_num': spot_num,
+                'parks_in': parks_in
+            })
+        yield ']}'
+
+    return Response(generate(), mimetype='application/json'), 200
+
+
 @org_api.route('/<org_id>/rules', methods=['GET', 'PUT', 'POST', 'DELETE'])
+@jwt_required
 def org_rules(org_id):
     # When the client uses GET we want to query rules only, when they use
     # POST we only want to add rules, throwing an error if a rule already
     # exists in its place. If the client uses PUT we will allow them to
     # modify an existing rule.
-    live_org = LiveOrg(get_redis(), get_org_by_id(org_id))
+    live_org = get_live_org(org_id)
     if request.method == 'GET':
         # Check permissions
         verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
 
-        # Figure out what rules they want to start with
-        criteria = get_field(request, 'criteria', None)
-        rule_sets = []
+        # The kinds of rule sets can be picked with a JSON body, otherwise
+        # both are given. The rest comes from the query arguments.
+        js = request.get_json(silent=True) or {}
+        criteria = js.get('criteria',
+                          {'single-use': True, 'reoccurring': True})
+        single_use = criteria.get('single-use', False) is True
+        reoccurring = criteria.get('reoccurring', False) is True
+
+        start_date = _get_query_date(live_org, 'start')
+        end_date = _get_query_date(live_org, 'end')
+        if start_date is not None and end_date is not None and \
+                end_date < start_date:
+            raise ex.InvalidDateRange('end is before start')
+
+        max_limit = current_app.config['MAX_RULE_SETS_PER_PAGE']
+        try:
+            limit = int(request.args.get('limit', max_limit))
+        except ValueError:
+            raise ex.InvalidPage('limit must be a number')
+        if not 0 < limit <= max_limit:
+            raise ex.InvalidPage(
+                'limit must be from 1 to {}'.format(max_limit)
+            )
+
+        # A pattern picks the kind of rule set, a single-use pattern is one
+        # more day to narrow the range down to.
+        pattern = request.args.get('pattern',
+                                   js.get('filter', {}).get('pattern'))
+        if pattern is not None:
+            matcher = compile_pattern(pattern)
+            if matcher is None:
+                raise ex.InvalidRulePattern(pattern)
+            if matcher.reoccurs:
+                single_use = False
+            else:
+                reoccurring = False
+                day = live_org.date_util.date_from_string(
+                    date_to_str(date.fromordinal(matcher.ordinal))
+                )
+                if (start_date is not None and day < start_date) or \
+                        (end_date is not None and day > end_date):
+                    single_use = False
+                start_date = end_date = day
 
         # Adding them in this order means they will be given to the client in
-        #  the same order that they are considered for matching any given day.
-        if criteria.get('single-use', False) is True:
-            rule_sets.extend(live_org.get_single_use_rule_sets())
-        if criteria.get('reoccurring', False) is True:
-            rule_sets.extend(live_org.get_reoccurring_rule_sets())
-
-        # Now filter it based on just one thing currently supported.
-        # FIXME: Support filter by timestamp / date. Right now you can
-        # basically only query specific dates and specific reoccurring
-        # patterns if they exist.
-        in_filter = get_field(request, 'filter', None)
-        if 'pattern' in in_filter:
-            in_pat = in_filter.get('pattern', '')
-            # Only let rule sets through that match the pattern exactly.
-            rule_sets = list(filter(lambda rs: rs.pattern == in_pat, rule_sets))
+        # the same order that they are considered for matching any given day.
+        # Single-use rule sets are paged through, the reoccurring ones come on
+        # the last page.
+        rule_sets = []
+        next_cursor = None
+        if single_use:
+            try:
+                rule_sets, next_cursor = \
+                    live_org.get_single_use_rule_set_page(
+                        start_date, end_date, request.args.get('cursor'),
+                        limit
+                    )
+            except InvalidRuleCursor:
+                raise ex.InvalidPage('invalid cursor')
+        if reoccurring and next_cursor is None:
+            rule_sets.extend(
+                rs for rs in live_org.get_reoccurring_rule_sets(
+                    date=start_date
+                ) if pattern is None or rs.pattern == pattern
+            )
 
         return jsonify({
-            'rule_sets': [dict_from_ruleset(rs) for rs in rule_sets]
+            'rule_sets': [dict_from_ruleset(rs) for rs in rule_sets],
+            'next_cursor': next_cursor
         }), 200
     elif request.method == 'DELETE':
         verify_user_is_mod(get_jwt_identity(), org_id)
 
-        # Remove a rule by pattern
+        # Remove a rule by pattern, from the effective date on if there is
+        # one.
         pattern = get_field(request, 'pattern')
-        num_deleted = live_org.remove_rule_set(pattern)
+        num_deleted = live_org.remove_rule_set(
+            pattern, _get_effective_date(live_org)
+        )
         return jsonify({
             'num_deleted': num_deleted
         }), 200
     else:
         verify_user_is_mod(get_jwt_identity(), org_id)
-        rs = ruleset_from_dict(get_field(request, 'rule_set'))
+        rs = _get_rule_set(get_field(request, 'rule_set'))
+
         if request.method == 'POST':
             # Add a new rule set, but throw an error if we would be overriding one
             # that already exists.
@@ -421,27 +583,126 @@ def org_rules(org_id):
             if pattern_reoccurs(rs.pattern):
                 test_rulesets.extend(live_org.get_reoccurring_rule_sets())
             else:
-                test_rulesets.extend(live_org.get_single_use_rule_sets())
+                # Only the rule sets of its day can have the same pattern.
+                day = live_org.date_util.date_from_string(rs.pattern)
+                test_rulesets.extend(
+                    live_org.get_single_use_rule_set_page(day, day)[0]
+                )
 
             # Search by pattern only. There should never be an issue where two
-            # patterns represent the same date, because there is only one way to
-            # represent any particular day.
+            # patterns represent the same date, because _get_rule_set stores
+            # every single day the same way.
             for test_rs in test_rulesets:
                 if test_rs.pattern == rs.pattern:
                     raise ex.RuleSetExists(org_id, rs)
 
             # Add the rule set, there are no duplicates.
-            live_org.push_rule_set(rs)
-            return 200
+            live_org.push_rule_set(rs, _get_effective_date(live_org))
+            return '', 204
         else:
             # Add a new rule set, replacing one that is already there.
-            if pattern_reoccurs(rs.pattern):
-                # Remove a reoccurring rule if it already exists.
-                live_org.remove_reoccuring_rule_set(rs.pattern)
+            live_org.put_rule_set(rs, _get_effective_date(live_org))
+            return '', 204
+
+
+def _get_query_date(live_org, arg):
+    """Returns the day of a query argument, or None if it isn't there."""
+    date_str = request.args.get(arg)
+    if date_str is None:
+        return None
+    try:
+        return live_org.date_util.date_from_string(date_str)
+    except ValueError:
+        raise ex.InvalidDate(date_str)
+
+
+def _get_rule_set(rs_dict):
+    """Returns the rule set of a dict sent by a client, or raises an error if
+    it is missing a field or has an invalid pattern or rule."""
+    for field in ('pattern', 'incrday', 'rules'):
+        if not isinstance(rs_dict, dict) or field not in rs_dict:
+            raise ex.MissingFieldError(field)
+
+    try:
+        rs = ruleset_from_dict(rs_dict)
+    except RuleSyntaxError as e:
+        raise ex.InvalidRule(e.instring)
+    if not isinstance(rs.pattern, str) or compile_pattern(rs.pattern) is None:
+        raise ex.InvalidRulePattern(rs.pattern)
+
+    # Single days can be written without leading zeros, store them the one
+    # way so patterns of the same day compare equal.
+    if not pattern_reoccurs(rs.pattern):
+        rs = rs._replace(pattern=date_to_str(str_to_date(rs.pattern)))
+    return rs
+
+
+def _get_effective_date(live_org):
+    """Returns the day reoccurring rule set changes take effect, or None when
+    they apply to every day."""
+    date_str = get_field(request, 'effective_date', None)
+    if date_str is None:
+        return None
+    try:
+        return live_org.date_util.date_from_string(date_str)
+    except ValueError:
+        raise ex.InvalidDate(date_str)
+
+
+@org_api.route('/<org_id>/rules/simulate', methods=['POST'])
+@jwt_required
+def org_rules_simulate(org_id):
+    verify_user_is_mod(get_jwt_identity(), org_id)
+    live_org = get_live_org(org_id)
+    schedule = live_org.get_schedule()
+    sequence = schedule.sequence_index
+
+    rule_sets = []
+    for rs_dict in get_field(request, 'rule_sets', []):
+        rule_sets.append(_get_rule_set(rs_dict))
+
+    # Fixes can only be pushed in order, after the newest one, like
+    # push_fixed_daystate.
+    fixes = []
+    last_fix_day = schedule.fixes[0].date.date() if schedule.fixes else None
+    for fix_dict in get_field(request, 'fixes', []):
+        for field in ('date', 'daystate_id'):
+            if not isinstance(fix_dict, dict) or field not in fix_dict:
+                raise ex.MissingFieldError(field)
+
+        daystate_id = fix_dict['daystate_id']
+        if not isinstance(daystate_id, int) or isinstance(daystate_id, bool) \
+           or daystate_id not in sequence:
+            raise ex.InvalidDaystate(daystate_id, org_id)
+        try:
+            fix_date = live_org.date_util.date_from_string(fix_dict['date'])
+        except ValueError:
+            raise ex.InvalidDate(fix_dict['date'])
+        if last_fix_day is not None and fix_date.date() < last_fix_day:
+            raise ex.InvalidFixDate(date_to_str(fix_date),
+                                    date_to_str(last_fix_day))
+        last_fix_day = fix_date.date()
+        fixes.append(FixedDaystate(fix_date, daystate_id))
+
+    start_str = get_field(request, 'start_date', None)
+    if start_str is None:
+        start_date = live_org.date_util.today()
+    else:
+        try:
+            start_date = live_org.date_util.date_from_string(start_str)
+        except ValueError:
+            raise ex.InvalidDate(start_str)
+
+    num_days = get_field(request, 'days', 30)
+    max_days = current_app.config['MAX_SIMULATION_DAYS']
+    if not isinstance(num_days, int) or not 0 < num_days <= max_days:
+        raise ex.InvalidDateRange(
+            'days must be between 1 and {}'.format(max_days)
+        )
+    end_date = start_date + timedelta(days=num_days - 1)
 
-            # This is done automatically for single-use rule sets
-            live_org.push_rule_set(rs)
-            return 200
+    return jsonify(simulate_rules(org_id, rule_sets, fixes, start_date,
+                                  end_date)), 200
 
 
 @org_api.route('/<org_id>/rules/current')
@@ -449,7 +710,7 @@ def org_rules(org_id):
 def org_rules_current(org_id):
     verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
 
-    live_org = LiveOrg(get_redis(), get_org_by_id(org_id))
+    live_org = get_live_org(org_id)
 
     # Get the datetime of the start of today ie 00:00:00.
     today = live_org.date_util.today()
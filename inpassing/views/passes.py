@@ -7,12 +7,12 @@ from flask import Blueprint, jsonify, request, current_app, url_for
 from flask_jwt_extended import get_jwt_identity, jwt_required
 from flask_redis import FlaskRedis
 
-from .. import util
+from .. import util, exceptions as ex
 from ..models import db, User, Daystate, Pass
-from ..util import range_inclusive_dates, get_redis
+from ..util import range_inclusive_dates
 from ..view_util import user_is_mod, user_is_participant, get_user_by_id, \
-    get_field, get_org_by_id
-from ..worker import LiveOrg, str_to_date, date_to_str
+    get_field, get_live_org, verify_user_is_participant_or_mod
+from ..worker import str_to_date, date_to_str
 
 pass_api = Blueprint('pass', __name__)
 
@@ -179,14 +179,15 @@ def passes_query(pass_id):
                 'msg': 'not authenticated to modify this pass',
             }), 403
     elif request.method == 'DELETE':
+        # Whoever removes the pass, it must not be lent out anymore.
+        if is_mod or get_jwt_identity() == p.owner_id:
+            get_live_org(p.org_id).drop_pass_lends(p.id)
+
         # If we are a mod, remove the pass immediately.
         if is_mod:
-            db.session.remove(p)
+            db.session.delete(p)
             db.session.commit()
-
-        ###
-        # TODO: Make sure we update queues so that the pass isn't lent out.
-        ###
+            return '', 204
 
         # If we are a participant we can only delete our own pass but this will
         # only remove the association of the user with the pass. This probably
@@ -212,24 +213,59 @@ class EndDateTooEarlyError(Exception):
         return 'start_date must come before end_date'
 
 
-def get_date_pair(date_in, start_date_in, end_date_in):
+class DateRangeTooLongError(Exception):
+    def __init__(self, max_days):
+        self.max_days = max_days
+
+    def __str__(self):
+        return 'date range must not be longer than {} days'.format(
+            self.max_days
+        )
+
+
+def _parse_date(date_in):
+    try:
+        return str_to_date(date_in)
+    except (TypeError, ValueError):
+        raise ex.InvalidDate(date_in)
+
+
+def get_date_pair(date_in, start_date_in, end_date_in, max_days=None):
     if date_in is not None:
-        date = str_to_date(date_in)
+        date = _parse_date(date_in)
         start_date = date
         end_date = date
     else:
         if start_date_in is None or end_date_in is None:
             raise MissingDateError
         else:
-            start_date = str_to_date(start_date_in)
-            end_date = str_to_date(end_date_in)
+            start_date = _parse_date(start_date_in)
+            end_date = _parse_date(end_date_in)
 
     if end_date < start_date:
         raise EndDateTooEarlyError
 
+    if max_days is not None and (end_date - start_date).days + 1 > max_days:
+        raise DateRangeTooLongError(max_days)
+
     return start_date, end_date
 
 
+def get_queue_date_pair(js):
+    """Returns the date range a client wants to (un)borrow or (un)lend."""
+    return get_date_pair(
+        js.get('date'), js.get('start_date'), js.get('end_date'),
+        current_app.config['MAX_QUEUE_DATE_RANGE']
+    )
+
+
+def day_results(results, key):
+    """Turns a date -> result dict from a LiveOrg into a JSON response."""
+    return jsonify({
+        date_to_str(date): {key: result} for date, result in results.items()
+    }), 200
+
+
 def do_borrow(user_id, js, action):
     user_obj = User.query.filter_by(id=user_id).first()
     if user_obj is None:
@@ -240,55 +276,78 @@ def do_borrow(user_id, js, action):
     # Make sure we were also given an org id.
     org_id = js.get('org_id')
     if org_id is None:
-        return (jsonify({
+        return jsonify({
             'msg': 'missing org'
-        }), 422), True
+        }), 422
 
     try:
-        start_date, end_date = get_date_pair(
-            js.get('date'), js.get('start_date'), js.get('end_date')
-        )
-    except (MissingDateError, EndDateTooEarlyError) as e:
-        return (jsonify({
+        start_date, end_date = get_queue_date_pair(js)
+    except (MissingDateError, EndDateTooEarlyError,
+            DateRangeTooLongError) as e:
+        return jsonify({
             'msg': str(e)
-        }), 422), True
+        }), 422
 
     return action(
-        start_date, end_date, user_obj,
-        LiveOrg(get_redis(), get_org_by_id(org_id))
+        range_inclusive_dates(start_date, end_date), user_obj,
+        get_live_org(org_id)
     )
 
 
 @pass_api.route('/borrow', methods=['POST'])
 @jwt_required
 def borrow_pass():
-    def enqueue(start_date, end_date, user_obj, live_org):
-        ret_obj = {}
-        for date in range_inclusive_dates(start_date, end_date):
-            enqueued = live_org.enqueue_user_borrow(date, user_obj.id)
-            ret_obj[date_to_str(date)] = {
-                'enqueued': enqueued
-            }
-
-        return jsonify(ret_obj), 200
+    def enqueue(dates, user_obj, live_org):
+        return day_results(
+            live_org.enqueue_user_borrow_days(dates, user_obj.id), 'enqueued'
+        )
 
-    return do_borrow(get_jwt_identity, request.get_json(), enqueue)
+    return do_borrow(get_jwt_identity(), request.get_json(), enqueue)
 
 
-@pass_api.route('/unborrow')
+@pass_api.route('/unborrow', methods=['POST'])
 @jwt_required
 def unborrow_pass():
-    def dequeue(start_date, end_date, user_obj, live_org):
-        ret_obj = {}
-        for date in range_inclusive_dates(start_date, end_date):
-            dequeued = live_org.dequeue_user_borrow(date, user_obj.id)
-            ret_obj[date_to_str(date)] = {
-                'dequeued': dequeued
-            }
+    def dequeue(dates, user_obj, live_org):
+        return day_results(
+            live_org.dequeue_user_borrow_days(dates, user_obj.id), 'dequeued'
+        )
+
+    return do_borrow(get_jwt_identity(), request.get_json(), dequeue)
+
+
+@pass_api.route('/borrow/position')
+@jwt_required
+def borrow_position():
+    org_id = request.args.get('org_id')
+    if org_id is None:
+        return jsonify({
+            'msg': 'missing org'
+        }), 422
+
+    verify_user_is_participant_or_mod(get_jwt_identity(), org_id)
 
-        return jsonify(ret_obj), 200
+    try:
+        start_date, end_date = get_date_pair(
+            request.args.get('date'), request.args.get('start_date'),
+            request.args.get('end_date'),
+            current_app.config['MAX_QUEUE_DATE_RANGE']
+        )
+    except (MissingDateError, EndDateTooEarlyError,
+            DateRangeTooLongError) as e:
+        return jsonify({
+            'msg': str(e)
+        }), 422
 
-    return do_borrow(get_jwt_identity, request.get_json(), dequeue)
+    positions = get_live_org(org_id).user_borrow_positions(
+        range_inclusive_dates(start_date, end_date), get_jwt_identity()
+    )
+    return jsonify({
+        date_to_str(date): {
+            'position': position,
+            'depth': depth
+        } for date, (position, depth) in positions.items()
+    }), 200
 
 
 def do_lend(pass_id, user_id, js, action):
@@ -305,34 +364,28 @@ def do_lend(pass_id, user_id, js, action):
         }), 403
 
     try:
-        start_date, end_date = get_date_pair(
-            js.get('date'), js.get('start_date'), js.get('end_date')
-        )
-    except (MissingDateError, EndDateTooEarlyError) as e:
+        start_date, end_date = get_queue_date_pair(js)
+    except (MissingDateError, EndDateTooEarlyError,
+            DateRangeTooLongError) as e:
         return jsonify({
             'msg': str(e)
         }), 422
 
     return action(
-        start_date, end_date, pass_obj,
-        LiveOrg(get_redis(), get_org_by_id(pass_obj.org_id))
+        range_inclusive_dates(start_date, end_date), pass_obj,
+        get_live_org(pass_obj.org_id)
     )
 
 
 @pass_api.route('/<pass_id>/lend', methods=['POST'])
 @jwt_required
 def lend_pass(pass_id):
-    def enqueue(start_date, end_date, pass_obj, live_org):
-        ret_obj = {}
-        for date in range_inclusive_dates(start_date, end_date):
-            enqueued = live_org.enqueue_pass_lend(date, pass_obj.id)
-            ret_obj[date_to_str(date)] = {
-                'enqueued': enqueued
-            }
-
+    def enqueue(dates, pass_obj, live_org):
         # Should we have a way to mark a queue as retired? Or should that be
         # inferred based on whether the queue is in the org's active-queue list.
-        return jsonify(ret_obj), 200
+        return day_results(
+            live_org.enqueue_pass_lend_days(dates, pass_obj.id), 'enqueued'
+        )
 
     return do_lend(pass_id, get_jwt_identity(), request.get_json(), enqueue)
 
@@ -340,13 +393,9 @@ def lend_pass(pass_id):
 @pass_api.route('/<pass_id>/unlend', methods=['POST'])
 @jwt_required
 def unlend_pass(pass_id):
-    def dequeue(start_date, end_date, pass_obj, live_org):
-        ret_obj = {}
-        for date in range_inclusive_dates(start_date, end_date):
-            dequeued = live_org.dequeue_pass_lend(date, pass_obj.id)
-            ret_obj[date_to_str(date)] = {
-                'dequeued': dequeued
-            }
-        return jsonify(ret_obj), 200
+    def dequeue(dates, pass_obj, live_org):
+        return day_results(
+            live_org.dequeue_pass_lend_days(dates, pass_obj.id), 'dequeued'
+        )
 
     return do_lend(pass_id, get_jwt_identity(), request.get_json(), dequeue)
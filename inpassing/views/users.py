@@ -1,7 +1,6 @@
 # Copyright (c) 2017 Luke San Antonio Bialecki
 # All rights reserved.
 
-import bcrypt
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity, \
     create_access_token
@@ -21,7 +20,7 @@ def auth_user():
 
     user = db.session.query(User).filter_by(email=in_email).first()
 
-    if user and bcrypt.checkpw(in_passwd.encode('ascii'), user.password):
+    if user and util.check_password(in_passwd, user.password):
         # Authenticated, return a JWT
         ret = {
             'access_token': create_access_token(identity=user)
@@ -45,7 +44,7 @@ def user_signup():
 
     # Hash password, add user, return response.
     password = get_field(request, 'password')
-    hashpass = bcrypt.hashpw(password.encode('ascii'), bcrypt.gensalt(12))
+    hashpass = util.hash_password(password)
     user_obj = User(
         first_name=get_field(request, 'first_name'),
         last_name=get_field(request, 'last_name'),
@@ -2,5 +2,8 @@
 # All rights reserved.
 
 from .timeutil import (DATE_FMT, str_to_date, date_to_str)
-from .queue import (LiveObj, LiveOrg)
+from .backend import (MemoryRedis)
+from .queue import (LiveObj, LiveOrg, org_version_key, passes_version_key)
+from .registry import (LiveOrgRegistry, EligibilityCache)
+from .schedule import (RuleBucket, Schedule)
 from .worker import (ParkingWorker)
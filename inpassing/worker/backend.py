@@ -0,0 +1,667 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+# Storage backends for LiveOrg.
+#
+# LiveOrg doesn't care what it talks to as long as it looks like the part of
+# redis.StrictRedis (redis-py 2.10) that it uses: strings, lists, sets, sorted
+# sets and hashes, pipelines and WATCH / MULTI transactions. A StrictRedis is
+# one backend, MemoryRedis below is the other. A backend that can't run Lua
+# scripts sets supports_scripts to False and LiveOrg uses transactions
+# instead.
+#
+# MemoryRedis keeps everything in the process, which is all a single node
+# install needs and lets the tests and benchmarks run without a redis server.
+# Replies come back the way redis-py would return them (bytes, ints, floats for
+# scores, None for nothing) so LiveOrg can't tell the difference.
+
+import fnmatch
+import threading
+from bisect import bisect_left, insort
+from functools import wraps
+
+from redis.exceptions import RedisError, ResponseError, WatchError
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+NOT_AN_INTEGER = 'value is not an integer or out of range'
+
+
+def _encode(value):
+    """Encodes a key or value the way redis-py would send it."""
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+def _score(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return float(value)
+
+
+def _score_bound(value):
+    """Parses a sorted set range bound, returns (score, exclusive)."""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str) and value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def _index_range(length, start, end):
+    """Turns an inclusive redis index range into a python slice."""
+    if start < 0:
+        start += length
+    if end < 0:
+        end += length
+    return max(start, 0), max(min(end, length - 1) + 1, 0)
+
+
+class _SortedSet:
+    """Members ordered by score, then by member like redis does."""
+
+    __slots__ = ('scores', 'entries')
+
+    def __init__(self):
+        self.scores = {}
+        # Sorted list of (score, member) tuples.
+        self.entries = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        """Returns True if the member is new."""
+        old_score = self.scores.get(member)
+        if old_score is not None:
+            if old_score == score:
+                return False
+            del self.entries[bisect_left(self.entries, (old_score, member))]
+
+        self.scores[member] = score
+        insort(self.entries, (score, member))
+        return old_score is None
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.entries[bisect_left(self.entries, (score, member))]
+        return True
+
+    def rank(self, member):
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return bisect_left(self.entries, (score, member))
+
+    def score_range(self, min_bound, max_bound):
+        """Returns the slice of entries with scores between two bounds."""
+        min_score, min_exclusive = _score_bound(min_bound)
+        max_score, max_exclusive = _score_bound(max_bound)
+
+        lo = bisect_left(self.entries, (min_score,))
+        if min_exclusive:
+            while lo < len(self.entries) and self.entries[lo][0] == min_score:
+                lo += 1
+
+        hi = bisect_left(self.entries, (max_score,))
+        if not max_exclusive:
+            while hi < len(self.entries) and self.entries[hi][0] == max_score:
+                hi += 1
+
+        return lo, max(lo, hi)
+
+
+_commands = set()
+
+
+def _command(fn):
+    """Runs a MemoryRedis method under the store lock, and lets pipelines
+    queue it up."""
+    _commands.add(fn.__name__)
+
+    @wraps(fn)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return fn(self, *args, **kwargs)
+
+    return locked
+
+
+class MemoryRedis:
+    """A thread-safe, in-process stand-in for redis.StrictRedis."""
+
+    supports_scripts = False
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+
+        # Every write takes a number from this counter and the key keeps the
+        # last one it took, so WATCH can tell when it changed. Dropped keys
+        # forget theirs, dropped is the number of the last drop.
+        self.writes = 0
+        self.versions = {}
+        self.dropped = 0
+
+    ###
+    # Helpers, call with the lock held
+    ###
+    def _touch(self, key):
+        self.writes += 1
+        self.versions[key] = self.writes
+
+    def _drop(self, key):
+        del self.data[key]
+        self.versions.pop(key, None)
+        self.writes += 1
+        self.dropped = self.writes
+
+    def _changed_since(self, key, writes):
+        """Returns whether a key may have been written after the write with
+        this number."""
+        version = self.versions.get(key)
+        if version is None:
+            return self.dropped > writes
+        return version > writes
+
+    def _get(self, name, ty):
+        value = self.data.get(_encode(name))
+        if value is not None and not isinstance(value, ty):
+            raise ResponseError(WRONGTYPE)
+        return value
+
+    def _get_or_create(self, name, ty):
+        key = _encode(name)
+        value = self.data.get(key)
+        if value is None:
+            value = self.data[key] = ty()
+        elif not isinstance(value, ty):
+            raise ResponseError(WRONGTYPE)
+        return value
+
+    def _written(self, name):
+        """Marks a key written, and drops it if that left it empty."""
+        key = _encode(name)
+        if key not in self.data:
+            return
+        if len(self.data[key]) == 0:
+            self._drop(key)
+        else:
+            self._touch(key)
+
+    ###
+    # Pipelines and transactions
+    ###
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self, transaction)
+
+    def transaction(self, func, *watches, **kwargs):
+        value_from_callable = kwargs.pop('value_from_callable', False)
+        with self.pipeline(True) as pipe:
+            while True:
+                try:
+                    if watches:
+                        pipe.watch(*watches)
+                    func_value = func(pipe)
+                    exec_value = pipe.execute()
+                    return func_value if value_from_callable else exec_value
+                except WatchError:
+                    continue
+
+    ###
+    # Keys
+    ###
+    @_command
+    def delete(self, *names):
+        deleted = 0
+        for name in names:
+            key = _encode(name)
+            if key in self.data:
+                self._drop(key)
+                deleted += 1
+        return deleted
+
+    @_command
+    def exists(self, name):
+        return _encode(name) in self.data
+
+    @_command
+    def type(self, name):
+        value = self.data.get(_encode(name))
+        if value is None:
+            return b'none'
+        return {bytes: b'string', list: b'list', set: b'set', dict: b'hash',
+                _SortedSet: b'zset'}[type(value)]
+
+    @_command
+    def keys(self, pattern='*'):
+        pattern = _encode(pattern)
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    def scan_iter(self, match=None, count=None):
+        yield from self.keys('*' if match is None else match)
+
+    @_command
+    def flushdb(self):
+        self.data.clear()
+        self.versions.clear()
+        self.writes += 1
+        self.dropped = self.writes
+        return True
+
+    flushall = flushdb
+    _commands.add('flushall')
+
+    ###
+    # Strings
+    ###
+    @_command
+    def get(self, name):
+        return self._get(name, bytes)
+
+    @_command
+    def set(self, name, value):
+        key = _encode(name)
+        self.data[key] = _encode(value)
+        self._touch(key)
+        return True
+
+    @_command
+    def incrby(self, name, amount=1):
+        key = _encode(name)
+        value = self._get(name, bytes)
+        try:
+            value = int(value or 0) + amount
+        except ValueError:
+            raise ResponseError(NOT_AN_INTEGER)
+        self.data[key] = _encode(value)
+        self._touch(key)
+        return value
+
+    incr = incrby
+    _commands.add('incr')
+
+    ###
+    # Lists
+    ###
+    @_command
+    def lpush(self, name, *values):
+        lst = self._get_or_create(name, list)
+        for value in values:
+            lst.insert(0, _encode(value))
+        self._written(name)
+        return len(lst)
+
+    @_command
+    def rpush(self, name, *values):
+        lst = self._get_or_create(name, list)
+        lst.extend(_encode(value) for value in values)
+        self._written(name)
+        return len(lst)
+
+    @_command
+    def lindex(self, name, index):
+        lst = self._get(name, list) or []
+        if -len(lst) <= index < len(lst):
+            return lst[index]
+        return None
+
+    @_command
+    def llen(self, name):
+        return len(self._get(name, list) or [])
+
+    @_command
+    def lrange(self, name, start, end):
+        lst = self._get(name, list) or []
+        start, end = _index_range(len(lst), start, end)
+        return lst[start:end]
+
+    @_command
+    def lrem(self, name, count, value):
+        lst = self._get(name, list)
+        if lst is None:
+            return 0
+
+        value = _encode(value)
+        indices = [i for i, item in enumerate(lst) if item == value]
+        if count < 0:
+            indices = indices[::-1][:-count]
+        elif count > 0:
+            indices = indices[:count]
+
+        for i in sorted(indices, reverse=True):
+            del lst[i]
+        if indices:
+            self._written(name)
+        return len(indices)
+
+    ###
+    # Sets
+    ###
+    @_command
+    def sadd(self, name, *values):
+        s = self._get_or_create(name, set)
+        size = len(s)
+        s.update(_encode(value) for value in values)
+        self._written(name)
+        return len(s) - size
+
+    @_command
+    def srem(self, name, *values):
+        s = self._get(name, set)
+        if s is None:
+            return 0
+        size = len(s)
+        s.difference_update(_encode(value) for value in values)
+        if len(s) != size:
+            self._written(name)
+        return size - len(s)
+
+    @_command
+    def smembers(self, name):
+        return set(self._get(name, set) or ())
+
+    @_command
+    def sismember(self, name, value):
+        return _encode(value) in (self._get(name, set) or ())
+
+    @_command
+    def scard(self, name):
+        return len(self._get(name, set) or ())
+
+    ###
+    # Hashes
+    ###
+    @_command
+    def hget(self, name, key):
+        return (self._get(name, dict) or {}).get(_encode(key))
+
+    @_command
+    def hmget(self, name, keys, *args):
+        h = self._get(name, dict) or {}
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        return [h.get(_encode(key)) for key in keys + list(args)]
+
+    @_command
+    def hgetall(self, name):
+        return dict(self._get(name, dict) or {})
+
+    @_command
+    def hvals(self, name):
+        return list((self._get(name, dict) or {}).values())
+
+    @_command
+    def hset(self, name, key, value):
+        h = self._get_or_create(name, dict)
+        key = _encode(key)
+        is_new = key not in h
+        h[key] = _encode(value)
+        self._written(name)
+        return int(is_new)
+
+    @_command
+    def hsetnx(self, name, key, value):
+        h = self._get_or_create(name, dict)
+        key = _encode(key)
+        if key in h:
+            return 0
+        h[key] = _encode(value)
+        self._written(name)
+        return 1
+
+    @_command
+    def hdel(self, name, *keys):
+        h = self._get(name, dict)
+        if h is None:
+            return 0
+        deleted = 0
+        for key in keys:
+            if h.pop(_encode(key), None) is not None:
+                deleted += 1
+        if deleted:
+            self._written(name)
+        return deleted
+
+    @_command
+    def hexists(self, name, key):
+        return _encode(key) in (self._get(name, dict) or {})
+
+    @_command
+    def hlen(self, name):
+        return len(self._get(name, dict) or {})
+
+    @_command
+    def hincrby(self, name, key, amount=1):
+        h = self._get_or_create(name, dict)
+        key = _encode(key)
+        try:
+            value = int(h.get(key, 0)) + amount
+        except ValueError:
+            raise ResponseError(NOT_AN_INTEGER)
+        h[key] = _encode(value)
+        self._written(name)
+        return value
+
+    ###
+    # Sorted sets
+    ###
+    @_command
+    def zadd(self, name, *args, **kwargs):
+        if len(args) % 2 != 0:
+            raise RedisError('ZADD requires an equal number of values and '
+                             'scores')
+        pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+
+        zset = self._get_or_create(name, _SortedSet)
+        added = sum(zset.add(_encode(member), _score(score))
+                    for member, score in pairs)
+        self._written(name)
+        return added
+
+    @_command
+    def zrem(self, name, *values):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return 0
+        removed = sum(zset.remove(_encode(value)) for value in values)
+        if removed:
+            self._written(name)
+        return removed
+
+    @_command
+    def zcard(self, name):
+        return len(self._get(name, _SortedSet) or ())
+
+    @_command
+    def zcount(self, name, min, max):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return 0
+        lo, hi = zset.score_range(min, max)
+        return hi - lo
+
+    @_command
+    def zscore(self, name, value):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return None
+        return zset.scores.get(_encode(value))
+
+    @_command
+    def zrank(self, name, value):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return None
+        return zset.rank(_encode(value))
+
+    @_command
+    def zrevrank(self, name, value):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return None
+        rank = zset.rank(_encode(value))
+        return None if rank is None else len(zset) - rank - 1
+
+    def _entries_reply(self, entries, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score))
+                    for score, member in entries]
+        return [member for score, member in entries]
+
+    @_command
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return []
+
+        entries = zset.entries[::-1] if desc else zset.entries
+        start, end = _index_range(len(entries), start, end)
+        return self._entries_reply(entries[start:end], withscores,
+                                   score_cast_func)
+
+    @_command
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores,
+                           score_cast_func)
+
+    @_command
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        if (start is None) != (num is None):
+            raise RedisError('``start`` and ``num`` must both be specified')
+
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return []
+
+        lo, hi = zset.score_range(min, max)
+        entries = zset.entries[lo:hi]
+        if start is not None:
+            entries = entries[start:] if num < 0 else \
+                entries[start:start + num]
+        return self._entries_reply(entries, withscores, score_cast_func)
+
+    @_command
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        if (start is None) != (num is None):
+            raise RedisError('``start`` and ``num`` must both be specified')
+
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return []
+
+        lo, hi = zset.score_range(min, max)
+        entries = zset.entries[lo:hi][::-1]
+        if start is not None:
+            entries = entries[start:] if num < 0 else \
+                entries[start:start + num]
+        return self._entries_reply(entries, withscores, score_cast_func)
+
+    @_command
+    def zremrangebyscore(self, name, min, max):
+        zset = self._get(name, _SortedSet)
+        if zset is None:
+            return 0
+
+        lo, hi = zset.score_range(min, max)
+        for score, member in zset.entries[lo:hi]:
+            del zset.scores[member]
+        del zset.entries[lo:hi]
+        if hi > lo:
+            self._written(name)
+        return hi - lo
+
+
+class MemoryPipeline:
+    """Queues up MemoryRedis commands like a redis-py pipeline.
+
+    After watch() commands run right away until multi() is called, just like
+    redis-py. execute() fails with a WatchError if a watched key was written
+    since it was watched.
+
+    """
+
+    def __init__(self, store, transaction=True):
+        self.store = store
+        self.transaction = transaction
+        self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+        self.watching = {}
+        self.explicit_transaction = False
+
+    def watch(self, *names):
+        if self.explicit_transaction:
+            raise RedisError('Cannot issue a WATCH after a MULTI')
+        with self.store.lock:
+            for name in names:
+                key = _encode(name)
+                self.watching[key] = self.store.writes
+        return True
+
+    def unwatch(self):
+        self.watching = {}
+        return True
+
+    def multi(self):
+        if self.explicit_transaction:
+            raise RedisError('Cannot issue nested calls to MULTI')
+        if self.command_stack:
+            raise RedisError('Commands without an initial WATCH have already '
+                             'been issued')
+        self.explicit_transaction = True
+
+    def __getattr__(self, name):
+        if name not in _commands:
+            raise AttributeError(name)
+        command = getattr(self.store, name)
+
+        def queue_command(*args, **kwargs):
+            if self.watching and not self.explicit_transaction:
+                return command(*args, **kwargs)
+            self.command_stack.append((command, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        try:
+            with self.store.lock:
+                for key, writes in self.watching.items():
+                    if self.store._changed_since(key, writes):
+                        raise WatchError('Watched variable changed.')
+
+                results = []
+                for command, args, kwargs in stack:
+                    try:
+                        results.append(command(*args, **kwargs))
+                    except ResponseError as e:
+                        results.append(e)
+        finally:
+            self.reset()
+
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, ResponseError):
+                    raise result
+        return results
@@ -9,6 +9,8 @@
 # Figure out the state based on what the last fixed index was and the number of
 # periods since it was fixed.
 
+from datetime import timedelta
+
 
 def current_state(states, fixed_index, periods_since_fixed):
     """Return the state of some day based on how it was last fixed.
@@ -33,3 +35,108 @@ def num_periods(period_duration, last_fixed_date, current_date):
         current_date - the date in question.
     """
     return (current_date - last_fixed_date) / period_duration
+
+
+# Periods are days that move the sequence forward, which days do is decided by
+# the org's rules. Reoccurring rules only look at the weekday so they can be
+# counted a week at a time, single-use rules (overrides) are corrected for one
+# by one.
+
+def weekday_counts(first_weekday, num_days):
+    """Return how many times each weekday comes up in a run of days.
+
+    Arguments:
+        first_weekday - The weekday of the first day, Monday is 0.
+        num_days - The number of days in the run.
+    """
+    weeks, rest = divmod(num_days, 7)
+    counts = [weeks] * 7
+    for i in range(rest):
+        counts[(first_weekday + i) % 7] += 1
+    return counts
+
+
+def count_increments(since, until, weekday_incrdays, overrides=None):
+    """Return the number of periods after one day up to and including another.
+
+    The count is negative when until comes before since, so that the state of
+    until is always current_state(states, <index on since>, count).
+
+    Arguments:
+        since - The date counting starts after.
+        until - The last date counted.
+        weekday_incrdays - Seven booleans, Monday first, whether days on that
+        weekday move the sequence forward.
+        overrides - A dict mapping dates to whether they move the sequence
+        forward, in place of what their weekday says.
+    """
+    if until < since:
+        return -count_increments(until, since, weekday_incrdays, overrides)
+
+    counts = weekday_counts((since + timedelta(days=1)).weekday(),
+                            (until - since).days)
+    total = sum(count for count, incrday in zip(counts, weekday_incrdays)
+                if incrday)
+
+    for day, incrday in (overrides or {}).items():
+        if since < day <= until:
+            total += int(bool(incrday)) - \
+                int(bool(weekday_incrdays[day.weekday()]))
+    return total
+
+
+# Projections compute the state of every day in a run at once, which is what
+# summaries over months or years of the schedule need. They import numpy
+# themselves so that nothing else waits for it.
+
+def increment_mask(first_day, num_days, weekday_incrdays, overrides=None):
+    """Return a boolean array of whether each day in a run of days moves the
+    sequence forward.
+
+    Arguments:
+        first_day - The date of the first day.
+        num_days - The number of days in the run.
+        weekday_incrdays - Seven booleans, Monday first, whether days on that
+        weekday move the sequence forward.
+        overrides - A dict mapping dates to whether they move the sequence
+        forward, in place of what their weekday says.
+    """
+    import numpy as np
+
+    weekdays = (first_day.weekday() + np.arange(num_days)) % 7
+    mask = np.asarray(weekday_incrdays, dtype=bool)[weekdays]
+    for day, incrday in (overrides or {}).items():
+        offset = (day - first_day).days
+        if 0 <= offset < num_days:
+            mask[offset] = bool(incrday)
+    return mask
+
+
+def project_states(states, fixed_index, incr_mask, fixes=None):
+    """Return an array of the state of every day in a run of days.
+
+    This is current_state for every day at once, the periods since the first
+    day are the running count of days that move the sequence forward.
+
+    Arguments:
+        states - An array of states.
+        fixed_index - The index of the state of the first day.
+        incr_mask - Whether each day moves the sequence forward, see
+        increment_mask. The first day is already at fixed_index so its own
+        entry doesn't count.
+        fixes - A dict mapping offsets into the run to the index of the state
+        the sequence is fixed to on that day.
+    """
+    import numpy as np
+
+    if len(incr_mask) == 0:
+        return np.asarray(states)[[]]
+
+    periods = np.cumsum(incr_mask, dtype=np.int64)
+    periods -= periods[0]
+
+    indices = fixed_index + periods
+    for offset, index in sorted((fixes or {}).items()):
+        if 0 < offset < len(indices):
+            indices[offset:] = index + periods[offset:] - periods[offset]
+    return np.asarray(states)[indices % len(states)]
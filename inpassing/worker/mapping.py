@@ -0,0 +1,182 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+# The mappings of a rule set are compiled into one sorted index of spot ranges
+# so that finding out where a pass parks is a binary search, instead of asking
+# every mapping and every spot map in turn like CompositeMapping does. The
+# index is also kept as numpy arrays to look up every pass of an org at once.
+
+# Every range in the index belongs to one state and covers a run of spot
+# numbers. Ranges are found by a key made from both, the state id in the high
+# bits and the spot number in the low bits, so the index sorts by state and
+# then spot number.
+
+# numpy is only imported once a mapping is compiled, the worker and most
+# requests never get that far.
+
+import bisect
+import heapq
+
+from . import rules
+
+# Mappings without spot maps cover every spot number of their state.
+MIN_SPOT = -2 ** 31
+MAX_SPOT = 2 ** 31 - 1
+
+
+def _key(state_id, spot_num):
+    # This works the same on ints and int64 arrays.
+    return (state_id << 32) + (spot_num - MIN_SPOT)
+
+
+class CompiledMapping:
+    """Where passes can park, according to a list of mappings.
+
+    adjust_pass and includes_pass give the same answers as a CompositeMapping
+    of the same mappings.
+
+    """
+
+    def __init__(self, segments, rejects_rest=False):
+        """Arguments:
+            segments - Sorted (state id, first spot, last spot, fixed, value)
+            tuples that don't overlap. When fixed is True every spot of the
+            segment is moved to value, otherwise value is added to the spot.
+            rejects_rest - Whether passes outside of every segment are
+            included, but can't park ('none').
+        """
+        self.segments = segments
+        self.rejects_rest = rejects_rest
+
+        self.keys = [_key(seg[0], seg[1]) for seg in segments]
+
+        # Passes of any other state can't park.
+        self.state_ids = sorted({seg[0] for seg in segments})
+
+        import numpy as np
+        self.key_array = np.array(self.keys, dtype=np.int64)
+        self.state_array = np.array([seg[0] for seg in segments],
+                                    dtype=np.int64)
+        self.last_array = np.array([seg[2] for seg in segments],
+                                   dtype=np.int64)
+        self.fixed_array = np.array([seg[3] for seg in segments], dtype=bool)
+        self.value_array = np.array([seg[4] for seg in segments],
+                                    dtype=np.int64)
+
+    def _find(self, state_id, spot_num):
+        i = bisect.bisect_right(self.keys, _key(state_id, spot_num)) - 1
+        if i < 0:
+            return None
+        seg = self.segments[i]
+        if seg[0] != state_id or spot_num > seg[2]:
+            return None
+        return seg
+
+    def includes_pass(self, state_id, spot_num):
+        return self.rejects_rest or self._find(state_id, spot_num) is not None
+
+    def adjust_pass(self, state_id, spot_num):
+        seg = self._find(state_id, spot_num)
+        if seg is None:
+            return None
+        return seg[4] if seg[3] else spot_num + seg[4]
+
+    def adjust_passes(self, state_ids, spot_nums):
+        """Looks up many passes at once.
+
+        Returns an (adjusted spot nums, can park) pair of arrays. The adjusted
+        spot num of a pass that can't park is meaningless.
+        """
+        import numpy as np
+
+        state_ids = np.asarray(state_ids, dtype=np.int64)
+        spot_nums = np.asarray(spot_nums, dtype=np.int64)
+        if len(self.segments) == 0:
+            return spot_nums.copy(), np.zeros(len(spot_nums), dtype=bool)
+
+        found = np.searchsorted(self.key_array, _key(state_ids, spot_nums),
+                                side='right') - 1
+        seg_i = np.maximum(found, 0)
+        can_park = (found >= 0) & (self.state_array[seg_i] == state_ids) & \
+            (spot_nums <= self.last_array[seg_i])
+
+        adjusted = np.where(self.fixed_array[seg_i], self.value_array[seg_i],
+                            spot_nums + self.value_array[seg_i])
+        return adjusted, can_park
+
+
+def _flatten(ranges):
+    """Turns (first spot, last spot, fixed, value) ranges of one state that
+    may overlap into sorted ranges that don't. Ranges earlier in the list win
+    where they overlap."""
+    bounds = sorted({r[0] for r in ranges} | {r[1] + 1 for r in ranges})
+    by_first = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+
+    # Indices of the ranges that started, the lowest one wins.
+    started = []
+    next_start = 0
+
+    flat = []
+    for first, end in zip(bounds, bounds[1:]):
+        while next_start < len(by_first) and \
+                ranges[by_first[next_start]][0] <= first:
+            heapq.heappush(started, by_first[next_start])
+            next_start += 1
+        while len(started) > 0 and ranges[started[0]][1] < first:
+            heapq.heappop(started)
+        if len(started) == 0:
+            continue
+
+        adjustment = ranges[started[0]][2:]
+        if len(flat) > 0 and flat[-1][1] == first - 1 and \
+                flat[-1][2:] == adjustment:
+            flat[-1] = (flat[-1][0], end - 1) + adjustment
+        else:
+            flat.append((first, end - 1) + adjustment)
+    return flat
+
+
+def compile_mappings(mappings, current_state_id=None):
+    """Compiles the mappings of a rule set into a CompiledMapping.
+
+    Arguments:
+        mappings - A list of mappings (what convert_rules gives a rule set) or
+        a CompositeMapping.
+        current_state_id - The daystate that 'cur' stands for, by default the
+        current_state_id of the CurStateMapping.
+    """
+    if isinstance(mappings, rules.CompositeMapping):
+        mappings = mappings.maps
+
+    # The ranges of every state, in the order they are tried.
+    state_ranges = {}
+    rejects_rest = False
+    for mapping in mappings:
+        if isinstance(mapping, rules.NoneMapping):
+            # Nothing after this is ever looked at.
+            rejects_rest = True
+            break
+        elif isinstance(mapping, rules.CurStateMapping):
+            state_id = current_state_id
+            if state_id is None:
+                state_id = mapping.current_state_id
+            if state_id is not None:
+                state_ranges.setdefault(state_id, []).append(
+                    (MIN_SPOT, MAX_SPOT, False, 0)
+                )
+        elif isinstance(mapping, rules.CustomMapping):
+            ranges = state_ranges.setdefault(mapping.state_id, [])
+            if len(mapping.spot_mappings) == 0:
+                ranges.append((MIN_SPOT, MAX_SPOT, False, 0))
+            for spot_map in mapping.spot_mappings:
+                fixed = spot_map.adjust_type == rules.SpotAdjustmentType.Fixed
+                ranges.append((spot_map.start, spot_map.end, fixed,
+                               spot_map.value))
+        else:
+            raise ValueError('Unable to compile mapping: {!r}'.format(mapping))
+
+    segments = []
+    for state_id in sorted(state_ranges):
+        segments.extend((state_id,) + seg
+                        for seg in _flatten(state_ranges[state_id]))
+    return CompiledMapping(segments, rejects_rest)
@@ -0,0 +1,173 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+# Rule set patterns are compiled once into matchers that only compare
+# integers, instead of looking up weekday names and parsing dates every time a
+# pattern is matched against a day.
+
+# Pattern syntax
+# '*' - Every day.
+# '<weekday>' - Every monday, tuesday, etc.
+# '<first|second|third|fourth|fifth|last> <weekday>' - One weekday of every
+# month, for example 'first monday'.
+# '<MM>-<DD>' - The same day every year, for example '12-25'.
+# '<YYYY>-<MM>-<DD>' - One day, these are the single-use patterns.
+# '<YYYY>-<MM>-<DD> to <YYYY>-<MM>-<DD>' - Every day in a range (inclusive).
+
+import calendar
+import re
+from datetime import date
+from functools import lru_cache
+
+days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+        'sunday']
+
+nths = ['first', 'second', 'third', 'fourth', 'fifth']
+
+LAST = -1
+
+_date_re = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+_month_day_re = re.compile(r'^(\d{1,2})-(\d{1,2})$')
+
+
+class AnyDayPattern:
+    __slots__ = ()
+    reoccurs = True
+
+    def matches(self, day):
+        return True
+
+
+class WeekdayPattern:
+    __slots__ = ('weekday',)
+    reoccurs = True
+
+    def __init__(self, weekday):
+        self.weekday = weekday
+
+    def matches(self, day):
+        return day.weekday() == self.weekday
+
+
+class NthWeekdayPattern:
+    """Matches one weekday of every month, nth is 1 for the first one and
+    LAST for the last one."""
+    __slots__ = ('nth', 'weekday')
+    reoccurs = True
+
+    def __init__(self, nth, weekday):
+        self.nth = nth
+        self.weekday = weekday
+
+    def matches(self, day):
+        if day.weekday() != self.weekday:
+            return False
+        if self.nth == LAST:
+            return day.day + 7 > calendar.monthrange(day.year, day.month)[1]
+        return (day.day - 1) // 7 + 1 == self.nth
+
+    def in_month(self, year, month):
+        """Returns the day this pattern matches in a month, or None."""
+        first_weekday, num_days = calendar.monthrange(year, month)
+        first = (self.weekday - first_weekday) % 7 + 1
+        if self.nth == LAST:
+            return date(year, month, first + (num_days - first) // 7 * 7)
+        day = first + (self.nth - 1) * 7
+        return date(year, month, day) if day <= num_days else None
+
+
+class MonthDayPattern:
+    __slots__ = ('month', 'day')
+    reoccurs = True
+
+    def __init__(self, month, day):
+        self.month = month
+        self.day = day
+
+    def matches(self, day):
+        return day.month == self.month and day.day == self.day
+
+    def in_year(self, year):
+        """Returns the day this pattern matches in a year, or None (February
+        29th)."""
+        try:
+            return date(year, self.month, self.day)
+        except ValueError:
+            return None
+
+
+class DatePattern:
+    __slots__ = ('ordinal',)
+    reoccurs = False
+
+    def __init__(self, ordinal):
+        self.ordinal = ordinal
+
+    def matches(self, day):
+        return day.toordinal() == self.ordinal
+
+
+class DateRangePattern:
+    __slots__ = ('first_ordinal', 'last_ordinal')
+
+    # Ranges are kept with the reoccurring rule sets, they aren't tied to a
+    # single day.
+    reoccurs = True
+
+    def __init__(self, first_ordinal, last_ordinal):
+        self.first_ordinal = first_ordinal
+        self.last_ordinal = last_ordinal
+
+    def matches(self, day):
+        return self.first_ordinal <= day.toordinal() <= self.last_ordinal
+
+
+def _parse_date(s):
+    match = _date_re.match(s)
+    if match is None:
+        return None
+    try:
+        return date(*map(int, match.groups()))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def compile_pattern(pattern):
+    """Returns the matcher of a pattern, or None if it isn't a valid
+    pattern."""
+    if not isinstance(pattern, str):
+        return None
+
+    if pattern == '*':
+        return AnyDayPattern()
+    if pattern in days:
+        return WeekdayPattern(days.index(pattern))
+
+    words = pattern.split()
+    if len(words) == 2 and words[1] in days and \
+            (words[0] in nths or words[0] == 'last'):
+        nth = LAST if words[0] == 'last' else nths.index(words[0]) + 1
+        return NthWeekdayPattern(nth, days.index(words[1]))
+
+    if len(words) == 3 and words[1] == 'to':
+        first, last = _parse_date(words[0]), _parse_date(words[2])
+        if first is None or last is None or last < first:
+            return None
+        return DateRangePattern(first.toordinal(), last.toordinal())
+
+    day = _parse_date(pattern)
+    if day is not None:
+        return DatePattern(day.toordinal())
+
+    match = _month_day_re.match(pattern)
+    if match is not None:
+        month, day = map(int, match.groups())
+        # Allow February 29th, it just doesn't match most years.
+        try:
+            date(2000, month, day)
+        except ValueError:
+            return None
+        return MonthDayPattern(month, day)
+
+    return None
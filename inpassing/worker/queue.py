@@ -1,14 +1,17 @@
 # Copyright (c) 2016 Luke San Antonio Bialecki
 # All rights reserved.
 
+import bisect
+
 import pytz
 from pytz import timezone
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from enum import Enum
 
 import msgpack
 
-from . import rules, DATE_FMT, date_to_str, str_to_date
+from . import rules, scripts, DATE_FMT, date_to_str, str_to_date
+from .schedule import RuleBucket, Schedule, ScheduleCache, simulate
 from .timeutil import SECONDS_PER_DAY, LocalizedDateUtil
 
 
@@ -21,6 +24,8 @@ class ObjType(Enum):
 class LiveObj:
     """Represents a pass or a user in a queue (with a request token)."""
 
+    __slots__ = ('ty', 'id', 'token')
+
     def __init__(self, ty, obj_id, obj_token):
         self.ty = ty
         self.id = obj_id
@@ -38,26 +43,150 @@ class LiveObj:
         return str(self).encode()
 
 
-def _obj_exists(r, queue, obj):
-    """Returns whether the obj exists in the given queue."""
-    size = r.llen(queue)
+# Day queues are sorted sets of object ids. Every object is scored with a
+# ticket taken from an ever increasing counter when it joins (or rejoins) the
+# queue, so the lowest score is the front of the queue and the highest score is
+# the back. That way the rank of an object and the length of a queue are both
+# O(log n) to find.
 
-    # No reason to call lrange if we aren't even dealing with a list, for
-    # example.
-    if size == 0:
-        return False
+def _day_score(day_str):
+    """Returns the score of a day in the active queue schedule.
 
-    ###
-    # Hopefully this isn't so wildly inefficient that it blows up in our
-    # face later.
-    ###
-    contents = r.lrange(queue, 0, size)
+    2017-05-01 is scored 20170501, which sorts days by date. scripts.py
+    computes the same score.
+    """
+    return int(day_str.replace('-', ''))
+
+
+def _score_day(score):
+    """Returns the day string of a day score, the inverse of _day_score."""
+    return '{:04d}-{:02d}-{:02d}'.format(score // 10000, score // 100 % 100,
+                                         score % 100)
+
+
+# Orgs and passes live in the database, every process caches what it derived
+# from them (the LiveOrg of an org, who may park on a day). These counters are
+# bumped after a change to them is committed so the other processes find out,
+# they aren't kept by a LiveOrg because the org may not have one yet.
+
+def org_version_key(org_id):
+    """Returns the name of the counter bumped when an org changes."""
+    return '{}:org-version'.format(org_id)
+
+
+def passes_version_key(org_id):
+    """Returns the name of the counter bumped when a pass of an org changes."""
+    return '{}:passes-version'.format(org_id)
 
-    # Make sure to use bytes so that comparisons work.
-    return True if bytes(obj) in contents else False
+
+# Reoccurring rule sets are kept in buckets by the day they take effect. Each
+# bucket is a hash of rule sets keyed by pattern, and a sorted set indexes the
+# buckets by the day score of their first day. The bucket with score 0 is the
+# one every org starts with, it is in effect before any other bucket and keeps
+# the key reoccurring rule sets always had. Fixing a daystate opens a bucket on
+# its day as a copy of the bucket in effect there, rule sets put from a day on
+# only change the buckets from that day on, so days before it keep the rules
+# they were counted with.
+
+# Buckets that are no longer needed to count recent daystates can be archived,
+# they are moved to a second index that only get_reoccurring_rule_sets looks
+# at.
+
+def _bucket_in_effect(bucket_scores, day_score):
+    """Returns the score of the bucket in effect on a day, given the sorted
+    scores of the buckets. The first bucket is also in effect before it."""
+    bucket_i = bisect.bisect_right(bucket_scores, day_score) - 1
+    return bucket_scores[max(bucket_i, 0)]
+
+
+# Tokens are kept in many small hashes of up to TOKEN_BUCKET_SIZE objects
+# rather than one hash per org. Redis stores hashes this small as a flat
+# listpack (see hash-max-listpack-entries) instead of a hash table, which
+# takes a fraction of the memory when an org has tens of thousands of users.
+TOKEN_BUCKET_SIZE = 128
+
+
+def _token_field(obj_id):
+    """Returns the field of an object in its token bucket."""
+    return str(int(obj_id) % TOKEN_BUCKET_SIZE)
+
+
+def _queue_index(queue):
+    """Returns the name of the hash indexing the objects in a queue.
+
+    The index maps an object id to the token it was enqueued with, which lets
+    us find (or rule out) an object in a queue without reading the queue.
+    """
+    return queue + '-index'
+
+
+def _parse_state_sequence(seq):
+    try:
+        if seq is None:
+            return []
+        return list(map(lambda x: int(x), seq.decode('utf-8').split(',')))
+    except ValueError:
+        return []
+
+
+def _pack_rule_set(rule_set, *extra):
+    """Packs a rule set along with its timestamp (and order).
+
+    Rules can be strings or mappings, they are stored already parsed (see
+    rules.pack_rule). Raises RuleSyntaxError if a rule string is invalid.
+    """
+    new_rules = rule_set.rules
+    if isinstance(new_rules, rules.CompositeMapping):
+        new_rules = new_rules.maps
+    elif not isinstance(new_rules, list):
+        # Make sure we have a list of rules instead of a single value.
+        new_rules = [new_rules]
+    return msgpack.packb(
+        [rules.RULE_FORMAT_VERSION, rule_set.pattern, rule_set.incrday,
+         [rules.pack_rule(rule) for rule in new_rules]] + list(extra)
+    )
+
+
+def _unpack_rule_set(item):
+    """Returns the rule set (with mappings) and the list of values packed
+    along with it."""
+    fields = msgpack.unpackb(item, encoding='utf-8')
+    if isinstance(fields[0], list):
+        # Rule sets packed before the format was versioned hold rule strings,
+        # manage.py migrate_rule_format repacks them.
+        rule_set = rules.RuleSet(*fields[0])
+        return rule_set._replace(rules=[rules.parse_rule(rule)
+                                        for rule in rule_set.rules]), \
+            fields[1:]
+
+    if fields[0] != rules.RULE_FORMAT_VERSION:
+        raise ValueError('Unknown rule set format: {}'.format(fields[0]))
+    return rules.RuleSet(fields[1], fields[2],
+                         [rules.unpack_rule(rule) for rule in fields[3]]), \
+        fields[4:]
+
+
+def _parse_rule_cursor(cursor):
+    """Returns the (score, skip) of a cursor of single-use rule sets."""
+    try:
+        score, skip = cursor.split(':')
+        score, skip = int(score), int(skip)
+    except ValueError:
+        raise InvalidRuleCursor(cursor)
+    if skip < 0:
+        raise InvalidRuleCursor(cursor)
+    return score, skip
+
+
+def _rule_strings(rule_sets):
+    """Returns the rule sets with their rules as strings."""
+    return [rule_set._replace(rules=[str(rule) for rule in rule_set.rules])
+            for rule_set in rule_sets]
 
 
 class FixedDaystate:
+    __slots__ = ('date', 'state_id')
+
     def __init__(self, date, state_id):
         self.date = date
         self.state_id = state_id
@@ -85,6 +214,11 @@ class InvalidFixDate(Exception):
         pass
 
 
+class InvalidRuleCursor(Exception):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+
 class LiveOrg:
     """This class manages live org data.
 
@@ -93,68 +227,146 @@ class LiveOrg:
 
     """
 
-    def __init__(self, redis, org):
+    def __init__(self, redis, org, use_scripts=False, checkpoint_window=366):
         self.r = redis
 
-        # Can we make this immutable? That way we don't have to call the
-        # active_queue_set and friend functions over and over.
+        # Whether queue mutations should go through the Lua scripts in
+        # scripts.py or the WATCH / MULTI transactions below. Not every
+        # backend can run scripts, see backend.py.
+        self.use_scripts = use_scripts and \
+            getattr(redis, 'supports_scripts', True)
+
+        # The value of the active queue change counter the last time we
+        # reconciled.
+        self.reconciled_changes = None
+
+        # Computed daystates are only kept for days this many days around
+        # today.
+        self.checkpoint_window = checkpoint_window
+
+        # The compiled schedule, see get_schedule.
+        self._schedule_cache = None
+        self.checkpoint_hits = 0
+        self.checkpoint_misses = 0
+
         self.org_id = org.id
         self.timezone = timezone(org.timezone)
         self.date_util = LocalizedDateUtil(self.timezone)
 
+        # Key names are asked for on every call, build the ones that don't
+        # depend on a day or object once.
+        self._key_prefix = str(self.org_id) + ':'
+        self._keys = {
+            name: self._key_prefix + name for name in (
+                'active-queues-set', 'active-queues-schedule',
+                'active-queues-dirty', 'active-queues-changes',
+                'user-tokens', 'pass-tokens', 'fixed-daystates',
+                'schedule-version', 'daystate-sequence', 'reoccurring-rules',
+                'reoccurring-rule-order', 'rule-buckets',
+                'archived-rule-buckets', 'single-rules', 'queue-ticket'
+            )
+        }
+
     ###
     # Names of redis keys
     ###
     def _active_queue_set(self):
         """Returns the name of the active queue set for this org."""
-        return str(self.org_id) + ':active-queues-set'
+        return self._keys['active-queues-set']
 
-    def _active_queue_temp_set(self):
-        return str(self.org_id) + ':active-queues-temp-set'
+    def _active_queue_schedule(self):
+        """Returns the name of the sorted set scheduling active queues."""
+        return self._keys['active-queues-schedule']
 
-    def _active_queue_diff_set(self):
-        return str(self.org_id) + ':active-queues-diff-set'
+    def _active_queue_dirty_set(self):
+        """Returns the name of the set of days activated or deactivated since
+        the last reconciliation."""
+        return self._keys['active-queues-dirty']
 
-    def _active_queue_list(self):
-        """Returns the name of the active queue list for this org."""
-        return str(self.org_id) + ':active-queues-list'
+    def _active_queue_change_counter(self):
+        """Returns the name of the counter of activations and deactivations."""
+        return self._keys['active-queues-changes']
 
     def _borrow_queue(self, day):
         """Returns name of a day's borrow queue."""
-        return str(self.org_id) + ':' + date_to_str(day) + ':borrow'
+        return self._key_prefix + date_to_str(day) + ':borrow'
 
     def _lend_queue(self, day):
         """Returns name of a day's lend queue."""
-        return str(self.org_id) + ':' + date_to_str(day) + ':lend'
+        return self._key_prefix + date_to_str(day) + ':lend'
 
-    def _user_token_hash(self):
-        """Returns the name of the hash containing user tokens."""
-        return str(self.org_id) + ':user-tokens'
+    def _user_token_hash(self, user_id):
+        """Returns the name of the bucket hash containing a user's token."""
+        return self._keys['user-tokens'] + ':' + \
+            str(int(user_id) // TOKEN_BUCKET_SIZE)
 
-    def _pass_token_hash(self):
-        """Returns the name of the hash containing pass tokens."""
-        return str(self.org_id) + ':pass-tokens'
+    def _pass_token_hash(self, pass_id):
+        """Returns the name of the bucket hash containing a pass's token."""
+        return self._keys['pass-tokens'] + ':' + \
+            str(int(pass_id) // TOKEN_BUCKET_SIZE)
 
     def _fixed_daystates_list(self):
-        return str(self.org_id) + ':fixed-daystates'
+        return self._keys['fixed-daystates']
 
-    def _current_state_cache(self):
-        return str(self.org_id) + ':current-state-cache'
+    def _schedule_version(self):
+        """Returns the name of the counter bumped on every change to the
+        daystate sequence, fixes or rules."""
+        return self._keys['schedule-version']
 
     def _daystate_sequence(self):
-        return str(self.org_id) + ':daystate-sequence'
+        return self._keys['daystate-sequence']
+
+    def _reoccurring_rule_hash(self, bucket_score=0):
+        """Returns the name of the hash of reoccurring rule sets of a bucket,
+        keyed by pattern."""
+        if bucket_score == 0:
+            return self._keys['reoccurring-rules']
+        return self._keys['reoccurring-rules'] + ':' + str(bucket_score)
 
-    def _reoccurring_rule_list(self):
-        return str(self.org_id) + ':global-rules'
+    def _rule_bucket_index(self):
+        """Returns the name of the sorted set of rule bucket scores, the day
+        score of the first day of each bucket."""
+        return self._keys['rule-buckets']
+
+    def _archived_rule_bucket_index(self):
+        return self._keys['archived-rule-buckets']
+
+    def _reoccurring_rule_order(self):
+        """Returns the name of the counter ordering reoccurring rule sets, the
+        most recently set rule set matches first."""
+        return self._keys['reoccurring-rule-order']
 
     def _single_use_rule_bucket(self):
-        return str(self.org_id) + ':single-rules'
+        return self._keys['single-rules']
+
+    def _queue_ticket_counter(self):
+        """Returns the name of the counter used to order queued objects."""
+        return self._keys['queue-ticket']
+
+    def _user_queues_set(self, user_id):
+        """Returns the name of the set of days a user is waiting to borrow.
+
+        Days are stored by their day score so the set stays an intset.
+        """
+        return self._key_prefix + 'user-queues:' + str(user_id)
+
+    def _pass_queues_set(self, pass_id):
+        """Returns the name of the set of days a pass is waiting to be lent."""
+        return self._key_prefix + 'pass-queues:' + str(pass_id)
+
+    def _token_hash(self, ty, id):
+        if ty == ObjType.User:
+            return self._user_token_hash(id)
+        elif ty == ObjType.Pass:
+            return self._pass_token_hash(id)
+        else:
+            return None
 
-    def _token_hash(self, ty):
+    def _obj_queues_set(self, ty, id):
         if ty == ObjType.User:
-            return self._user_token_hash()
+            return self._user_queues_set(id)
         elif ty == ObjType.Pass:
-            return self._pass_token_hash()
+            return self._pass_queues_set(id)
         else:
             return None
 
@@ -162,64 +374,105 @@ class LiveOrg:
     # Functions for a worker
     ###
 
-    def cycle_active_queue(self):
-        """Returns a queue that needs to be processed.
+    def cycle_active_queue(self, today=None):
+        """Returns the most urgent queue that needs to be processed.
 
-        The result is pumped atomically using the redis command RPOPLPUSH, which
-        means the queues will eventually repeat but multiple workers can call
-        this all at once, etc.
+        Active queues are scheduled by date so the nearest day always comes
+        first, multiple workers can call this all at once, etc. Queues of days
+        before today are retired along the way and so are days whose queues
+        turn out to be empty.
 
-        Returns the string name of a queue.
+        Returns the date string of a queue, or None if there is nothing to do.
 
         """
-        return self.r.rpoplpush(
-            self._active_queue_list(), self._active_queue_list()
-        )
+        if today is None:
+            today = self.date_util.today()
+        today_score = _day_score(date_to_str(today))
 
-    def reconcile_active_queue(self):
-        def find_missing_queues(pipe):
-            # Get the contents of the list
-            length = self.r.llen(self._active_queue_list())
-            contents = self.r.lrange(self._active_queue_list(), 0, length)
+        self._retire_past_queues(today_score)
 
-            pipe.multi()
+        while True:
+            upcoming = self.r.zrangebyscore(
+                self._active_queue_schedule(), today_score, '+inf', 0, 1
+            )
+            if len(upcoming) == 0:
+                return None
 
-            # Clear the temporary set.
-            # As long as the list doesn't change we don't need to worry, the set
-            # will not have duplicates, etc.
-            pipe.delete(self._active_queue_temp_set())
+            day_str = upcoming[0].decode('utf-8')
+            if not self._deactivate_day_queue(str_to_date(day_str)):
+                return day_str
 
-            # Add the contents of the active queue *list* to this temporary set.
-            pipe.sadd(self._active_queue_temp_set(), *contents)
+    def reconcile_active_queue(self, full=False):
+        """Makes sure the active queue set and schedule agree.
 
-            # Check if any elements are in the set but not the list.
-            pipe.sdiff(self._active_queue_diff_set(),
-                       self._active_queue_set(),
-                       self._active_queue_temp_set())
+        Only days activated or deactivated since the last reconciliation are
+        looked at. Those days are claimed atomically so several workers can
+        call this as often as they like without checking the same day twice,
+        and if nothing changed since this LiveOrg last reconciled it costs a
+        single GET. Pass full=True to check every active day instead, for
+        example to recover after the dirty markers were lost.
 
-        # Watch the list, if it changes, it's all over. Furthermore, if the set
-        # changes, we need to give it time for the list to change too so we
-        # don't think its not there when it was going to eventually be there and
-        # we just added a queue twice. Honestly this isn't the end of the world,
-        # because it will eventually be removed (hopefully).
-        num_missing = self.r.transaction(find_missing_queues,
-                                         self._active_queue_list(),
-                                         self._active_queue_set())[2]
+        Returns the number of days that had to be fixed.
+        """
+        changes = self.r.get(self._active_queue_change_counter())
+        if not full and changes is not None and \
+                changes == self.reconciled_changes:
+            return 0
+
+        # Claim the days that changed.
+        pipe = self.r.pipeline()
+        pipe.smembers(self._active_queue_dirty_set())
+        pipe.delete(self._active_queue_dirty_set())
+        days = pipe.execute()[0]
+
+        if full:
+            days |= self.r.smembers(self._active_queue_set())
+            days.update(self.r.zrange(self._active_queue_schedule(), 0, -1))
+
+        self.reconciled_changes = changes
+        if len(days) == 0:
+            return 0
+
+        days = [day.decode('utf-8') for day in days]
+
+        if self.use_scripts:
+            return scripts.reconcile_active_days(
+                self.r, keys=[self._active_queue_set(),
+                              self._active_queue_schedule()], args=days
+            )
 
-        def add_missing_queues(pipe):
-            # Add the elements missing from the list to the list.
-            contents = pipe.smembers(self._active_queue_diff_set())
+        def reconcile_days(pipe):
+            reads = self.r.pipeline(transaction=False)
+            for day_str in days:
+                reads.sismember(self._active_queue_set(), day_str)
+                reads.zscore(self._active_queue_schedule(), day_str)
+            res = reads.execute()
 
             pipe.multi()
-            pipe.lpush(self._active_queue_list(), *contents)
-            pipe.execute()
 
-        if num_missing > 0:
-            # If members were missing we need to add them!
-            self.r.transaction(add_missing_queues,
-                               self._active_queue_diff_set(),
-                               self._active_queue_set(),
-                               self._active_queue_list())
+            fixed = 0
+            for day_str, is_active, score in zip(days, res[::2], res[1::2]):
+                if is_active and score is None:
+                    # Active but never going to be processed.
+                    pipe.zadd(self._active_queue_schedule(),
+                              _day_score(day_str), day_str)
+                    fixed += 1
+                elif not is_active and score is not None:
+                    # Processed without being active.
+                    pipe.zrem(self._active_queue_schedule(), day_str)
+                    fixed += 1
+            return fixed
+
+        # If either changes under us we could undo an activation or
+        # deactivation that just happened.
+        return self.r.transaction(reconcile_days, self._active_queue_set(),
+                                  self._active_queue_schedule(),
+                                  value_from_callable=True)
+
+    def _mark_days_changed(self, pipe, *day_strs):
+        """Records days whose activation changed for reconcile_active_queue."""
+        pipe.sadd(self._active_queue_dirty_set(), *day_strs)
+        pipe.incrby(self._active_queue_change_counter(), len(day_strs))
 
     ###
     # Functions for web service
@@ -227,36 +480,89 @@ class LiveOrg:
     def _activate_day_queue(self, day):
         day_str = date_to_str(day)
 
+        if self.use_scripts:
+            scripts.activate_day_queue(
+                self.r, keys=[self._active_queue_set(),
+                              self._active_queue_schedule(),
+                              self._active_queue_dirty_set(),
+                              self._active_queue_change_counter()],
+                args=[day_str]
+            )
+            return
+
         def activate_queue(pipe):
             # Is this queue already active?
             is_member = pipe.sismember(self._active_queue_set(), day_str)
 
             pipe.multi()
             if is_member == 0:
-                # Add the date to the set and list
+                # Add the date to the set and schedule
                 pipe.sadd(self._active_queue_set(), day_str)
-                pipe.lpush(self._active_queue_list(), day_str)
+                pipe.zadd(self._active_queue_schedule(), _day_score(day_str),
+                          day_str)
+                self._mark_days_changed(pipe, day_str)
 
-        self.r.transaction(activate_queue,
-                           self._active_queue_set(),
-                           self._active_queue_list())
+        self.r.transaction(activate_queue, self._active_queue_set())
 
     def _deactivate_day_queue(self, day):
+        """Deactivates the queues of a day, as long as they are empty.
+
+        Returns whether or not the day was deactivated.
+        """
         day_str = date_to_str(day)
+        borrow_queue = self._borrow_queue(day)
+        lend_queue = self._lend_queue(day)
+
+        if self.use_scripts:
+            return scripts.deactivate_day_queue(
+                self.r, keys=[self._active_queue_set(),
+                              self._active_queue_schedule(), borrow_queue,
+                              lend_queue, self._active_queue_dirty_set(),
+                              self._active_queue_change_counter()],
+                args=[day_str]
+            ) == 1
 
         def deactivate_queue(pipe):
-            # Is this queue active?
-            is_member = pipe.sismember(self._active_queue_set(), day_str)
+            # Someone is still waiting on this day
+            if pipe.zcard(borrow_queue) > 0 or pipe.zcard(lend_queue) > 0:
+                return False
 
             pipe.multi()
-            if is_member == 1:
-                # Remove the date to the set and list
-                pipe.srem(self._active_queue_set(), day_str)
-                pipe.lrem(self._active_queue_list(), 1, day_str)
+            # Remove the date from the set and schedule
+            pipe.srem(self._active_queue_set(), day_str)
+            pipe.zrem(self._active_queue_schedule(), day_str)
+            self._mark_days_changed(pipe, day_str)
+            return True
+
+        return self.r.transaction(deactivate_queue, borrow_queue, lend_queue,
+                                  value_from_callable=True)
+
+    def _retire_past_queues(self, today_score):
+        """Unschedules the queues of every day before today.
+
+        The queues themselves are left alone, they are history now.
+        """
+        if self.use_scripts:
+            scripts.retire_past_queues(
+                self.r, keys=[self._active_queue_set(),
+                              self._active_queue_schedule(),
+                              self._active_queue_dirty_set(),
+                              self._active_queue_change_counter()],
+                args=[today_score]
+            )
+            return
 
-        self.r.transaction(deactivate_queue,
-                           self._active_queue_set(),
-                           self._active_queue_list())
+        def retire(pipe):
+            past = pipe.zrangebyscore(self._active_queue_schedule(), '-inf',
+                                      '({}'.format(today_score))
+
+            pipe.multi()
+            if len(past) > 0:
+                pipe.srem(self._active_queue_set(), *past)
+                pipe.zrem(self._active_queue_schedule(), *past)
+                self._mark_days_changed(pipe, *past)
+
+        self.r.transaction(retire, self._active_queue_schedule())
 
     def obj_token(self, ty, id, r=None):
         """Returns the token of an object given its ID and type.
@@ -268,15 +574,15 @@ class LiveOrg:
             r = self.r
 
         # Which hash has our token?
-        hash_str = self._token_hash(ty)
+        hash_str = self._token_hash(ty, id)
         if hash_str is None:
             return None
 
         # Add a token if it's not already there.
-        r.hsetnx(hash_str, str(id), 1)
+        r.hsetnx(hash_str, _token_field(id), 1)
 
         # Query the token
-        return r.hget(hash_str, str(id))
+        return r.hget(hash_str, _token_field(id))
 
     def live_obj(self, ty, id, r=None):
         """Returns a live object (with a token) from an ID and type."""
@@ -305,47 +611,47 @@ class LiveOrg:
         either that or I just need sleep.
 
         """
+        queue_index = _queue_index(queue_name)
+        token_hash = self._token_hash(obj_type, obj_id)
+        token_field = _token_field(obj_id)
+
+        if self.use_scripts:
+            return scripts.refresh_obj_token(
+                self.r, keys=[queue_name, queue_index, token_hash,
+                              self._queue_ticket_counter()],
+                args=[obj_id, token_field]
+            )
 
         def refresh_obj(pipe):
+            # Objects without a token start at 1 before it is bumped, like the
+            # script does.
+            token = int(pipe.hget(token_hash, token_field) or 1) + 1
 
-            # Get the current user token
-            old_token = self.obj_token(obj_type, obj_id, r=pipe)
-
-            # Update the token
-            pipe.hincrby(self._token_hash(obj_type), str(obj_id), 1)
+            # Is the object sitting in the queue?
+            queued = pipe.hexists(queue_index, str(obj_id))
 
-            # What's the new object supposed to look like?
-            new_obj = self.live_obj(obj_type, obj_id, r=pipe)
-
-            # Get the current state of the queue
-            length = pipe.llen(queue_name)
-            queue_contents = pipe.lrange(queue_name, 0, length)
+            if queued:
+                # Make sure we move them to the back of the queue, if they
+                # refreshed their token it means they should go to the back
+                # of the line.
+                ticket = int(pipe.get(self._queue_ticket_counter()) or 0) + 1
 
             pipe.multi()
 
-            for obj_str in queue_contents:
-                # Get the ID and token from the string
-                cur_obj = LiveObj.fromstring(obj_str)
-                if cur_obj.id == new_obj.id and cur_obj.token != new_obj.token:
-                    # The object needs to be updated, because its token doesn't
-                    # match the new token we were given.
-
-                    if cur_obj.token != old_token and old_token != None:
-                        # We don't recognize this token!
-                        # TODO: Add a stderr warning here.
-                        pass
-
-                    # Make sure we move them to the back of the queue, if they
-                    # refreshed their token it means they should go to the back
-                    # of the line.
-
-                    # Remove the object.
-                    pipe.lrem(queue_name, 0, obj_str)
+            # Update the token
+            pipe.hset(token_hash, token_field, token)
 
-                    # Add the obj to the back of the queue with a new token.
-                    pipe.lpush(queue_name, bytes(new_obj))
+            if queued:
+                pipe.incr(self._queue_ticket_counter())
+                pipe.zadd(queue_name, ticket, str(obj_id))
+                pipe.hset(queue_index, str(obj_id), token)
+            return token
 
-        self.r.transaction(refresh_obj, queue_name)
+        # Nothing is written before MULTI, the token and tickets are watched so
+        # nothing else can take them before ours go through.
+        return self.r.transaction(refresh_obj, queue_index, token_hash,
+                                  self._queue_ticket_counter(),
+                                  value_from_callable=True)
 
     def refresh_user(self, date, user_id):
         """Updates a borrow token and moves it to the back of the queue."""
@@ -356,97 +662,259 @@ class LiveOrg:
     def refresh_pass(self, date, pass_id):
         """Updates a lend token and moves it to the back of the queue."""
         self._refresh_obj_token(
-            self._borrow_queue(date), ObjType.Pass, pass_id
+            self._lend_queue(date), ObjType.Pass, pass_id
         )
 
-    def _enqueue_obj(self, queue, obj, check_existing=True):
-        """Adds an object to a queue, if it doesn't already exist.
+    def _enqueue_days(self, dates, queue_name, obj_type, obj_id):
+        """Activates the queue of every date and enqueues an object onto them.
 
-        Returns whether or not the object was enqueued, if this is false it
-        means the object was already in the queue, which is fine, it was left
-        where it was.
+        queue_name is a function that returns the name of a day's queue.
+
+        Returns a dict mapping each date to whether or not the object was
+        enqueued, if this is false it means the object was already in the
+        queue, which is fine, it was left where it was.
         """
+        dates = list(dates)
+        if len(dates) == 0:
+            return {}
+
+        day_strs = [date_to_str(date) for date in dates]
+        queues = [queue_name(date) for date in dates]
+        indices = [_queue_index(queue) for queue in queues]
+        token_hash = self._token_hash(obj_type, obj_id)
+        token_field = _token_field(obj_id)
+        obj_queues = self._obj_queues_set(obj_type, obj_id)
+
+        if self.use_scripts:
+            keys = [self._active_queue_set(), self._active_queue_schedule(),
+                    token_hash, obj_queues, self._queue_ticket_counter(),
+                    self._active_queue_dirty_set(),
+                    self._active_queue_change_counter()]
+            for queue, queue_index in zip(queues, indices):
+                keys.extend([queue, queue_index])
+
+            enqueued = scripts.enqueue_obj_days(
+                self.r, keys=keys,
+                args=[obj_id, token_field] + day_strs
+            )
+            return {date: res == 1 for date, res in zip(dates, enqueued)}
 
         def enqueue(pipe):
-            if check_existing:
-                exists = _obj_exists(pipe, queue, obj)
-            else:
-                exists = False
+            # Read everything we need in one round trip. This doesn't go
+            # through pipe but the keys it is watching still protect us,
+            # nothing is written until the transaction below.
+            reads = self.r.pipeline(transaction=False)
+            reads.hget(token_hash, token_field)
+            reads.get(self._queue_ticket_counter())
+            for day_str in day_strs:
+                reads.sismember(self._active_queue_set(), day_str)
+            for queue_index in indices:
+                reads.hexists(queue_index, str(obj_id))
+            res = reads.execute()
+
+            # Objects without a token start at 1, like the script does.
+            token = int(res[0] or 1)
+            ticket = int(res[1] or 0)
+            active = res[2:2 + len(dates)]
+            exists = res[2 + len(dates):]
+
+            pipe.multi()
+
+            pipe.hsetnx(token_hash, token_field, 1)
+
+            for day_str, is_active in zip(day_strs, active):
+                if not is_active:
+                    # Add the date to the set and schedule
+                    pipe.sadd(self._active_queue_set(), day_str)
+                    pipe.zadd(self._active_queue_schedule(),
+                              _day_score(day_str), day_str)
+                    self._mark_days_changed(pipe, day_str)
 
-            if not exists:
-                # Add the object to the back of the queue
+            num_enqueued = 0
+            for day_str, queue, queue_index, queued in zip(day_strs, queues,
+                                                           indices, exists):
+                if queued:
+                    continue
 
-                ### IMPORTANT ### IMPORTANT ### IMPORTANT
-                # The left side of the list is considered the back of the queue.
-                # Don't forget to pop from the right with rpop.
-                ### IMPORTANT ### IMPORTANT ### IMPORTANT
+                # Add the object to the back of the queue, the highest ticket
+                # is the back.
+                num_enqueued += 1
+                pipe.zadd(queue, ticket + num_enqueued, str(obj_id))
 
-                pipe.lpush(queue, bytes(obj))
+                # Keep the indices in sync with the queue.
+                pipe.hset(queue_index, str(obj_id), token)
+                pipe.sadd(obj_queues, _day_score(day_str))
 
-                return True
-            return False
+            if num_enqueued > 0:
+                pipe.incrby(self._queue_ticket_counter(), num_enqueued)
 
-        return self.r.transaction(enqueue, queue, value_from_callable=True)
+            return {date: not queued for date, queued in zip(dates, exists)}
 
-    def _dequeue_obj(self, queue, obj):
-        """Removes an object from a queue.
+        # Tickets are taken in the transaction too, so the counter is watched
+        # along with the token. Enqueues onto any queue of the org can make
+        # each other retry, the script doesn't have that problem.
+        return self.r.transaction(enqueue, self._active_queue_set(),
+                                  token_hash, self._queue_ticket_counter(),
+                                  *indices, value_from_callable=True)
 
-        Returns whether or not the object was removed.
+    def _dequeue_days(self, dates, queue_name, obj_type, obj_id):
+        """Removes an object from the queue of every date.
+
+        The object is found by its id, whatever token it was queued with.
+
+        Returns a dict mapping each date to whether or not the object was
+        removed.
         """
+        dates = list(dates)
+        if len(dates) == 0:
+            return {}
+
+        day_strs = [date_to_str(date) for date in dates]
+        queues = [queue_name(date) for date in dates]
+        indices = [_queue_index(queue) for queue in queues]
+        obj_queues = self._obj_queues_set(obj_type, obj_id)
+
+        if self.use_scripts:
+            keys = [obj_queues]
+            for queue, queue_index in zip(queues, indices):
+                keys.extend([queue, queue_index])
+
+            dequeued = scripts.dequeue_obj_days(
+                self.r, keys=keys, args=[obj_id] + day_strs
+            )
+            return {date: res == 1 for date, res in zip(dates, dequeued)}
+
+        # Removing by id doesn't depend on anything we would have to read
+        # first, so there is nothing to watch.
+        pipe = self.r.pipeline()
+        for day_str, queue, queue_index in zip(day_strs, queues, indices):
+            pipe.hdel(queue_index, str(obj_id))
+            pipe.zrem(queue, str(obj_id))
+            pipe.srem(obj_queues, _day_score(day_str))
+        res = pipe.execute()
+
+        # Look at what HDEL returned for every day.
+        return {date: removed == 1 for date, removed in zip(dates, res[::3])}
+
+    def _queue_positions(self, dates, queue_name, obj_id):
+        """Finds where an object is in the queue of every date.
+
+        Returns a dict mapping each date to a (position, depth) tuple. Position
+        starts at one for the front of the queue and is None if the object
+        isn't queued, depth is the length of the queue.
+        """
+        dates = list(dates)
 
-        # TODO: Remove objects with an old token (do this by searching the
-        # list and looking at every obj. We could issue a warning if the token
-        # is different.
-        # TODO: Remove objects by ID, not entire object because that would be
-        # dependent on the token, etc.
-        removed = self.r.lrem(queue, 1, bytes(obj))
-        return True if removed > 0 else False
+        pipe = self.r.pipeline(transaction=False)
+        for date in dates:
+            pipe.zrank(queue_name(date), str(obj_id))
+            pipe.zcard(queue_name(date))
+        res = pipe.execute()
 
-    def enqueue_user_borrow(self, date, user_id):
-        # Active the queue if necessary
-        self._activate_day_queue(date)
-        # Enqueue the user onto the borrow queue
-        return self._enqueue_obj(
-            self._borrow_queue(date), self.live_user(user_id)
+        positions = {}
+        for date, rank, depth in zip(dates, res[::2], res[1::2]):
+            positions[date] = (None if rank is None else rank + 1, depth)
+        return positions
+
+    def _drop_obj(self, queue_name, obj_type, obj_id, since=None):
+        """Removes an object from every queue it is waiting in.
+
+        Only the queues of days from since onward, today by default, are
+        touched so that we don't rewrite history.
+
+        Returns a sorted list of the dates the object was removed from.
+        """
+        if since is None:
+            since = self.date_util.today()
+        since_score = _day_score(date_to_str(since))
+
+        # The reverse index knows every day the object is queued on, so there
+        # is no need to go through every active day.
+        day_scores = sorted(
+            score for score in (
+                int(day) for day in
+                self.r.smembers(self._obj_queues_set(obj_type, obj_id))
+            ) if score >= since_score
         )
 
-    def dequeue_user_borrow(self, date, user_id):
-        # TODO: Deactivate the queue if necessary (if it's empty).
-        # Dequeue the pass from the borrow queue
-        return self._dequeue_obj(
-            self._borrow_queue(date), self.live_user(user_id)
+        dequeued = self._dequeue_days(
+            [str_to_date(_score_day(score), self.timezone)
+             for score in day_scores],
+            queue_name, obj_type, obj_id
         )
+        return sorted(date for date, removed in dequeued.items() if removed)
 
-    def enqueue_pass_lend(self, date, pass_id):
-        # Active the queue if necessary
-        self._activate_day_queue(date)
-        # Enqueue the pass onto the lend queue
-        return self._enqueue_obj(
-            self._lend_queue(date), self.live_pass(pass_id)
+    def enqueue_user_borrow_days(self, dates, user_id):
+        """Enqueues the user onto the borrow queue of every date."""
+        return self._enqueue_days(
+            dates, self._borrow_queue, ObjType.User, user_id
         )
 
-    def dequeue_pass_lend(self, date, pass_id):
-        # TODO: Deactivate the queue if necessary (if it's empty).
-        # Dequeue the pass from the lend queue
-        return self._dequeue_obj(
-            self._lend_queue(date), self.live_pass(pass_id)
+    def dequeue_user_borrow_days(self, dates, user_id):
+        """Dequeues the user from the borrow queue of every date.
+
+        Queues left empty are deactivated when the worker comes across them.
+        """
+        return self._dequeue_days(
+            dates, self._borrow_queue, ObjType.User, user_id
         )
 
+    def enqueue_pass_lend_days(self, dates, pass_id):
+        """Enqueues the pass onto the lend queue of every date."""
+        return self._enqueue_days(
+            dates, self._lend_queue, ObjType.Pass, pass_id
+        )
+
+    def dequeue_pass_lend_days(self, dates, pass_id):
+        """Dequeues the pass from the lend queue of every date.
+
+        Queues left empty are deactivated when the worker comes across them.
+        """
+        return self._dequeue_days(
+            dates, self._lend_queue, ObjType.Pass, pass_id
+        )
+
+    def drop_user_borrows(self, user_id, since=None):
+        """Removes the user from every borrow queue from since onward."""
+        return self._drop_obj(
+            self._borrow_queue, ObjType.User, user_id, since
+        )
+
+    def drop_pass_lends(self, pass_id, since=None):
+        """Removes the pass from every lend queue from since onward."""
+        return self._drop_obj(
+            self._lend_queue, ObjType.Pass, pass_id, since
+        )
+
+    def user_borrow_positions(self, dates, user_id):
+        """Finds the user's place in the borrow queue of every date."""
+        return self._queue_positions(dates, self._borrow_queue, user_id)
+
+    def enqueue_user_borrow(self, date, user_id):
+        return self.enqueue_user_borrow_days([date], user_id)[date]
+
+    def dequeue_user_borrow(self, date, user_id):
+        return self.dequeue_user_borrow_days([date], user_id)[date]
+
+    def enqueue_pass_lend(self, date, pass_id):
+        return self.enqueue_pass_lend_days([date], pass_id)[date]
+
+    def dequeue_pass_lend(self, date, pass_id):
+        return self.dequeue_pass_lend_days([date], pass_id)[date]
+
     def set_state_sequence(self, state_ids):
         # We're using a string here because we don't really want a redis list.
         # The states list shouldn't get too big and it's more convenient to just
         # modify it in memory.
         state_ids = map(lambda x: str(x), state_ids)
-        self.r.set(self._daystate_sequence(), ','.join(state_ids))
+
+        pipe = self.r.pipeline()
+        pipe.set(self._daystate_sequence(), ','.join(state_ids))
+        pipe.incr(self._schedule_version())
+        pipe.execute()
 
     def get_state_sequence(self):
-        try:
-            seq = self.r.get(self._daystate_sequence())
-            if seq is None:
-                return []
-            return list(map(lambda x: int(x), seq.decode('utf-8').split(',')))
-        except ValueError:
-            return []
+        return _parse_state_sequence(self.r.get(self._daystate_sequence()))
 
     def push_fixed_daystate(self, new_fixed_daystate):
         """Fixes a date to a particular day state
@@ -455,7 +923,17 @@ class LiveOrg:
         newest fix in the list.
         """
         daystate_queue = self._fixed_daystates_list()
-        current_state_cache = self._current_state_cache()
+        schedule_version = self._schedule_version()
+
+        if self.use_scripts:
+            pushed = scripts.push_fixed_daystate(
+                self.r, keys=[daystate_queue, schedule_version],
+                args=[str(new_fixed_daystate)]
+            )
+            if pushed == 0:
+                raise InvalidFixDate()
+            self.open_rule_bucket(new_fixed_daystate.date)
+            return
 
         def do_push(pipe):
             # Make sure the new date is more recent then the previous date in
@@ -465,9 +943,12 @@ class LiveOrg:
 
             if current_fix is not None:
                 current_fixed_daystate = FixedDaystate.fromstring(
-                    current_fix, self.timezone
+                    current_fix.decode('utf-8'), self.timezone
                 )
-                if new_fixed_daystate.date < current_fixed_daystate.date:
+                # Compare calendar days, the new fix isn't necessarily
+                # localized.
+                if (date_to_str(new_fixed_daystate.date) <
+                        date_to_str(current_fixed_daystate.date)):
                     # The new fix comes before the one already there.
 
                     # Either throw an error or adjust the last fix to match
@@ -477,14 +958,12 @@ class LiveOrg:
 
             pipe.multi()
 
-            # Remove all cached daystate ids from the new fixed daystate onward.
-            pipe.zremrangebyscore(
-                current_state_cache, new_fixed_daystate.date.timestamp(), '+inf'
-            )
             # Push the new daystate
             pipe.lpush(daystate_queue, str(new_fixed_daystate))
+            pipe.incr(schedule_version)
 
-        self.r.transaction(do_push, daystate_queue, current_state_cache)
+        self.r.transaction(do_push, daystate_queue)
+        self.open_rule_bucket(new_fixed_daystate.date)
 
     def get_last_fixed_daystate(self):
         return FixedDaystate.fromstring(
@@ -492,45 +971,184 @@ class LiveOrg:
             self.timezone
         )
 
-    def push_rule_set(self, rule_set: rules.RuleSet):
-        def rule_str(rs, timestamp):
-            new_rules = rs.rules
-            if not isinstance(rs.rules, list):
-                # Make sure we have a list of rules instead of a single value.
-                new_rules = [rs.rules]
-            return msgpack.packb([rs._replace(rules=new_rules), timestamp])
-
+    def push_rule_set(self, rule_set: rules.RuleSet, effective_date=None):
+        """Adds a rule set. A reoccurring rule set replaces the one with the
+        same pattern, if there is one, from effective_date on (or on every
+        day)."""
         if rules.pattern_reoccurs(rule_set.pattern):
-            # Push to the top of the reoccurring rules list
-            # Use the current UTC timestamp because we don't want daylight
-            # savings or other stupid time oddity to cause a duplicate.
-            time = int(datetime.now(pytz.utc).timestamp())
-            self.r.lpush(
-                self._reoccurring_rule_list(), rule_str(rule_set, time)
-            )
-
+            self._set_reoccurring_rule_set(rule_set, effective_date)
         else:
             # Add the one-day pattern to the set sorting by timestmap.
             time = int(str_to_date(rule_set.pattern, self.timezone).timestamp())
             # Add the timestamp to the rule set and add it to the sorted set.
-            self.r.zadd(
-                self._single_use_rule_bucket(), time, rule_str(rule_set, time)
+            pipe = self.r.pipeline()
+            pipe.zadd(
+                self._single_use_rule_bucket(), time,
+                _pack_rule_set(rule_set, time)
             )
+            pipe.incr(self._schedule_version())
+            pipe.execute()
 
-    def _strip_time_stamp_from_msgpack(self, rule_sets_in):
-        rule_sets = []
-        for item in rule_sets_in:
-            # Strip out the timestamp from all the input rule sets.
-            rule_sets.append(item[0])
+    def put_rule_set(self, rule_set: rules.RuleSet, effective_date=None):
+        """Adds a rule set, replacing any rule set with the same pattern in
+        one go. Reoccurring rule sets only change from effective_date on, if
+        it is given."""
+        if rules.pattern_reoccurs(rule_set.pattern):
+            self._set_reoccurring_rule_set(rule_set, effective_date)
+        else:
+            time = int(str_to_date(rule_set.pattern, self.timezone).timestamp())
+            pipe = self.r.pipeline()
+            pipe.zremrangebyscore(self._single_use_rule_bucket(), time, time)
+            pipe.zadd(
+                self._single_use_rule_bucket(), time,
+                _pack_rule_set(rule_set, time)
+            )
+            pipe.incr(self._schedule_version())
+            pipe.execute()
 
-        return rule_sets
+    def _set_reoccurring_rule_set(self, rule_set, effective_date=None):
+        # Use the current UTC timestamp because we don't want daylight
+        # savings or other stupid time oddity to cause a duplicate.
+        time = int(datetime.now(pytz.utc).timestamp())
 
-    def get_reoccurring_rule_sets(self, convert=True):
-        res = self.r.lrange(self._reoccurring_rule_list(), 0, -1)
+        # The newest rule set matches first, the order has to be taken before
+        # the transaction. Skipping an order doesn't hurt.
+        order = self.r.incr(self._reoccurring_rule_order())
+        packed = _pack_rule_set(rule_set, time, order)
+        if effective_date is not None:
+            self.open_rule_bucket(effective_date)
 
-        return rules.convert_rules(
-            self._strip_time_stamp_from_msgpack(res)
-        ) if convert else res
+        def do_set(pipe):
+            bucket_scores = self._rule_buckets_from(pipe, effective_date)
+            pipe.multi()
+            for bucket_score in bucket_scores:
+                pipe.hset(self._reoccurring_rule_hash(bucket_score),
+                          rule_set.pattern, packed)
+            pipe.incr(self._schedule_version())
+
+        self.r.transaction(do_set, self._rule_bucket_index())
+
+    def _rule_buckets_from(self, pipe, effective_date):
+        """Returns the scores of the buckets from a day on, or of every bucket
+        without one."""
+        if effective_date is None:
+            return self._rule_bucket_scores(pipe)
+
+        return [int(score) for score in pipe.zrangebyscore(
+            self._rule_bucket_index(), _day_score(date_to_str(effective_date)),
+            '+inf'
+        )]
+
+    def _rule_bucket_scores(self, r=None):
+        """Returns the sorted scores of the buckets that aren't archived."""
+        r = r or self.r
+        scores = r.zrange(self._rule_bucket_index(), 0, -1)
+        return [int(score) for score in scores] or [0]
+
+    def open_rule_bucket(self, day):
+        """Starts a bucket of reoccurring rule sets on a day, as a copy of the
+        bucket in effect on it. Nothing changes until rule sets are put from
+        that day on."""
+        day_score = _day_score(date_to_str(day))
+        index = self._rule_bucket_index()
+
+        def do_open(pipe):
+            bucket_scores = [int(score) for score in pipe.zrange(index, 0, -1)]
+            if day_score in bucket_scores:
+                return
+
+            from_hash = self._reoccurring_rule_hash(
+                _bucket_in_effect(bucket_scores or [0], day_score)
+            )
+            pipe.watch(from_hash)
+            rule_sets = pipe.hgetall(from_hash)
+
+            pipe.multi()
+            if len(bucket_scores) == 0:
+                pipe.zadd(index, 0, 0)
+            pipe.zadd(index, day_score, day_score)
+            to_hash = self._reoccurring_rule_hash(day_score)
+            for pattern, packed in rule_sets.items():
+                pipe.hset(to_hash, pattern, packed)
+
+        self.r.transaction(do_open, index)
+
+    def archive_rule_buckets(self, day):
+        """Archives the buckets that were followed by another one before a
+        day. Schedules are only built from the buckets that are left, days
+        before them are counted with the rules of the earliest one.
+
+        Returns how many buckets were archived.
+        """
+        day_score = _day_score(date_to_str(day))
+        index = self._rule_bucket_index()
+
+        def do_archive(pipe):
+            bucket_scores = self._rule_bucket_scores(pipe)
+            in_effect = _bucket_in_effect(bucket_scores, day_score)
+            archived = [score for score in bucket_scores if score < in_effect]
+
+            pipe.multi()
+            if len(archived) > 0:
+                pipe.zrem(index, *archived)
+                for score in archived:
+                    pipe.zadd(self._archived_rule_bucket_index(), score, score)
+                pipe.incr(self._schedule_version())
+            return len(archived)
+
+        return self.r.transaction(do_archive, index, value_from_callable=True)
+
+    def get_rule_bucket_days(self):
+        """Returns the first day of every bucket that isn't archived, None
+        for the bucket every org starts with."""
+        return [None if score == 0 else _score_day(score)
+                for score in self._rule_bucket_scores()]
+
+    def _strip_time_stamp_from_msgpack(self, rule_sets_in):
+        # Strip out the timestamp from all the input rule sets.
+        return [_unpack_rule_set(item)[0] for item in rule_sets_in]
+
+    def _sort_reoccurring_rule_sets(self, packed_rule_sets):
+        """Returns the reoccurring rule sets in the order they match, newest
+        first."""
+        ordered = []
+        for item in packed_rule_sets:
+            if item is None:
+                continue
+            rule_set, (time_stamp, order) = _unpack_rule_set(item)
+            ordered.append((order, rule_set))
+        ordered.sort(key=lambda x: x[0], reverse=True)
+        return [rule_set for order, rule_set in ordered]
+
+    def get_reoccurring_rule_sets(self, convert=True, date=None):
+        """Returns the reoccurring rule sets in the order they match, of the
+        bucket in effect on a day (archived or not) or of the newest bucket.
+        Rules are mappings, or strings if convert is False."""
+        rule_sets = self._sort_reoccurring_rule_sets(
+            self.r.hvals(self._reoccurring_rule_hash(
+                self._rule_bucket_score(date)
+            ))
+        )
+        return rule_sets if convert else _rule_strings(rule_sets)
+
+    def _rule_bucket_score(self, day=None):
+        if day is None:
+            newest = self.r.zrevrange(self._rule_bucket_index(), 0, 0)
+            return int(newest[0]) if len(newest) > 0 else 0
+
+        day_score = _day_score(date_to_str(day))
+        reads = self.r.pipeline()
+        for index in (self._rule_bucket_index(),
+                      self._archived_rule_bucket_index()):
+            reads.zrevrangebyscore(index, day_score, '-inf', start=0, num=1)
+        reads.zrange(self._rule_bucket_index(), 0, 0)
+        live, archived, earliest = reads.execute()
+
+        scores = [int(score) for score in live + archived]
+        if len(scores) > 0:
+            return max(scores)
+        # Days before every bucket go by the earliest one.
+        return int(earliest[0]) if len(earliest) > 0 else 0
 
     def get_single_use_rule_sets(self, start_time=None, end_time=None,
                                  convert=True):
@@ -544,45 +1162,95 @@ class LiveOrg:
             self._single_use_rule_bucket(), start_time, end_time
         )
 
-        return rules.convert_rules(
-            self._strip_time_stamp_from_msgpack(res)
-        ) if convert else res
+        rule_sets = self._strip_time_stamp_from_msgpack(res)
+        return rule_sets if convert else _rule_strings(rule_sets)
+
+    def get_single_use_rule_set_page(self, start_date=None, end_date=None,
+                                     cursor=None, limit=100, convert=True):
+        """Returns (rule sets, cursor of the next page) of the single-use rule
+        sets from start_date to end_date, oldest first and at most limit of
+        them. The cursor is None on the last page.
+
+        Only the rule sets of the page are read from redis and unpacked.
+        Raises InvalidRuleCursor if the cursor isn't one this returned.
+        """
+        # Every rule set of a day has the same score, so a cursor is the score
+        # to go on from and how many rule sets with that score came before.
+        min_score, skip = '-inf', 0
+        if start_date is not None:
+            min_score = int(start_date.timestamp())
+        if cursor is not None:
+            min_score, skip = _parse_rule_cursor(cursor)
+        max_score = '+inf'
+        if end_date is not None:
+            max_score = int(end_date.timestamp())
+
+        res = self.r.zrangebyscore(
+            self._single_use_rule_bucket(), min_score, max_score,
+            start=skip, num=limit + 1, withscores=True
+        )
+        page = res[:limit]
+
+        next_cursor = None
+        if len(res) > limit:
+            next_score = res[limit][1]
+            next_skip = sum(1 for item, score in page if score == next_score)
+            if next_score == min_score:
+                next_skip += skip
+            next_cursor = '{}:{}'.format(int(next_score), next_skip)
+
+        rule_sets = self._strip_time_stamp_from_msgpack(
+            [item for item, score in page]
+        )
+        return rule_sets if convert else _rule_strings(rule_sets), next_cursor
+
+    def remove_reoccuring_rule_set(self, pattern, effective_date=None):
+        """Removes a reoccurring rule set from effective_date on (or on every
+        day). Returns 1 if there was one to remove, otherwise 0."""
+        if effective_date is not None:
+            self.open_rule_bucket(effective_date)
 
-    def remove_reoccuring_rule_set(self, pattern):
-        reoccurring = self.get_reoccurring_rule_sets(convert=False)
-        indices=[i for i, rs in enumerate(reoccurring) if rs.pattern == pattern]
-        removed = 0
-        for i in indices:
-            # Find the value
-            element = self.r.lindex(indices)
-            # Remove it from the list
-            removed += self.r.lrem(self._reoccurring_rule_list(), 1, element);
+        def do_remove(pipe):
+            bucket_scores = self._rule_buckets_from(pipe, effective_date)
+            pipe.multi()
+            for bucket_score in bucket_scores:
+                pipe.hdel(self._reoccurring_rule_hash(bucket_score), pattern)
+            pipe.incr(self._schedule_version())
 
-        return removed
+        # One HDEL per bucket, then the version.
+        deleted = self.r.transaction(do_remove, self._rule_bucket_index())
+        return max(deleted[:-1])
 
     def remove_single_use_rule_set(self, date):
         if isinstance(date, str):
-            date = str_to_date(date)
+            date = str_to_date(date, self.timezone)
         time = date.timestamp()
-        return self.r.zremrangebyscore(
-            self._single_use_rule_bucket(), time, time
-        )
 
-    def remove_rule_set(self, pattern):
+        pipe = self.r.pipeline()
+        pipe.zremrangebyscore(self._single_use_rule_bucket(), time, time)
+        pipe.incr(self._schedule_version())
+        return pipe.execute()[0]
+
+    def remove_rule_set(self, pattern, effective_date=None):
         if rules.pattern_reoccurs(pattern):
-            self.remove_reoccuring_rule_set(pattern)
+            return self.remove_reoccuring_rule_set(pattern, effective_date)
         else:
-            self.remove_single_use_rule_set(pattern)
+            return self.remove_single_use_rule_set(pattern)
 
     def get_rule_set(self, date):
-        # Find the operative rule set for a particular day.
+        """Returns the operative rule set of a day, or None."""
+        return self.get_schedule().rule_set(date.date())
+
+    def _read_rule_set(self, date):
+        # Find the operative rule set for a particular day, straight from
+        # redis.
         start_time = date.timestamp()
         rule_sets = self.get_single_use_rule_sets(
             start_time, start_time + SECONDS_PER_DAY
         )
 
         # Add reoccurring dates that could match any given date
-        rule_sets.extend(self.get_reoccurring_rule_sets())
+        rule_sets.extend(self.get_reoccurring_rule_sets(date=date))
 
         # Return the first one that matches
         for rs in rule_sets:
@@ -592,50 +1260,154 @@ class LiveOrg:
         # No rule set matched
         return None
 
+    def get_schedule(self):
+        """Returns the compiled Schedule of this org.
+
+        The schedule is only read from redis again when the schedule version
+        changed since it was built, otherwise this is a single GET.
+        """
+        return self._get_schedule_cache().schedule
+
+    def _get_schedule_cache(self):
+        version = self.r.get(self._schedule_version())
+        cache = self._schedule_cache
+        if cache is not None and cache.schedule.version == version:
+            return cache
+
+        # The version is read along with the buckets, anything that changes
+        # while the rest is read bumps it and the schedule is built again next
+        # time.
+        reads = self.r.pipeline()
+        reads.get(self._schedule_version())
+        reads.zrange(self._rule_bucket_index(), 0, -1)
+        version, bucket_scores = reads.execute()
+        bucket_scores = [int(score) for score in bucket_scores] or [0]
+
+        reads = self.r.pipeline()
+        reads.get(self._daystate_sequence())
+        reads.lrange(self._fixed_daystates_list(), 0, -1)
+        reads.zrange(self._single_use_rule_bucket(), 0, -1)
+        for bucket_score in bucket_scores:
+            reads.hvals(self._reoccurring_rule_hash(bucket_score))
+        seq, fixes, single_use, *buckets = reads.execute()
+
+        single_use = self._strip_time_stamp_from_msgpack(single_use)
+        cache = ScheduleCache(Schedule(
+            version, _parse_state_sequence(seq),
+            [FixedDaystate.fromstring(fix.decode('utf-8'), self.timezone)
+             for fix in fixes],
+            [RuleBucket(date.min if bucket_score == 0 else
+                        str_to_date(_score_day(bucket_score)).date(),
+                        self._sort_reoccurring_rule_sets(reoccurring))
+             for bucket_score, reoccurring in zip(bucket_scores, buckets)],
+            [(str_to_date(rs.pattern).date(), rs) for rs in single_use]
+        ))
+        self._schedule_cache = cache
+        return cache
+
+    def daystate_cache_stats(self):
+        """Returns how many get_daystate_id calls could resume from a computed
+        daystate (hits) and how many had to start from a fix (misses)."""
+        return {
+            'hits': self.checkpoint_hits,
+            'misses': self.checkpoint_misses
+        }
+
     def get_daystate_id(self, target_date):
-        # Get the latest date in the cache already, if there is none use the
-        # last fixed daystate.
-
-        # Don't forget that what we get is actually id:timestamp where
-        # timestamp is the timestamp used as the score. This is used to prevent
-        # the state from being overwritten later on when the daystates go and
-        # repeat themselves.
-        latest_entry = self.r.zrevrank(self._current_state_cache(), -1)
-        if latest_entry is not None:
-            latest_state_id = int(latest_entry.split(':')[0])
-            cur_timestamp = self.r.zscore(latest_entry)
+        """Finds the daystate of a day.
+
+        Rather than going through every day since the daystate was fixed, the
+        days that move the sequence forward are counted a week at a time from
+        the reoccurring rules, and then corrected for the single-use rules in
+        between. This happens in memory against the compiled schedule.
+
+        Computed daystates are kept as checkpoints, the search starts from the
+        nearest one before the day instead of the fix when there is one.
+        """
+        cache = self._get_schedule_cache()
+        state_i, hit = cache.daystate_index(
+            target_date.date(), self.date_util.today().date(),
+            timedelta(days=self.checkpoint_window)
+        )
+        if hit:
+            self.checkpoint_hits += 1
         else:
-            # Use the most recent daystate
-            fixed_day = self.get_last_fixed_daystate()
-            cur_timestamp = fixed_day.date.timestamp()
-            latest_state_id = fixed_day.state_id
+            self.checkpoint_misses += 1
+        return None if state_i is None else cache.schedule.sequence[state_i]
+
+    def get_daystate_calendar(self, first_date, last_date):
+        """Returns a CalendarDay for every day from first_date to last_date.
+
+        The daystate of the first day is found like get_daystate_id, the rest
+        are found by going forward a day at a time. Calendars are cached until
+        the schedule changes.
+        """
+        cache = self._get_schedule_cache()
+        first_day = first_date.date()
+        return cache.calendar(first_day, last_date.date(),
+                              cache.schedule.daystate_index(first_day))
+
+    def get_spot_mapping(self, date):
+        """Returns the CompiledMapping of a day, which says where every pass
+        can park on it, or None when no rule set applies.
+
+        Mappings are compiled once per rule set and daystate and cached until
+        the schedule changes.
+        """
+        cache = self._get_schedule_cache()
+        day = date.date()
+        rule_set = cache.schedule.rule_set(day)
+        if rule_set is None:
+            return None
+
+        state_i, _ = cache.daystate_index(
+            day, self.date_util.today().date(),
+            timedelta(days=self.checkpoint_window)
+        )
+        state_id = None if state_i is None else cache.schedule.sequence[state_i]
+        return cache.mapping(rule_set, state_id)
+
+    def project_daystates(self, first_date, last_date):
+        """Returns (daystate ids, increment mask) arrays for every day from
+        first_date to last_date, see Schedule.project."""
+        return self.get_schedule().project(first_date.date(), last_date.date())
+
+    def simulate_changes(self, rule_sets, fixes, first_date, last_date):
+        """Returns a Simulation of the days from first_date to last_date that
+        would change if the rule sets were put and the fixes pushed. Nothing
+        is written, the changes are made to a copy of the schedule."""
+        return simulate(self.get_schedule(), rule_sets, fixes,
+                        first_date.date(), last_date.date())
+
+    def _walk_daystate_id(self, target_date):
+        """Finds the daystate of a day by going through every day since the
+        last fix, one by one.
+
+        This is much slower than get_daystate_id and only kept around to check
+        it against.
+        """
+        fixed_day = self.get_last_fixed_daystate()
 
         # Find list of daystates
         daystate_seq = self.get_state_sequence()
         # Find the starting index
-        curstate_i = daystate_seq.index(latest_state_id)
+        curstate_i = daystate_seq.index(fixed_day.state_id)
 
-        # Now move forward by a day, we already know today's daystate.
-        cur_timestamp += SECONDS_PER_DAY
+        # Now move forward by a day, we already know the fixed day's daystate.
+        cur_day = fixed_day.date.date() + timedelta(days=1)
 
         # Go forward day by day looking at the operative rule set, counting the
         # amount of times it needs to be incremented.
-        while cur_timestamp < target_date.timestamp() + SECONDS_PER_DAY:
+        while cur_day <= target_date.date():
             # Get the rule set for this day
             current_date = self.timezone.localize(
-                datetime.fromtimestamp(cur_timestamp)
+                datetime(cur_day.year, cur_day.month, cur_day.day)
             )
-            rule_set = self.get_rule_set(current_date)
-            if rule_set.incrday:
+            rule_set = self._read_rule_set(current_date)
+            if rule_set is not None and rule_set.incrday:
                 curstate_i = (curstate_i + 1) % len(daystate_seq)
 
-            # Cache the daystate on this day (after processing incrday).
-            # Find some way to add NX in there which prevents new items from
-            # being created, but redis-py doesn't support it.
-            self.r.zadd(self._current_state_cache(), cur_timestamp,
-                        '{}:{}'.format(curstate_i, cur_timestamp))
-
             # Move on to the next day
-            cur_timestamp += SECONDS_PER_DAY
+            cur_day += timedelta(days=1)
 
         return daystate_seq[curstate_i]
@@ -0,0 +1,137 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+import threading
+from collections import OrderedDict
+
+
+class LiveOrgRegistry:
+    """Keeps the LiveOrgs of recently used orgs around.
+
+    Building a LiveOrg means fetching the org and looking up its timezone,
+    which is wasted work when the same few orgs are asked for on every
+    request. Only the max_size most recently used orgs are kept.
+
+    LiveOrgs are tagged with the version of their org they were built at, see
+    org_version_key, and are only handed out while it is still the version of
+    the org.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.live_orgs = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Bumped on every invalidation so a LiveOrg that was being built while
+        # its org changed doesn't make it into the registry.
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, org_id, make_live_org, version=None):
+        """Returns the LiveOrg of an org, calling make_live_org() to build it
+        if it isn't in the registry at this org version."""
+        with self.lock:
+            entry = self.live_orgs.get(org_id)
+            if entry is not None and entry[0] == version:
+                self.live_orgs.move_to_end(org_id)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            generation = self.generation
+
+        # Don't hold the lock while the org is looked up.
+        live_org = make_live_org()
+
+        with self.lock:
+            if generation == self.generation:
+                self.live_orgs[org_id] = (version, live_org)
+                self.live_orgs.move_to_end(org_id)
+                while len(self.live_orgs) > self.max_size:
+                    self.live_orgs.popitem(last=False)
+
+        return live_org
+
+    def invalidate(self, org_id):
+        """Forgets the LiveOrg of an org, for example after its timezone
+        changed."""
+        with self.lock:
+            self.live_orgs.pop(org_id, None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.live_orgs.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self.live_orgs)
+
+
+class EligibilityCache:
+    """Keeps who may park where on recently asked for days of each org.
+
+    Entries are tagged with the version they were computed at, the schedule
+    version of the org along with the version of its passes (see
+    passes_version_key), and are only handed out while it is still the version
+    of the org. invalidate forgets every day of an org right away.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Bumped on every invalidation (of an org), like LiveOrgRegistry.
+        self.generation = 0
+        self.org_generations = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, org_id, day, version, compute):
+        """Returns the eligibility of an org on a day, calling compute() when
+        it isn't cached at this version."""
+        key = (org_id, day)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            generation = self._generation(org_id)
+
+        eligibility = compute()
+
+        with self.lock:
+            if generation == self._generation(org_id):
+                self.entries[key] = (version, eligibility)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+        return eligibility
+
+    def invalidate(self, org_id):
+        """Forgets every day of an org."""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == org_id]:
+                del self.entries[key]
+            self.org_generations[org_id] = self._generation(org_id)[1] + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def _generation(self, org_id):
+        return self.generation, self.org_generations.get(org_id, 0)
+
+    def __len__(self):
+        return len(self.entries)
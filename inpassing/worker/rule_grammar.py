@@ -0,0 +1,46 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+# The pyparsing grammar of rule strings, see rules.py for the syntax. Rules
+# are parsed with the hand written parser in rules.py, this is only kept
+# around to check it against.
+
+import pyparsing as pp
+
+from .rules import SpotMap, CustomMapping, CurStateMapping, NoneMapping
+
+# Parse integers as numbers not strings
+integer = pp.Word(pp.nums).setParseAction(lambda toks: int(toks[0]))
+
+spot_offset = pp.Literal('(') + integer('spot_offset') + ')'
+spot_assignment = pp.Literal('=') + integer('spot_assignment')
+
+# A mapping from a range or spots.
+spot_map = integer('start_spot_num') + \
+               (pp.Optional(pp.Literal('-') + integer('end_spot_num') +
+                            pp.Optional(spot_offset)) ^
+                pp.Optional(spot_offset ^ spot_assignment))
+
+# results[0] is the state id
+# results[1:] are parse results of each spot map
+mapping_syntax = integer('state_id') + \
+              pp.Optional(pp.Suppress(':') + pp.Group(spot_map) +
+                          pp.ZeroOrMore(pp.Suppress(',') +
+                                        pp.Group(spot_map))) ^ \
+              'none' ^ 'cur'
+
+
+def parse_rule(instring):
+    parse_res = mapping_syntax.parseString(instring)
+
+    if 'state_id' in parse_res.asDict():
+        mappings = []
+        for mapping_res in parse_res[1:]:
+            mappings.append(SpotMap.fromdict(mapping_res))
+        return CustomMapping(parse_res['state_id'], mappings)
+    elif parse_res[0] == 'cur':
+        return CurStateMapping()
+    elif parse_res[0] == 'none':
+        return NoneMapping()
+    else:
+        raise RuntimeError("Invalid rule string: '{}'".format(instring))
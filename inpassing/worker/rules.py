@@ -3,11 +3,9 @@
 
 from collections import namedtuple
 from enum import Enum
-import msgpack
+from functools import lru_cache
 
-import pyparsing as pp
-
-from . import str_to_date
+from .patterns import days, compile_pattern
 
 # A rule set is a three-element tuple. The first element is a string pattern
 # that can match a particular day of the week or month. The second element
@@ -20,8 +18,9 @@ from . import str_to_date
 
 # Who can park on what day is determined by looking at the last fixed daystate
 # and going forward using the rules defined in a bucket. Every time a new
-# daystate is fixed, a new bucket is created with new rules being added to the
-# most recent bucket.
+# daystate is fixed, a new bucket is created, so rules can be changed from a
+# day on without changing how the days before it were counted. See queue.py
+# for how buckets are kept.
 
 # Example patterns
 
@@ -73,25 +72,114 @@ from . import str_to_date
 #  ('sunday', false, 'none'),
 #  ('*', true, ['cur', '1:1-20(40)', '2:1-20(40)'])]
 
-# Parse integers as numbers not strings
-integer = pp.Word(pp.nums).setParseAction(lambda toks: int(toks[0]))
-
-spot_offset = pp.Literal('(') + integer('spot_offset') + ')'
-spot_assignment = pp.Literal('=') + integer('spot_assignment')
-
-# A mapping from a range or spots.
-spot_map = integer('start_spot_num') + \
-               (pp.Optional(pp.Literal('-') + integer('end_spot_num') +
-                            pp.Optional(spot_offset)) ^
-                pp.Optional(spot_offset ^ spot_assignment))
-
-# results[0] is the state id
-# results[1:] are parse results of each spot map
-mapping_syntax = integer('state_id') + \
-              pp.Optional(pp.Suppress(':') + pp.Group(spot_map) +
-                          pp.ZeroOrMore(pp.Suppress(',') +
-                                        pp.Group(spot_map))) ^ \
-              'none' ^ 'cur'
+# Rules are parsed by hand rather than with a grammar, they are parsed every
+# time rule sets are read. rule_grammar.py has the pyparsing grammar this
+# parser accepts the same strings as, the tests check one against the other.
+# Like the grammar, whitespace is allowed between any two tokens and anything
+# after a complete rule is ignored.
+
+_WHITESPACE = ' \t\n\r'
+_DIGITS = '0123456789'
+
+
+class RuleSyntaxError(ValueError):
+    def __init__(self, instring, loc):
+        super().__init__("Invalid rule string: '{}' (at char {})".format(
+            instring, loc
+        ))
+        self.instring = instring
+        self.loc = loc
+
+
+def _skip_whitespace(s, loc):
+    while loc < len(s) and s[loc] in _WHITESPACE:
+        loc += 1
+    return loc
+
+
+def _literal(s, loc, literal):
+    """Returns the location after a literal, or None if it isn't there."""
+    loc = _skip_whitespace(s, loc)
+    return loc + len(literal) if s.startswith(literal, loc) else None
+
+
+def _integer(s, loc):
+    """Returns (integer, location after it), or (None, loc)."""
+    start = _skip_whitespace(s, loc)
+    end = start
+    while end < len(s) and s[end] in _DIGITS:
+        end += 1
+    if end == start:
+        return None, loc
+    return int(s[start:end]), end
+
+
+def _spot_offset(s, loc):
+    """Parses '(<spot_offset>)'."""
+    after = _literal(s, loc, '(')
+    if after is None:
+        return None, loc
+    offset, after = _integer(s, after)
+    if offset is None:
+        return None, loc
+    after = _literal(s, after, ')')
+    if after is None:
+        return None, loc
+    return offset, after
+
+
+def _spot_map(s, loc):
+    """Returns ((start, end, value, fixed), location after it), or (None,
+    loc)."""
+    start, loc = _integer(s, loc)
+    if start is None:
+        return None, loc
+
+    # <start_spot_num>-<end_spot_num>[(<spot_offset>)]
+    after = _literal(s, loc, '-')
+    if after is not None:
+        end, after = _integer(s, after)
+        if end is not None:
+            offset, after = _spot_offset(s, after)
+            return (start, end, offset or 0, False), after
+
+    # <start_spot_num>(<spot_offset>)
+    offset, after = _spot_offset(s, loc)
+    if offset is not None:
+        return (start, None, offset, False), after
+
+    # <start_spot_num>=<adjusted_spot_num>
+    after = _literal(s, loc, '=')
+    if after is not None:
+        value, after = _integer(s, after)
+        if value is not None:
+            return (start, None, value, True), after
+
+    return (start, None, 0, False), loc
+
+
+@lru_cache(maxsize=1024)
+def _parse_rule_string(instring):
+    """Returns ('cur',), ('none',) or (state id, spot maps)."""
+    state_id, loc = _integer(instring, 0)
+    if state_id is not None:
+        spot_maps = []
+        after = _literal(instring, loc, ':')
+        if after is not None:
+            spot_map, after = _spot_map(instring, after)
+            while spot_map is not None:
+                spot_maps.append(spot_map)
+                after = _literal(instring, after, ',')
+                if after is None:
+                    break
+                spot_map, after = _spot_map(instring, after)
+        return state_id, tuple(spot_maps)
+
+    loc = _skip_whitespace(instring, 0)
+    for literal in ('none', 'cur'):
+        if instring.startswith(literal, loc):
+            return (literal,)
+    raise RuleSyntaxError(instring, loc)
 
 
 class SpotAdjustmentType(Enum):
@@ -155,11 +243,19 @@ class SpotMap:
             return SpotMap(dict['start_spot_num'], dict.get('end_spot_num'),
                            dict.get('spot_offset', 0), SpotAdjustmentType.Offset)
 
+    @classmethod
+    def fromtuple(cls, spot_map):
+        start, end, value, fixed = spot_map
+        if fixed:
+            return SpotMap(start, end, value, SpotAdjustmentType.Fixed)
+        return SpotMap(start, end, value, SpotAdjustmentType.Offset)
+
     @classmethod
     def fromstring(cls, instring):
-        return SpotMap.fromdict(
-            spot_map.parseString(instring).asDict()
-        )
+        spot_map, loc = _spot_map(instring, 0)
+        if spot_map is None:
+            raise RuleSyntaxError(instring, loc)
+        return SpotMap.fromtuple(spot_map)
 
 
 # Mappings are used to figure out who can park and where. A return value of
@@ -239,19 +335,20 @@ class NoneMapping:
 
 
 def parse_rule(instring):
-    parse_res = mapping_syntax.parseString(instring)
-
-    if 'state_id' in parse_res.asDict():
-        mappings = []
-        for mapping_res in parse_res[1:]:
-            mappings.append(SpotMap.fromdict(mapping_res))
-        return CustomMapping(parse_res['state_id'], mappings)
-    elif parse_res[0] == 'cur':
+    """Parses a rule string into a new mapping, raises RuleSyntaxError if it
+    isn't one. Parses are cached, the mappings are not."""
+    if not isinstance(instring, str):
+        raise RuleSyntaxError(instring, 0)
+
+    parsed = _parse_rule_string(instring)
+    if parsed[0] == 'cur':
         return CurStateMapping()
-    elif parse_res[0] == 'none':
+    elif parsed[0] == 'none':
         return NoneMapping()
     else:
-        raise RuntimeError("Invalid rule string: '{}'".format(instring))
+        state_id, spot_maps = parsed
+        return CustomMapping(state_id, [SpotMap.fromtuple(spot_map)
+                                        for spot_map in spot_maps])
 
 
 class CompositeMapping:
@@ -268,14 +365,11 @@ class CompositeMapping:
     def adjust_pass(self, state_id, spot_num):
         for mapping in self.maps:
             if mapping.includes_pass(state_id, spot_num):
-                return mapping.adjust_spot_num(state_id, spot_num)
+                return mapping.adjust_pass(state_id, spot_num)
         return None
 
 RuleSet = namedtuple('RuleSet', 'pattern incrday rules')
 
-days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
-        'sunday']
-
 def dict_from_ruleset(rs):
     rules = []
     if isinstance(rs.rules, CompositeMapping):
@@ -298,41 +392,76 @@ def dict_from_ruleset(rs):
 
 
 def ruleset_from_dict(d):
+    rules = d['rules']
+    if isinstance(rules, str):
+        # One rule, like push_rule_set takes.
+        rules = [rules]
     return RuleSet(
-        d.pattern, d.incrday, [parse_rule(rule) for rule in d.rules]
+        d['pattern'], d['incrday'], [parse_rule(rule) for rule in rules]
     )
 
 
 def pattern_matches_date(pattern, date):
-    if pattern == '*':
-        return True
+    matcher = compile_pattern(pattern)
+    return matcher is not None and matcher.matches(date)
 
-    if pattern in days:
-        pattern_day = days.index(pattern)
-        if pattern_day == date.weekday():
-            # The date is on the same weekday as the pattern designates
-            return True
-        else:
-            return False
-    else:
-        try:
-            test_date = str_to_date(pattern)
-            if (test_date.year == date.year and test_date.month == date.month
-                and test_date.day == date.day):
-                return True
-        except ValueError:
-            pass
 
-        return False
+def pattern_reoccurs(day):
+    """Returns whether rule sets with this pattern are kept with the
+    reoccurring rule sets, which is every valid pattern but single days."""
+    matcher = compile_pattern(day)
+    return matcher is not None and matcher.reoccurs
 
 
-def pattern_reoccurs(day):
-    if day == '*':
-        return True
-    return True if day in days else False
+# Rule sets are kept in redis with their rules already parsed, so reading them
+# doesn't parse any text. Every rule is packed into a list of ints:
+# [RULE_CUR], [RULE_NONE] or [<state_id>, <start>, <end>, <value>,
+# <adjust type>, ...] with four ints per spot map. State ids are never
+# negative, which is how the kinds are told apart. RULE_FORMAT_VERSION is
+# stored with every rule set and has to change along with this layout.
+
+RULE_FORMAT_VERSION = 1
+
+RULE_CUR = -1
+RULE_NONE = -2
+
+_ADJUST_TYPES = {t.value: t for t in SpotAdjustmentType}
+
+
+def pack_rule(rule):
+    """Packs a mapping (or a rule string) into a list of ints."""
+    if isinstance(rule, str):
+        rule = parse_rule(rule)
+
+    if isinstance(rule, CurStateMapping):
+        return [RULE_CUR]
+    elif isinstance(rule, NoneMapping):
+        return [RULE_NONE]
+    elif isinstance(rule, CustomMapping):
+        packed = [rule.state_id]
+        for spot_map in rule.spot_mappings:
+            packed.extend((spot_map.start, spot_map.end, spot_map.value,
+                           spot_map.adjust_type.value))
+        return packed
+    raise ValueError('Unable to pack rule: {!r}'.format(rule))
+
+
+def unpack_rule(packed):
+    """Returns a new mapping from a rule packed by pack_rule."""
+    if packed[0] == RULE_CUR:
+        return CurStateMapping()
+    elif packed[0] == RULE_NONE:
+        return NoneMapping()
+    elif packed[0] >= 0 and len(packed) % 4 == 1:
+        return CustomMapping(packed[0], [
+            SpotMap(packed[i], packed[i + 1], packed[i + 2],
+                    _ADJUST_TYPES[packed[i + 3]])
+            for i in range(1, len(packed), 4)
+        ])
+    raise ValueError('Invalid packed rule: {!r}'.format(packed))
 
 
-def convert_rules(self, rsets):
+def convert_rules(rsets):
     """Converts a list of rule msgpack strings to a list of objects."""
     ret = []
     for rule_set in rsets:
@@ -0,0 +1,559 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+import bisect
+import calendar
+import threading
+from collections import namedtuple, OrderedDict
+from datetime import date, timedelta
+
+from . import daystate, patterns
+from .mapping import compile_mappings
+
+# One day of a daystate calendar. pattern and incrday come from the rule set
+# that applies to the day, they are None when no rule set does.
+CalendarDay = namedtuple('CalendarDay', 'date daystate_id pattern incrday')
+
+# How many calendars are kept per schedule.
+MAX_CACHED_CALENDARS = 64
+
+# How many compiled mappings are kept per schedule.
+MAX_CACHED_MAPPINGS = 64
+
+# What simulate found. before and after are the schedules without and with the
+# changes, days is a list of (before, after) CalendarDay pairs of the days that
+# changed.
+Simulation = namedtuple('Simulation', 'before after recomputed_from days')
+
+
+class RuleBucket:
+    """The reoccurring rule sets in effect from one day on, indexed by what
+    their patterns match.
+
+    Like a schedule, a bucket never changes once it is built.
+
+    """
+
+    __slots__ = ('start', 'rule_sets', 'weekday_ranked', 'weekday_rule_sets',
+                 'weekday_incrdays', 'month_days', 'nth_weekdays',
+                 'range_starts', 'range_segments')
+
+    def __init__(self, start, rule_sets):
+        """Arguments:
+            start - The first day the bucket is in effect, date.min for the
+            bucket every org starts with.
+            rule_sets - In the order they are matched against.
+        """
+        self.start = start
+        self.rule_sets = tuple(rule_sets)
+
+        # Rule sets are indexed by what their pattern matches, along with
+        # their rank. The rule set with the lowest rank (the first one) is the
+        # one that counts when more than one matches.
+        weekday_ranked = [None] * 7
+        self.month_days = {}
+        self.nth_weekdays = {}
+        ranges = []
+        for rank, rs in enumerate(self.rule_sets):
+            matcher = patterns.compile_pattern(rs.pattern)
+            ranked = (rank, rs)
+            if isinstance(matcher, patterns.AnyDayPattern):
+                for weekday in range(7):
+                    if weekday_ranked[weekday] is None:
+                        weekday_ranked[weekday] = ranked
+            elif isinstance(matcher, patterns.WeekdayPattern):
+                if weekday_ranked[matcher.weekday] is None:
+                    weekday_ranked[matcher.weekday] = ranked
+            elif isinstance(matcher, patterns.MonthDayPattern):
+                self.month_days.setdefault((matcher.month, matcher.day),
+                                           ranked)
+            elif isinstance(matcher, patterns.NthWeekdayPattern):
+                self.nth_weekdays.setdefault((matcher.nth, matcher.weekday),
+                                             ranked)
+            elif isinstance(matcher, patterns.DateRangePattern):
+                ranges.append((matcher.first_ordinal, matcher.last_ordinal,
+                               ranked))
+
+        self.weekday_ranked = tuple(weekday_ranked)
+        self.weekday_rule_sets = tuple(None if ranked is None else ranked[1]
+                                       for ranked in weekday_ranked)
+        self.weekday_incrdays = tuple(rs is not None and bool(rs.incrday)
+                                      for rs in self.weekday_rule_sets)
+
+        self.range_segments = _flatten_ranges(ranges)
+        self.range_starts = [first for first, last, ranked
+                             in self.range_segments]
+
+    def with_rule_set(self, rule_set):
+        """Returns a new bucket with the rule set put in, replacing the one
+        with the same pattern."""
+        return RuleBucket(self.start, [rule_set] + [
+            rs for rs in self.rule_sets if rs.pattern != rule_set.pattern
+        ])
+
+    def rule_set(self, day):
+        """Returns the rule set of the bucket that matches a day, or None."""
+        best = self.weekday_ranked[day.weekday()]
+        for ranked in self._dated_rule_sets(day):
+            if ranked is not None and (best is None or ranked[0] < best[0]):
+                best = ranked
+        return None if best is None else best[1]
+
+    def _dated_rule_sets(self, day):
+        """Yields the ranked rule sets that match a day by its date rather
+        than only its weekday (or None)."""
+        if len(self.month_days) > 0:
+            yield self.month_days.get((day.month, day.day))
+
+        if len(self.nth_weekdays) > 0:
+            weekday = day.weekday()
+            yield self.nth_weekdays.get(((day.day - 1) // 7 + 1, weekday))
+            if day.day + 7 > calendar.monthrange(day.year, day.month)[1]:
+                yield self.nth_weekdays.get((patterns.LAST, weekday))
+
+        if len(self.range_segments) > 0:
+            ordinal = day.toordinal()
+            segment_i = bisect.bisect_right(self.range_starts, ordinal) - 1
+            if segment_i >= 0:
+                first, last, ranked = self.range_segments[segment_i]
+                if ordinal <= last:
+                    yield ranked
+
+    def dated_days(self, first_day, last_day):
+        """Returns every day from first_day to last_day that a rule set matches
+        by its date."""
+        dated = set()
+        for month, day in self.month_days:
+            for year in range(first_day.year, last_day.year + 1):
+                match = patterns.MonthDayPattern(month, day).in_year(year)
+                if match is not None and first_day <= match <= last_day:
+                    dated.add(match)
+
+        if len(self.nth_weekdays) > 0:
+            year, month = first_day.year, first_day.month
+            while (year, month) <= (last_day.year, last_day.month):
+                for nth, weekday in self.nth_weekdays:
+                    match = patterns.NthWeekdayPattern(nth, weekday) \
+                        .in_month(year, month)
+                    if match is not None and first_day <= match <= last_day:
+                        dated.add(match)
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        for first, last, ranked in self.range_segments:
+            for ordinal in range(max(first, first_day.toordinal()),
+                                 min(last, last_day.toordinal()) + 1):
+                dated.add(date.fromordinal(ordinal))
+        return dated
+
+
+class Schedule:
+    """Everything it takes to find the daystate and rule set of any day.
+
+    A schedule is built from what an org has in redis at one version and never
+    changes afterwards, so it can be shared between threads without locking.
+    LiveOrg builds a new one whenever the org's schedule version moves on.
+
+    """
+
+    __slots__ = ('version', 'sequence', 'fixes', 'rule_buckets',
+                 'bucket_starts', 'single_use_rule_sets', 'sequence_index',
+                 'fix_days', 'fix_indices', 'weekday_incrdays', 'overrides',
+                 'override_incrdays', 'override_days')
+
+    def __init__(self, version, sequence, fixes, rule_buckets,
+                 single_use_rule_sets):
+        """Arguments:
+            version - The schedule version this was built from.
+            sequence - The daystate ids in order.
+            fixes - FixedDaystates, newest first.
+            rule_buckets - RuleBuckets, oldest first. The first one is also in
+            effect before its start.
+            single_use_rule_sets - (date, RuleSet) pairs, in the order they are
+            matched against.
+        """
+        self.version = version
+        self.sequence = tuple(sequence)
+
+        # Kept to build changed copies from, see with_changes.
+        self.fixes = tuple(fixes)
+        self.single_use_rule_sets = tuple(single_use_rule_sets)
+
+        self.rule_buckets = tuple(rule_buckets)
+        if len(self.rule_buckets) == 0:
+            self.rule_buckets = (RuleBucket(date.min, []),)
+        self.bucket_starts = [bucket.start for bucket in self.rule_buckets]
+
+        self.sequence_index = {}
+        for i, state_id in enumerate(self.sequence):
+            self.sequence_index.setdefault(state_id, i)
+
+        # Oldest first, the newest fix of a day wins.
+        day_fixes = {}
+        for fix in reversed(fixes):
+            day_fixes[fix.date.date()] = fix.state_id
+        self.fix_days = sorted(day_fixes)
+        self.fix_indices = [self.sequence_index.get(day_fixes[day])
+                            for day in self.fix_days]
+
+        # Days are counted by the weekdays of the newest bucket, days of other
+        # buckets that go differently are overrides (see incrday_overrides).
+        self.weekday_incrdays = self.rule_buckets[-1].weekday_incrdays
+
+        self.overrides = {}
+        for day, rs in single_use_rule_sets:
+            self.overrides.setdefault(day, rs)
+        self.override_incrdays = {day: bool(rs.incrday)
+                                  for day, rs in self.overrides.items()}
+        self.override_days = sorted(self.override_incrdays)
+
+    def with_changes(self, rule_sets=(), fixes=()):
+        """Returns a new schedule as if the rule sets were put (replacing the
+        ones with the same pattern, in every bucket) and then the fixes pushed,
+        in order."""
+        buckets = list(self.rule_buckets)
+        single_use = list(self.single_use_rule_sets)
+        for rs in rule_sets:
+            matcher = patterns.compile_pattern(rs.pattern)
+            if matcher is None:
+                raise ValueError('Invalid pattern: {}'.format(rs.pattern))
+            if matcher.reoccurs:
+                buckets = [bucket.with_rule_set(rs) for bucket in buckets]
+            else:
+                day = date.fromordinal(matcher.ordinal)
+                single_use = [(day, rs)] + [(other_day, other) for other_day,
+                                            other in single_use
+                                            if other_day != day]
+
+        return Schedule(self.version, self.sequence,
+                        list(reversed(fixes)) + list(self.fixes),
+                        buckets, single_use)
+
+    def rule_bucket(self, day):
+        """Returns the RuleBucket in effect on a day."""
+        bucket_i = bisect.bisect_right(self.bucket_starts, day) - 1
+        return self.rule_buckets[max(bucket_i, 0)]
+
+    def _bucket_spans(self, first_day, last_day):
+        """Yields (bucket, first day, last day) for every bucket in effect
+        from first_day to last_day, with the days it is in effect."""
+        first_i = max(bisect.bisect_right(self.bucket_starts, first_day) - 1,
+                      0)
+        for bucket_i in range(first_i, len(self.rule_buckets)):
+            span_first = first_day
+            if bucket_i > first_i:
+                span_first = self.bucket_starts[bucket_i]
+            if span_first > last_day:
+                break
+
+            span_last = last_day
+            if bucket_i + 1 < len(self.rule_buckets):
+                span_last = min(last_day, self.bucket_starts[bucket_i + 1] -
+                                timedelta(days=1))
+            yield self.rule_buckets[bucket_i], span_first, span_last
+
+    def rule_set(self, day):
+        """Returns the rule set that applies to a day, or None."""
+        rs = self.overrides.get(day)
+        if rs is not None:
+            return rs
+        return self.rule_bucket(day).rule_set(day)
+
+    def incrday_overrides(self, first_day, last_day):
+        """Returns a dict mapping the days from first_day to last_day that
+        don't go by their weekday (in the newest bucket) to whether they move
+        the sequence forward."""
+        overrides = {}
+        for bucket, span_first, span_last in self._bucket_spans(first_day,
+                                                                last_day):
+            if bucket.weekday_incrdays != self.weekday_incrdays:
+                for offset in range((span_last - span_first).days + 1):
+                    day = span_first + timedelta(days=offset)
+                    overrides[day] = bucket.weekday_incrdays[day.weekday()]
+
+            for day in bucket.dated_days(span_first, span_last):
+                rs = bucket.rule_set(day)
+                overrides[day] = rs is not None and bool(rs.incrday)
+
+        # Orgs keep every single-use rule set they ever had, only the ones of
+        # these days are looked at.
+        first_i = bisect.bisect_left(self.override_days, first_day)
+        last_i = bisect.bisect_right(self.override_days, last_day)
+        for day in self.override_days[first_i:last_i]:
+            overrides[day] = self.override_incrdays[day]
+        return overrides
+
+    def fix_for_day(self, day):
+        """Returns (date, sequence index) of the most recent fix on or before a
+        day, or of the earliest fix when they all come after it. Returns None
+        when there are no fixes."""
+        if len(self.fix_days) == 0:
+            return None
+        fix_i = max(bisect.bisect_right(self.fix_days, day) - 1, 0)
+        return self.fix_days[fix_i], self.fix_indices[fix_i]
+
+    def daystate_index(self, day, checkpoint=None):
+        """Returns the index into the sequence of the daystate of a day.
+
+        The days that move the sequence forward are counted from the fix that
+        applies to the day, or from checkpoint, a (date, index) pair for a day
+        computed earlier, when it comes after that fix.
+        """
+        fix = self.fix_for_day(day)
+        if fix is None or len(self.sequence) == 0:
+            return None
+
+        since_day, since_i = fix
+        if checkpoint is not None and checkpoint[0] >= since_day:
+            since_day, since_i = checkpoint
+
+        periods = 0
+        if since_day != day:
+            periods = daystate.count_increments(
+                since_day, day, self.weekday_incrdays,
+                self.incrday_overrides(min(since_day, day), max(since_day, day))
+            )
+        return (since_i + periods) % len(self.sequence)
+
+    def calendar(self, first_day, last_day, first_i):
+        """Returns a CalendarDay for every day from first_day to last_day,
+        given the sequence index of the first day."""
+        state_i = first_i
+        calendar = []
+        for day_i in range((last_day - first_day).days + 1):
+            day = first_day + timedelta(days=day_i)
+            rule_set = self.rule_set(day)
+
+            if day_i > 0 and state_i is not None:
+                # A fix in the middle of the calendar starts the sequence over.
+                fix_i = bisect.bisect_left(self.fix_days, day)
+                if fix_i < len(self.fix_days) and self.fix_days[fix_i] == day:
+                    state_i = self.fix_indices[fix_i]
+                elif rule_set is not None and rule_set.incrday:
+                    state_i = (state_i + 1) % len(self.sequence)
+
+            calendar.append(CalendarDay(
+                day, None if state_i is None else self.sequence[state_i],
+                None if rule_set is None else rule_set.pattern,
+                None if rule_set is None else bool(rule_set.incrday)
+            ))
+        return calendar
+
+    def project(self, first_day, last_day):
+        """Returns (daystate ids, increment mask), arrays with an entry for
+        every day from first_day to last_day. The daystate ids are None when
+        the org has no fixes."""
+        num_days = (last_day - first_day).days + 1
+        mask = daystate.increment_mask(
+            first_day, num_days, self.weekday_incrdays,
+            self.incrday_overrides(first_day, last_day)
+        )
+
+        first_i = self.daystate_index(first_day)
+        if first_i is None:
+            return None, mask
+
+        fixes = {(day - first_day).days: state_i
+                 for day, state_i in zip(self.fix_days, self.fix_indices)}
+        return daystate.project_states(self.sequence, first_i, mask,
+                                       fixes), mask
+
+
+def _first_match(matcher, first_day, last_day):
+    """Returns the first day from first_day to last_day a pattern matches, or
+    None."""
+    # Don't walk up to days that are known not to match.
+    if isinstance(matcher, patterns.DatePattern):
+        first_day = max(first_day, date.fromordinal(matcher.ordinal))
+    elif isinstance(matcher, patterns.DateRangePattern):
+        first_day = max(first_day, date.fromordinal(matcher.first_ordinal))
+
+    day = first_day
+    while day <= last_day:
+        if matcher.matches(day):
+            return day
+        day += timedelta(days=1)
+    return None
+
+
+def _changed_from(schedule, rule_sets, fixes, first_day, last_day):
+    """Returns the earliest day from first_day on whose daystate or rule set
+    the changes could affect, or None if they can't affect any day up to
+    last_day."""
+    # Changes before the fix first_day counts from don't reach it.
+    fix = schedule.fix_for_day(first_day)
+    since_day = first_day if fix is None else min(first_day, fix[0])
+
+    changed = None
+    for rs in rule_sets:
+        day = _first_match(patterns.compile_pattern(rs.pattern), since_day,
+                           last_day)
+        if day is not None and (changed is None or day < changed):
+            changed = day
+    for fixed in fixes:
+        day = max(fixed.date.date(), since_day)
+        if day <= last_day and (changed is None or day < changed):
+            changed = day
+
+    if changed is None:
+        return None
+
+    # Days before the earliest fix are counted backwards from it, a change
+    # on or before it moves all of them.
+    if len(schedule.fix_days) == 0 or schedule.fix_days[0] >= changed:
+        return first_day
+    return max(first_day, changed)
+
+
+def _rules_key(rs):
+    if rs is None:
+        return None
+    return bool(rs.incrday), [str(rule) for rule in rs.rules]
+
+
+def simulate(schedule, rule_sets, fixes, first_day, last_day):
+    """Finds the days from first_day to last_day whose daystate or rule set
+    would change if the rule sets were put and the fixes pushed, see
+    Schedule.with_changes.
+
+    Days before the earliest one the changes can affect are left alone, both
+    schedules are only projected from there on.
+    """
+    simulated = schedule.with_changes(rule_sets, fixes)
+    start = _changed_from(schedule, rule_sets, fixes, first_day, last_day)
+    if start is None:
+        return Simulation(schedule, simulated, None, [])
+
+    before_ids, _ = schedule.project(start, last_day)
+    after_ids, _ = simulated.project(start, last_day)
+
+    def calendar_day(day, rule_set, state_ids, offset):
+        return CalendarDay(
+            day, None if state_ids is None else int(state_ids[offset]),
+            None if rule_set is None else rule_set.pattern,
+            None if rule_set is None else bool(rule_set.incrday)
+        )
+
+    days = []
+    for offset in range((last_day - start).days + 1):
+        day = start + timedelta(days=offset)
+        before_rs, after_rs = schedule.rule_set(day), simulated.rule_set(day)
+        before = calendar_day(day, before_rs, before_ids, offset)
+        after = calendar_day(day, after_rs, after_ids, offset)
+        if before.daystate_id != after.daystate_id or \
+                _rules_key(before_rs) != _rules_key(after_rs):
+            days.append((before, after))
+    return Simulation(schedule, simulated, start, days)
+
+
+def _flatten_ranges(ranges):
+    """Turns (first ordinal, last ordinal, ranked rule set) ranges that may
+    overlap into sorted ranges that don't, each with the lowest ranked rule
+    set covering it."""
+    bounds = sorted({first for first, last, ranked in ranges} |
+                    {last + 1 for first, last, ranked in ranges})
+
+    segments = []
+    for first, end in zip(bounds, bounds[1:]):
+        covering = [ranked for range_first, range_last, ranked in ranges
+                    if range_first <= first and end - 1 <= range_last]
+        if len(covering) == 0:
+            continue
+        best = min(covering, key=lambda ranked: ranked[0])
+
+        # Join with the previous segment when the same rule set goes on.
+        if len(segments) > 0 and segments[-1][1] == first - 1 and \
+                segments[-1][2] is best:
+            segments[-1] = (segments[-1][0], end - 1, best)
+        else:
+            segments.append((first, end - 1, best))
+    return segments
+
+
+class ScheduleCache:
+    """The daystates and calendars computed from one schedule.
+
+    Daystates are kept as checkpoints to resume later lookups from, but only
+    for days within a window around today. Everything is thrown away with the
+    schedule.
+
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.lock = threading.Lock()
+
+        # Sorted days, and the sequence index of each.
+        self.checkpoint_days = []
+        self.checkpoints = {}
+
+        self.calendars = OrderedDict()
+
+        # Rule sets belong to the schedule, so they are keyed by id.
+        self.mappings = OrderedDict()
+
+    def daystate_index(self, day, today, window):
+        """Returns (sequence index, whether a checkpoint was resumed from) for
+        a day."""
+        with self.lock:
+            i = bisect.bisect_right(self.checkpoint_days, day)
+            checkpoint = None
+            if i > 0:
+                checkpoint_day = self.checkpoint_days[i - 1]
+                checkpoint = checkpoint_day, self.checkpoints[checkpoint_day]
+
+        state_i = self.schedule.daystate_index(day, checkpoint)
+
+        # Days before the earliest fix never resume from a checkpoint.
+        fix = self.schedule.fix_for_day(day)
+        hit = checkpoint is not None and fix is not None and \
+            checkpoint[0] >= fix[0]
+        if state_i is not None and day >= fix[0] and \
+                abs(day - today) <= window:
+            self._save(day, state_i, today, window)
+        return state_i, hit
+
+    def _save(self, day, state_i, today, window):
+        with self.lock:
+            if day not in self.checkpoints:
+                bisect.insort(self.checkpoint_days, day)
+            self.checkpoints[day] = state_i
+
+            # Forget days that fell out of the window.
+            while self.checkpoint_days[0] < today - window:
+                del self.checkpoints[self.checkpoint_days.pop(0)]
+            while self.checkpoint_days[-1] > today + window:
+                del self.checkpoints[self.checkpoint_days.pop()]
+
+    def calendar(self, first_day, last_day, first_i):
+        key = (first_day, last_day)
+        with self.lock:
+            calendar = self.calendars.get(key)
+            if calendar is not None:
+                self.calendars.move_to_end(key)
+                return calendar
+
+        calendar = self.schedule.calendar(first_day, last_day, first_i)
+
+        with self.lock:
+            self.calendars[key] = calendar
+            while len(self.calendars) > MAX_CACHED_CALENDARS:
+                self.calendars.popitem(last=False)
+        return calendar
+
+    def mapping(self, rule_set, state_id):
+        """Returns the CompiledMapping of a rule set of this schedule, when
+        state_id is the current daystate."""
+        key = (id(rule_set), state_id)
+        with self.lock:
+            mapping = self.mappings.get(key)
+            if mapping is not None:
+                self.mappings.move_to_end(key)
+                return mapping
+
+        mapping = compile_mappings(rule_set.rules, state_id)
+
+        with self.lock:
+            self.mappings[key] = mapping
+            while len(self.mappings) > MAX_CACHED_MAPPINGS:
+                self.mappings.popitem(last=False)
+        return mapping
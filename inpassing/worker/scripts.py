@@ -0,0 +1,205 @@
+# Copyright (c) 2017 Luke San Antonio Bialecki
+# All rights reserved.
+
+# Lua versions of the LiveOrg queue mutations. Each one does in a single
+# round trip what the WATCH / MULTI version in queue.py does, and since scripts
+# run atomically there is nothing to retry when a lot of clients show up at
+# once.
+
+# The scripts are only ever called with EVALSHA. The sha is computed locally so
+# that we don't have to ask the server for it, the script is loaded with SCRIPT
+# LOAD the first time the server tells us it doesn't know about it.
+
+import hashlib
+
+from redis.exceptions import NoScriptError
+
+
+class LuaScript:
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def load(self, r):
+        """Makes sure the redis server knows about this script."""
+        return r.script_load(self.source)
+
+    def __call__(self, r, keys=(), args=()):
+        try:
+            return r.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            self.load(r)
+            return r.evalsha(self.sha, len(keys), *keys, *args)
+
+
+# Scores a day in the active queue schedule, 2017-05-01 is scored 20170501.
+# This has to match _day_score in queue.py.
+DAY_SCORE = """
+local function day_score(day)
+    return tonumber((string.gsub(day, '-', '')))
+end
+"""
+
+
+# Records that the activation of a day changed, for reconcile_active_queue.
+# Expects the dirty set and change counter to be passed in as the given keys.
+def mark_day_changed(dirty_key, counter_key):
+    return """
+local function mark_day_changed(day)
+    redis.call('SADD', {0}, day)
+    redis.call('INCR', {1})
+end
+""".format(dirty_key, counter_key)
+
+
+# KEYS: active queue set, active queue schedule, dirty set, change counter
+# ARGV: day
+activate_day_queue = LuaScript(
+    DAY_SCORE + mark_day_changed('KEYS[3]', 'KEYS[4]') + """
+if redis.call('SADD', KEYS[1], ARGV[1]) == 1 then
+    redis.call('ZADD', KEYS[2], day_score(ARGV[1]), ARGV[1])
+    mark_day_changed(ARGV[1])
+end
+""")
+
+# Deactivates the queues of a day, unless someone is still waiting in them.
+# Returns 1 if the day was deactivated.
+# KEYS: active queue set, active queue schedule, borrow queue, lend queue,
+# dirty set, change counter
+# ARGV: day
+deactivate_day_queue = LuaScript(mark_day_changed('KEYS[5]', 'KEYS[6]') + """
+if redis.call('ZCARD', KEYS[3]) > 0 or redis.call('ZCARD', KEYS[4]) > 0 then
+    return 0
+end
+
+redis.call('SREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+mark_day_changed(ARGV[1])
+return 1
+""")
+
+# Unschedules the queues of every day before today. Returns how many days
+# were retired.
+# KEYS: active queue set, active queue schedule, dirty set, change counter
+# ARGV: score of today
+retire_past_queues = LuaScript(mark_day_changed('KEYS[3]', 'KEYS[4]') + """
+local past = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+for _, day in ipairs(past) do
+    redis.call('SREM', KEYS[1], day)
+    mark_day_changed(day)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+return #past
+""")
+
+# Activates the queue of every day and enqueues the object onto them, if it
+# isn't already there. Returns a list with a 1 for every day the object was
+# enqueued and a 0 for every day it was already in the queue.
+# KEYS: active queue set, active queue schedule, token hash, object queues set,
+# queue ticket counter, dirty set, change counter, then the queue and queue
+# index of every day
+# ARGV: object id, field of the object in the token hash, then every day
+enqueue_obj_days = LuaScript(
+    DAY_SCORE + mark_day_changed('KEYS[6]', 'KEYS[7]') + """
+redis.call('HSETNX', KEYS[3], ARGV[2], 1)
+local token = redis.call('HGET', KEYS[3], ARGV[2])
+
+local enqueued = {}
+for i = 3, #ARGV do
+    if redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+        redis.call('ZADD', KEYS[2], day_score(ARGV[i]), ARGV[i])
+        mark_day_changed(ARGV[i])
+    end
+
+    -- The index doubles as our membership check.
+    if redis.call('HSETNX', KEYS[2 * i + 3], ARGV[1], token) == 1 then
+        -- The highest ticket is the back of the queue.
+        local ticket = redis.call('INCR', KEYS[5])
+        redis.call('ZADD', KEYS[2 * i + 2], ticket, ARGV[1])
+        redis.call('SADD', KEYS[4], day_score(ARGV[i]))
+        enqueued[i - 2] = 1
+    else
+        enqueued[i - 2] = 0
+    end
+end
+return enqueued
+""")
+
+# Makes the active queue set and schedule agree on the given days. Returns how
+# many days had to be fixed.
+# KEYS: active queue set, active queue schedule
+# ARGV: every day to look at
+reconcile_active_days = LuaScript(DAY_SCORE + """
+local fixed = 0
+for _, day in ipairs(ARGV) do
+    local is_active = redis.call('SISMEMBER', KEYS[1], day) == 1
+    local is_scheduled = redis.call('ZSCORE', KEYS[2], day)
+    if is_active and not is_scheduled then
+        redis.call('ZADD', KEYS[2], day_score(day), day)
+        fixed = fixed + 1
+    elseif not is_active and is_scheduled then
+        redis.call('ZREM', KEYS[2], day)
+        fixed = fixed + 1
+    end
+end
+return fixed
+""")
+
+# Removes the object from the queue of every day, whatever token it was queued
+# with. Returns a list with a 1 for every day the object was removed.
+# KEYS: object queues set, then the queue and queue index of every day
+# ARGV: object id, then every day
+dequeue_obj_days = LuaScript(DAY_SCORE + """
+local dequeued = {}
+for i = 2, #ARGV do
+    if redis.call('HDEL', KEYS[2 * i - 1], ARGV[1]) == 1 then
+        redis.call('ZREM', KEYS[2 * i - 2], ARGV[1])
+        redis.call('SREM', KEYS[1], day_score(ARGV[i]))
+        dequeued[i - 1] = 1
+    else
+        dequeued[i - 1] = 0
+    end
+end
+return dequeued
+""")
+
+# Updates the token of an object and moves it to the back of the queue, if it
+# is queued. Returns the new token.
+# KEYS: queue, queue index, token hash, queue ticket counter
+# ARGV: object id, field of the object in the token hash
+refresh_obj_token = LuaScript("""
+redis.call('HSETNX', KEYS[3], ARGV[2], 1)
+local token = redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then
+    redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[4]), ARGV[1])
+    redis.call('HSET', KEYS[2], ARGV[1], token)
+end
+return token
+""")
+
+# Pushes a new fixed daystate, unless it comes before the most recent fix.
+# Returns 0 if the fix was rejected.
+# KEYS: fixed daystate list, schedule version
+# ARGV: fixed daystate string
+push_fixed_daystate = LuaScript("""
+local new_date = string.match(ARGV[1], '^([^:]+)')
+local current_fix = redis.call('LINDEX', KEYS[1], 0)
+if current_fix and new_date < string.match(current_fix, '^([^:]+)') then
+    return 0
+end
+
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('INCR', KEYS[2])
+return 1
+""")
+
+all_scripts = [activate_day_queue, deactivate_day_queue, retire_past_queues,
+               reconcile_active_days, enqueue_obj_days, dequeue_obj_days,
+               refresh_obj_token, push_fixed_daystate]
+
+
+def load_scripts(r):
+    """Loads every script with SCRIPT LOAD, ahead of the first EVALSHA."""
+    for script in all_scripts:
+        script.load(r)
@@ -1,14 +1,13 @@
 # Copyright (c) 2016 Luke San Antonio Bialecki
 # All rights reserved.
 
-from . import str_to_date
 from .queue import LiveOrg
 
 
 class ParkingWorker:
-    def __init__(self, redis_inst, org_id):
+    def __init__(self, redis_inst, org):
         self.r = redis_inst
-        self.live_org = LiveOrg(redis_inst, org_id)
+        self.live_org = LiveOrg(redis_inst, org)
 
     def run(self):
         """Distribute / lend passes to new users with a fancy magic algorithm.
@@ -34,20 +33,24 @@ class ParkingWorker:
 
         """
 
+        # Cheap unless some day was activated or deactivated since our last
+        # run.
+        self.live_org.reconcile_active_queue()
+
+        # This is always the nearest day that someone is waiting on, days in
+        # the past are never handed out.
         date_str = self.live_org.cycle_active_queue()
         if date_str == None:
             print('No data to process')
             return
 
-        date_str = date_str.decode('utf-8')
-
-        date = str_to_date(date_str)
+        date = self.live_org.date_util.date_from_string(date_str)
 
         # How far are we away from that day?
-        dt = date - date.today()
-        if dt.days < 0:
-            # Lock in, maybe, or the queue was in the past.
-            print("Processing queue from the past '{}'".format(date_str))
-        elif 0 <= dt.days:
-            # The queue is in the very near future!
+        dt = date - self.live_org.date_util.today()
+        if dt.days == 0:
+            # Lock in, maybe.
+            print("Processing today's queue '{}'".format(date_str))
+        else:
+            # The queue is in the near future!
             print("Processing queue from the future '{}'".format(date_str))
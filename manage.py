@@ -5,16 +5,20 @@ import datetime
 import getpass
 
 import bcrypt
+import msgpack
 from flask_script import Manager
+from sqlalchemy import inspect
 from sqlalchemy.sql import and_
 
 import inpassing
 from inpassing.models import db, Org, User, Pass, Daystate
 
 # Create a test app
+from inpassing.view_util import daystate_summary
 from inpassing.views import redis_store
-from inpassing.worker import LiveOrg
-from inpassing.worker.queue import FixedDaystate
+from inpassing.worker import LiveOrg, str_to_date
+from inpassing.worker.queue import FixedDaystate, _day_score, _token_field, \
+    _pack_rule_set, _unpack_rule_set
 from inpassing.worker.rules import RuleSet
 
 app = inpassing.create_app(instance_relative_config=True)
@@ -80,6 +84,147 @@ def init_test_data():
     live_org.push_rule_set(RuleSet('saturday', False, 'none'))
 
 
+@manager.command
+def migrate_queue_layout():
+    """Moves queue tokens into bucket hashes and reverse indices to day scores"""
+
+    for org in Org.query.all():
+        live_org = LiveOrg(redis_store, org)
+
+        # Tokens used to be kept in one hash per org and object type.
+        for old_hash, bucket_hash in (
+                (str(org.id) + ':user-tokens', live_org._user_token_hash),
+                (str(org.id) + ':pass-tokens', live_org._pass_token_hash)):
+            if redis_store.type(old_hash) != b'hash':
+                continue
+
+            pipe = redis_store.pipeline()
+            for obj_id, token in redis_store.hgetall(old_hash).items():
+                pipe.hset(bucket_hash(obj_id), _token_field(obj_id), token)
+            pipe.delete(old_hash)
+            pipe.execute()
+
+        # Reverse indices used to hold day strings.
+        for pattern in (live_org._user_queues_set('*'),
+                        live_org._pass_queues_set('*')):
+            for key in redis_store.scan_iter(pattern):
+                days = [day.decode('utf-8')
+                        for day in redis_store.smembers(key)]
+                old_days = [day for day in days if '-' in day]
+                if len(old_days) == 0:
+                    continue
+
+                pipe = redis_store.pipeline()
+                pipe.srem(key, *old_days)
+                pipe.sadd(key, *[_day_score(day) for day in old_days])
+                pipe.execute()
+
+        print('Migrated org {} ({})'.format(org.id, org.name))
+
+
+@manager.command
+def migrate_reoccurring_rules():
+    """Moves reoccurring rule sets from a list into a hash keyed by pattern"""
+
+    for org in Org.query.all():
+        live_org = LiveOrg(redis_store, org)
+        old_list = str(org.id) + ':global-rules'
+        packed = redis_store.lrange(old_list, 0, -1)
+        if len(packed) == 0:
+            continue
+
+        # The list is newest first and the newest rule set of a pattern is the
+        # one that used to match. Migrated rule sets are ordered below any
+        # that were already set in the hash.
+        pipe = redis_store.pipeline()
+        patterns = set()
+        for i, item in enumerate(packed):
+            rule_set, time_stamp = msgpack.unpackb(item, encoding='utf-8')
+            pattern = RuleSet(*rule_set).pattern
+            if pattern in patterns:
+                continue
+            patterns.add(pattern)
+            pipe.hsetnx(
+                live_org._reoccurring_rule_hash(), pattern,
+                _pack_rule_set(RuleSet(*rule_set), time_stamp, -i - 1)
+            )
+        pipe.delete(old_list)
+        pipe.incr(live_org._schedule_version())
+        pipe.execute()
+
+        print('Migrated {} reoccurring rule sets of org {} ({})'.format(
+            len(patterns), org.id, org.name
+        ))
+
+
+@manager.command
+def migrate_rule_format():
+    """Repacks rule sets stored with rule strings into the parsed format"""
+
+    def is_old(item):
+        # Rule sets were packed as a [pattern, incrday, rules] list followed
+        # by the time stamp, the current format starts with its version.
+        return isinstance(msgpack.unpackb(item)[0], list)
+
+    for org in Org.query.all():
+        live_org = LiveOrg(redis_store, org)
+        pipe = redis_store.pipeline()
+        count = 0
+
+        bucket_scores = live_org._rule_bucket_scores() + [
+            int(score) for score in redis_store.zrange(
+                live_org._archived_rule_bucket_index(), 0, -1
+            )
+        ]
+        for bucket_score in bucket_scores:
+            rule_hash = live_org._reoccurring_rule_hash(bucket_score)
+            for pattern, item in redis_store.hgetall(rule_hash).items():
+                if is_old(item):
+                    rule_set, extra = _unpack_rule_set(item)
+                    pipe.hset(rule_hash, pattern,
+                              _pack_rule_set(rule_set, *extra))
+                    count += 1
+
+        rule_bucket = live_org._single_use_rule_bucket()
+        for item, score in redis_store.zrange(rule_bucket, 0, -1,
+                                              withscores=True):
+            if is_old(item):
+                rule_set, extra = _unpack_rule_set(item)
+                pipe.zrem(rule_bucket, item)
+                pipe.zadd(rule_bucket, score, _pack_rule_set(rule_set, *extra))
+                count += 1
+
+        pipe.execute()
+        print('Repacked {} rule sets of org {} ({})'.format(
+            count, org.id, org.name
+        ))
+
+
+@manager.command
+def archive_rule_buckets(before):
+    """Archives the rule buckets every org replaced before a date"""
+
+    day = str_to_date(before)
+    for org in Org.query.all():
+        live_org = LiveOrg(redis_store, org)
+        archived = live_org.archive_rule_buckets(day)
+        print('Archived {} rule buckets of org {} ({})'.format(
+            archived, org.id, org.name
+        ))
+
+
+@manager.command
+def create_pass_indexes():
+    """Adds indexes of the passes table to a database created before them"""
+
+    existing = {index['name'] for index
+                in inspect(db.engine).get_indexes(Pass.__tablename__)}
+    for index in Pass.__table__.indexes:
+        if index.name not in existing:
+            index.create(db.engine)
+            print('Created index {}'.format(index.name))
+
+
 def parse_field(prompt_fmt, cur_value):
     """Parse a value that can be correctly later."""
 
@@ -215,5 +360,31 @@ def verify_pass():
             more_to_verify = len(reqs)
 
 
+@manager.command
+def daystate_report(org_id, start, end):
+    """Prints how many days of each daystate fall between two dates"""
+
+    summary = daystate_summary(org_id, str_to_date(start), str_to_date(end))
+    names = {daystate.id: daystate.identifier for daystate in
+             Daystate.query.filter_by(org_id=org_id).all()}
+    state_ids = list(summary['daystates'])
+
+    print('{} school days from {} to {}'.format(
+        summary['school_days'], summary['start'], summary['end']
+    ))
+    for state_id in state_ids:
+        print('\t{}: {}'.format(names.get(state_id, state_id),
+                                summary['daystates'][state_id]))
+
+    print('{:>12}'.format('week of') +
+          ''.join('{:>8}'.format(names.get(state_id, state_id))
+                  for state_id in state_ids) + '{:>16}'.format('usable passes'))
+    for week in summary['weeks']:
+        print('{:>12}'.format(week['start']) +
+              ''.join('{:>8}'.format(week['daystates'][state_id])
+                      for state_id in state_ids) +
+              '{:>16}'.format(week['usable_passes']))
+
+
 if __name__ == "__main__":
     manager.run()
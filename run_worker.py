@@ -5,6 +5,8 @@ import sys
 
 import redis
 
+import inpassing
+from inpassing.view_util import get_org_by_id
 from inpassing.worker import ParkingWorker
 
 if __name__ == '__main__':
@@ -13,6 +15,11 @@ if __name__ == '__main__':
         print('usage: {} <org_id>'.format(sys.argv[0]))
         exit(1)
 
+    # The worker needs to know the org's timezone to tell what today is.
+    app = inpassing.create_app(instance_relative_config=True)
+    with app.app_context():
+        org = get_org_by_id(int(sys.argv[1]))
+
     r = redis.StrictRedis(host='localhost', port=6379, db=0)
-    worker = ParkingWorker(r, int(sys.argv[1]))
+    worker = ParkingWorker(r, org)
     worker.run()